@@ -0,0 +1,436 @@
+"""JSON API for Warbler, version 1.
+
+Endpoints, under /api/v1 (those marked * need a logged-in session, the
+same cookie the HTML pages use):
+
+    GET     /timeline *                 home timeline
+    GET     /users/<id>                 profile
+    GET     /users/<id>/messages        their messages
+    GET     /users/<id>/likes *         messages they liked (only your
+                                        own, as on the HTML likes page)
+    GET     /users/<id>/following *     users they follow
+    GET     /users/<id>/followers *     users following them
+    POST    /users/<id>/follow *        follow them (DELETE: unfollow)
+    GET     /messages/<id>              one message
+    POST    /messages/<id>/like *       like it (DELETE: unlike)
+
+Lists come as {"<items>": [...], "next": cursor}: at most `limit` items
+(default API_PAGE_SIZE), newest (or, for users, lowest id) first. Pass
+`next` back as `cursor` for the following page; it is null on the last.
+
+Everything is read with column-only queries, so no ORM objects are built,
+and encoded with orjson when it is installed. Lists are streamed from a
+server-side cursor in chunks, so memory use doesn't grow with `limit`.
+
+POST and DELETE need `Content-Type: application/json`, which browsers
+won't send cross-site without a CORS preflight, so a form on another site
+can't make them with the user's cookie.
+"""
+
+import json
+
+from flask import (
+    Blueprint, Response, abort, g, request, stream_with_context,
+)
+from sqlalchemy import exists, literal, tuple_
+from sqlalchemy.orm import aliased
+from werkzeug.exceptions import HTTPException
+
+from invalidation import invalidate_cached_users, invalidate_timelines
+from models import db, Follows, Like, Message, TimelineEntry, User
+from pagination import decode_cursor, encode_cursor
+from replicas import read_from_replica
+
+try:
+    import orjson
+except ImportError:  # the standard library is slower, but works
+    orjson = None
+
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+
+# Rows encoded per chunk of a streamed list
+STREAM_CHUNK_ROWS = 100
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+##############################################################################
+# Encoding
+
+
+def dumps(value):
+    """ `value` as compact JSON bytes. """
+
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':')).encode()
+
+
+def json_response(value, status=200):
+    return Response(dumps(value), status=status, mimetype='application/json')
+
+
+def stream_page(name, rows, limit, serialize, cursor_for):
+    """ Stream {"<name>": [...], "next": cursor} from `rows`.
+
+    `rows` should hold up to `limit` + 1 rows: an extra one means there's
+    a next page, starting after the `limit`th row.
+    """
+
+    def generate():
+        yield b'{"' + name.encode() + b'":['
+
+        chunk = []
+        sent = 0
+        last = None
+        next_cursor = None
+
+        for row in rows:
+            if sent == limit:
+                next_cursor = cursor_for(last)
+                break
+
+            # Items after the first chunk's need a comma before them too
+            if sent and not chunk:
+                chunk.append(b'')
+            chunk.append(dumps(serialize(row)))
+            sent += 1
+            last = row
+
+            if len(chunk) >= STREAM_CHUNK_ROWS:
+                yield b','.join(chunk)
+                chunk = []
+
+        yield b','.join(chunk) + b'],"next":' + dumps(next_cursor) + b'}'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+def page_limit():
+    return min(max(request.args.get('limit', API_PAGE_SIZE, type=int), 1),
+               API_MAX_PAGE_SIZE)
+
+
+def timestamp(value):
+    return f"{value.isoformat()}Z"
+
+
+##############################################################################
+# Queries and serializers
+
+
+def message_query():
+    """ Column-only query of messages with their (active) authors, plus
+    whether the current user liked each one.
+    """
+
+    if g.user:
+        # Aliased so it stays correlated when the query also joins likes
+        viewer_like = aliased(Like)
+        liked = (exists()
+                 .where(viewer_like.message_id == Message.id)
+                 .where(viewer_like.user_id == g.user.id))
+    else:
+        liked = literal(False)
+
+    return (db.session
+            .query(
+                Message.id,
+                Message.text,
+                Message.timestamp,
+                Message.likes_count,
+                User.id.label('user_id'),
+                User.username,
+                User.image_url,
+                liked.label('liked'),
+            )
+            .join(User, Message.user_id == User.id)
+            .filter(User.deactivated.is_(False)))
+
+
+def message_json(row):
+    return {
+        'id': row.id,
+        'text': row.text,
+        'timestamp': timestamp(row.timestamp),
+        'likes_count': row.likes_count,
+        'liked': bool(row.liked),
+        'user': {
+            'id': row.user_id,
+            'username': row.username,
+            'image_url': row.image_url,
+        },
+    }
+
+
+def message_cursor(row):
+    return encode_cursor(row.timestamp, row.id)
+
+
+def newest_first(query, timestamp_col, id_col, limit):
+    """ One page of `query`, newest first, after the request's cursor. """
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        key = decode_cursor(cursor)
+        if key is None:
+            abort(400, "Invalid cursor")
+        query = query.filter(tuple_(timestamp_col, id_col) < tuple_(*key))
+
+    return (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(limit + 1)
+            .yield_per(STREAM_CHUNK_ROWS))
+
+
+def stream_messages(query, timestamp_col, id_col):
+    limit = page_limit()
+    rows = newest_first(query, timestamp_col, id_col, limit)
+    return stream_page('messages', rows, limit, message_json, message_cursor)
+
+
+def stream_users(query, id_col):
+    """ Stream a page of users by id from `query`, which selects from
+    follows; `id_col` is the follows column holding the listed users.
+    """
+
+    limit = page_limit()
+    cursor = request.args.get('cursor')
+    if cursor:
+        if not cursor.isdigit():
+            abort(400, "Invalid cursor")
+        query = query.filter(id_col > int(cursor))
+
+    rows = (query
+            .join(User, User.id == id_col)
+            .filter(User.deactivated.is_(False))
+            .with_entities(User.id, User.username, User.image_url, User.bio)
+            .order_by(id_col)
+            .limit(limit + 1)
+            .yield_per(STREAM_CHUNK_ROWS))
+
+    return stream_page(
+        'users',
+        rows,
+        limit,
+        lambda row: {
+            'id': row.id,
+            'username': row.username,
+            'image_url': row.image_url,
+            'bio': row.bio,
+        },
+        lambda row: str(row.id),
+    )
+
+
+def login_required():
+    if not g.user:
+        abort(401, "Log in first")
+
+
+def require_active_user(user_id):
+    """ 404 unless user `user_id` exists and isn't being deleted. """
+
+    active = exists().where(User.id == user_id).where(~User.deactivated)
+    if not db.session.query(active).scalar():
+        abort(404, "No such user")
+
+
+@api.before_request
+def require_json_for_writes():
+    if request.method in ('POST', 'DELETE') and not request.is_json:
+        abort(415, "Send Content-Type: application/json")
+
+
+@api.errorhandler(HTTPException)
+def api_error(error):
+    return json_response({'error': error.description}, error.code)
+
+
+##############################################################################
+# Messages
+
+
+@api.route('/timeline')
+@read_from_replica
+def timeline():
+    """ The current user's home timeline. """
+
+    login_required()
+
+    query = (message_query()
+             .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+             .filter(TimelineEntry.user_id == g.user.id))
+
+    return stream_messages(
+        query, TimelineEntry.timestamp, TimelineEntry.message_id)
+
+
+@api.route('/messages/<int:message_id>')
+@read_from_replica
+def message(message_id):
+    row = message_query().filter(Message.id == message_id).first()
+    if row is None:
+        abort(404, "No such message")
+
+    return json_response(message_json(row))
+
+
+@api.route('/users/<int:user_id>/messages')
+@read_from_replica
+def user_messages(user_id):
+    require_active_user(user_id)
+
+    query = message_query().filter(Message.user_id == user_id)
+    return stream_messages(query, Message.timestamp, Message.id)
+
+
+@api.route('/users/<int:user_id>/likes')
+@read_from_replica
+def user_likes(user_id):
+    login_required()
+    if user_id != g.user.id:
+        abort(403, "You can only see your own likes")
+    require_active_user(user_id)
+
+    query = (message_query()
+             .join(Like, Like.message_id == Message.id)
+             .filter(Like.user_id == user_id))
+    return stream_messages(query, Message.timestamp, Message.id)
+
+
+@api.route('/messages/<int:message_id>/like', methods=['POST', 'DELETE'])
+def like(message_id):
+    """ Like (POST) or unlike (DELETE) a message. """
+
+    login_required()
+
+    author_id = (db.session
+                 .query(Message.user_id)
+                 .join(User, User.id == Message.user_id)
+                 .filter(Message.id == message_id)
+                 .filter(User.deactivated.is_(False))
+                 .scalar())
+    if author_id is None:
+        abort(404, "No such message")
+    if author_id == g.user.id:
+        abort(400, "Cannot like your own message")
+
+    # Read before the commit expires it, so that doesn't reload the user
+    user_id = g.user.id
+
+    if request.method == 'POST':
+        g.user.like(message_id)
+    else:
+        g.user.unlike(message_id)
+
+    db.session.commit()
+    invalidate_cached_users(user_id)
+    invalidate_timelines(user_id)
+
+    likes_count = (db.session
+                   .query(Message.likes_count)
+                   .filter(Message.id == message_id)
+                   .scalar())
+
+    return json_response({
+        'liked': request.method == 'POST',
+        'likes_count': likes_count,
+    })
+
+
+##############################################################################
+# Users
+
+
+@api.route('/users/<int:user_id>')
+@read_from_replica
+def user(user_id):
+    if g.user:
+        following = exists().where(
+            (Follows.user_following_id == g.user.id) &
+            (Follows.user_being_followed_id == User.id))
+    else:
+        following = literal(False)
+
+    row = (db.session
+           .query(
+               User.id,
+               User.username,
+               User.image_url,
+               User.header_image_url,
+               User.bio,
+               User.location,
+               User.messages_count,
+               User.following_count,
+               User.followers_count,
+               User.likes_count,
+               following.label('following'),
+           )
+           .filter(User.id == user_id)
+           .filter(User.deactivated.is_(False))
+           .first())
+
+    if row is None:
+        abort(404, "No such user")
+
+    return json_response(dict(row._asdict(), following=bool(row.following)))
+
+
+@api.route('/users/<int:user_id>/following')
+@read_from_replica
+def user_following(user_id):
+    login_required()
+    require_active_user(user_id)
+
+    query = (db.session
+             .query(Follows)
+             .filter(Follows.user_following_id == user_id))
+    return stream_users(query, Follows.user_being_followed_id)
+
+
+@api.route('/users/<int:user_id>/followers')
+@read_from_replica
+def user_followers(user_id):
+    login_required()
+    require_active_user(user_id)
+
+    query = (db.session
+             .query(Follows)
+             .filter(Follows.user_being_followed_id == user_id))
+    return stream_users(query, Follows.user_following_id)
+
+
+@api.route('/users/<int:user_id>/follow', methods=['POST', 'DELETE'])
+def follow(user_id):
+    """ Follow (POST) or unfollow (DELETE) a user. """
+
+    login_required()
+    require_active_user(user_id)
+
+    if user_id == g.user.id:
+        abort(400, "Cannot follow yourself")
+
+    # Read before the commit expires it, so that doesn't reload the user
+    follower_id = g.user.id
+
+    if request.method == 'POST':
+        g.user.follow(user_id)
+    else:
+        g.user.unfollow(user_id)
+
+    db.session.commit()
+    invalidate_cached_users(follower_id, user_id)
+    invalidate_timelines(follower_id)
+
+    followers_count = (db.session
+                       .query(User.followers_count)
+                       .filter(User.id == user_id)
+                       .scalar())
+
+    return json_response({
+        'following': request.method == 'POST',
+        'followers_count': followers_count,
+    })
@@ -1,7 +1,16 @@
+import hashlib
+import hmac
 import os
+import signal
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from functools import wraps
 
+import click
 from flask import (
     Flask,
+    Response,
     render_template,
     request,
     flash,
@@ -9,9 +18,18 @@ from flask import (
     session,
     g,
     url_for,
+    abort,
+    jsonify,
 )
+from flask.ctx import _AppCtxGlobals
 from flask_debugtoolbar import DebugToolbarExtension
+from werkzeug.http import is_resource_modified
+from sqlalchemy import inspect
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import (
+    contains_eager, joinedload, make_transient_to_detached,
+)
+from cache import DictBackend, LRUCache, TieredCache, backend_from_url
 from forms import (
     UserAddForm,
     LoginForm,
@@ -20,11 +38,34 @@ from forms import (
     UserLogoutForm,
     UserMessageLikeForm,
 )
-from models import db, connect_db, User, Message
+from fragments import FragmentCache
+from api import api
+from models import (
+    db, bcrypt, connect_db, User, Message, TimelineEntry, Like, Follows,
+)
+from passwords import PasswordHasherBusy
+from instrumentation import sql_instrumentation
+from metrics import metrics
+from replicas import read_from_replica, reading_from_primary
+from dbpool import engine_options
+from search import UserSearch, MessageSearch
+from timelines import TimelineCache
+from invalidation import (
+    invalidate, invalidate_cached_users, invalidate_timelines,
+)
+from deletion import delete_deactivated_user, delete_user
+from jobs import job_queue
+import migrations
+from pagination import paginate
 
 CURR_USER_KEY = "curr_user"
 DEFAULT_IMAGE_URL = "/static/images/default-pic.png"
 DEFAULT_HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
+TIMELINE_PAGE_SIZE = 100
+PROFILE_PAGE_SIZE = 25
+USERS_PAGE_SIZE = 24
+USERS_MAX_PAGES = 10
+MESSAGE_SEARCH_PAGE_SIZE = 25
 
 app = Flask(__name__)
 
@@ -34,27 +75,249 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Read replicas (comma-separated URLs) for the read-only views; see
+# replicas.py. A user reads from the primary for a few seconds after
+# writing, and a replica that fails is left out for a while.
+app.config['SQLALCHEMY_REPLICA_URLS'] = [
+    url.strip()
+    for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url.strip()
+]
+app.config['DB_REPLICA_STICKY_SECONDS'] = float(
+    os.environ.get('DB_REPLICA_STICKY_SECONDS', 5))
+app.config['DB_REPLICA_COOLDOWN'] = float(
+    os.environ.get('DB_REPLICA_COOLDOWN', 30))
+
+# Connection pooling: 'queue' keeps a pool per process; 'pgbouncer' leaves
+# pooling to pgbouncer (transaction mode). See dbpool.py.
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+    mode=os.environ.get('DB_POOL_MODE', 'queue'),
+    size=app.config['DB_POOL_SIZE'],
+    max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    timeout=float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    pre_ping=os.environ.get('DB_POOL_PRE_PING', '1') != '0',
+)
+
+# Connections each gunicorn worker opens when it starts
+app.config['DB_POOL_WARMUP'] = int(
+    os.environ.get('DB_POOL_WARMUP', app.config['DB_POOL_SIZE']))
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
+
+# Password hashing runs in a pool of this many processes per web worker.
+# Each call waiting on it holds one of the worker's GUNICORN_THREADS
+# threads (see gunicorn.conf.py); beyond BCRYPT_POOL_MAX_PENDING of them,
+# half the threads by default so the rest keep serving pages, requests
+# get a fast 503.
+app.config['BCRYPT_POOL_WORKERS'] = int(
+    os.environ.get('BCRYPT_POOL_WORKERS', 2))
+app.config['BCRYPT_POOL_MAX_PENDING'] = int(
+    os.environ.get('BCRYPT_POOL_MAX_PENDING',
+                   max(int(os.environ.get('GUNICORN_THREADS', 8)) // 2, 1)))
+
+# bcrypt cost for new hashes; older hashes at another cost are upgraded
+# (or downgraded) the next time their user logs in.
+app.config['BCRYPT_LOG_ROUNDS'] = int(
+    os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+
+# Shared cache store: 'redis://...' in production, 'memory://' for a local
+# stand-in; unset means each process only has its own in-memory LRU.
+app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL')
+
+# The session user is cached (minus their password hash) for a few seconds
+# per process, and longer in the shared store; both are invalidated when
+# the user's row changes.
+app.config['CURRENT_USER_CACHE_SIZE'] = int(
+    os.environ.get('CURRENT_USER_CACHE_SIZE', 10000))
+app.config['CURRENT_USER_CACHE_TTL'] = int(
+    os.environ.get('CURRENT_USER_CACHE_TTL', 5))
+app.config['CURRENT_USER_SHARED_CACHE_TTL'] = int(
+    os.environ.get('CURRENT_USER_SHARED_CACHE_TTL', 60))
+
+# Rendered fragments (profile headers, message cards, the anonymous home
+# page) kept per process and in the shared store, for this many seconds.
+# Their keys change when what they show does; see fragments.py.
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['FRAGMENT_CACHE_TTL'] = int(
+    os.environ.get('FRAGMENT_CACHE_TTL', 3600))
+
+# First pages of home timelines, and the messages and authors on them
+# (see timelines.py), kept in the shared store. Writes drop what they
+# change; entries expire after TIMELINE_CACHE_TTL seconds regardless.
+# Without CACHE_REDIS_URL there's no timeline cache: other processes
+# would keep serving pages a write had made stale.
+app.config['TIMELINE_CACHE_TTL'] = int(
+    os.environ.get('TIMELINE_CACHE_TTL', 600))
+
+# Rows removed per transaction when a deleted account is cleared out in
+# the background (see deletion.py)
+app.config['USER_DELETE_BATCH_SIZE'] = int(
+    os.environ.get('USER_DELETE_BATCH_SIZE', 1000))
+
+# Background jobs (see jobs.py): runs before a failing job is kept as
+# 'failed', seconds before its first retry (doubling after that), and
+# seconds a job may stay 'running' without a heartbeat before it's taken
+# for abandoned and run again
+app.config['JOB_MAX_ATTEMPTS'] = int(
+    os.environ.get('JOB_MAX_ATTEMPTS', 5))
+app.config['JOB_RETRY_DELAY'] = int(
+    os.environ.get('JOB_RETRY_DELAY', 10))
+app.config['JOB_TIMEOUT'] = int(
+    os.environ.get('JOB_TIMEOUT', 3600))
+
+# Seconds browsers and proxies may keep pages that allow it (see
+# cache_policy) when shown to anonymous visitors
+app.config['PUBLIC_CACHE_MAX_AGE'] = int(
+    os.environ.get('PUBLIC_CACHE_MAX_AGE', 60))
+
+# Statements slower than this are logged as warnings (0: never)
+app.config['SLOW_QUERY_THRESHOLD_MS'] = float(
+    os.environ.get('SLOW_QUERY_THRESHOLD_MS', 100))
+
+# Bearer token for /admin/metrics; unset disables the page
+app.config['ADMIN_METRICS_TOKEN'] = os.environ.get('ADMIN_METRICS_TOKEN')
+
+# Bearer token Prometheus must send for /metrics; unset leaves the page
+# open, for deployments where only the internal network can reach it
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# Directory where each worker process writes its /metrics values, so any
+# worker can report for all of them; unset reports just the one process.
+app.config['METRICS_MULTIPROC_DIR'] = os.environ.get('METRICS_MULTIPROC_DIR')
+
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+sql_instrumentation.init_app(app)
+metrics.init_app(app, db, bcrypt)
+
+shared_cache = backend_from_url(app.config['CACHE_REDIS_URL'])
+
+current_user_cache = TieredCache(
+    LRUCache(
+        maxsize=app.config['CURRENT_USER_CACHE_SIZE'],
+        ttl=app.config['CURRENT_USER_CACHE_TTL'],
+    ),
+    shared_cache,
+    prefix='warbler:user:',
+    shared_ttl=app.config['CURRENT_USER_SHARED_CACHE_TTL'],
+)
+
+timeline_cache = TimelineCache(
+    shared_cache,
+    ttl=app.config['TIMELINE_CACHE_TTL'],
+)
+
+# Writes everywhere drop what they change from these (invalidation.py)
+app.extensions['current_user_cache'] = current_user_cache
+app.extensions['timeline_cache'] = timeline_cache
+app.register_blueprint(api)
+
+fragment_cache = FragmentCache(TieredCache(
+    LRUCache(
+        maxsize=app.config['FRAGMENT_CACHE_SIZE'],
+        ttl=app.config['FRAGMENT_CACHE_TTL'],
+    ),
+    shared_cache,
+    prefix='warbler:fragment:',
+    shared_ttl=app.config['FRAGMENT_CACHE_TTL'],
+))
+fragment_cache.init_app(app)
+
+CACHED_USER_COLUMNS = [
+    attr.key for attr in inspect(User).column_attrs if attr.key != 'password'
+]
+
+# Without pg_trgm (or PostgreSQL, for warble search), search uses
+# in-process indexes that are rebuilt from the database this often
+# (seconds).
+app.config['USER_SEARCH_REFRESH_INTERVAL'] = int(
+    os.environ.get('USER_SEARCH_REFRESH_INTERVAL', 60))
+
+job_queue.init_app(app)
+
+user_search = UserSearch(
+    refresh_interval=app.config['USER_SEARCH_REFRESH_INTERVAL'])
+message_search = MessageSearch(
+    refresh_interval=app.config['USER_SEARCH_REFRESH_INTERVAL'])
 
 
 ##############################################################################
 # User signup/login/logout
 
 
+class AppGlobals(_AppCtxGlobals):
+    """Flask global whose `user` is loaded on first access.
+
+    Requests that never read g.user (redirects, static-ish pages) don't
+    load the current user at all.
+    """
+
+    @property
+    def user(self):
+        if '_user' not in self.__dict__:
+            self._user = load_session_user()
+        return self._user
+
+    @user.setter
+    def user(self, value):
+        self._user = value
+
+
+app.app_ctx_globals_class = AppGlobals
+
+
+def load_session_user():
+    """Return the logged-in user (or None), from the cache if possible.
+
+    A cache hit is attached to the DB session without running a query;
+    relationships and the password hash still load on demand.
+    """
+
+    user_id = session.get(CURR_USER_KEY)
+    if user_id is None:
+        return None
+
+    columns = current_user_cache.get(user_id)
+
+    if columns is None:
+        # Cached for everyone, so read from the primary, not a replica
+        # that might lag (even if the view already loaded them from one)
+        with reading_from_primary():
+            user = User.query.populate_existing().get(user_id)
+        if user is None or user.deactivated:
+            return None
+
+        current_user_cache.set(
+            user_id,
+            {key: getattr(user, key) for key in CACHED_USER_COLUMNS},
+        )
+        g._user_from_cache = False
+        return user
+
+    if columns['deactivated']:
+        return None
+
+    g._user_from_cache = True
+
+    user = User(**columns)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, make curr user available as g.user.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    The user is only loaded when g.user is first read (see AppGlobals).
+    """
 
-    else:
-        g.user = None
+    g.pop('_user', None)
 
 
 def do_login(user):
@@ -70,6 +333,104 @@ def do_logout():
         session.pop(CURR_USER_KEY, None)
 
 
+def liked_ids_for(messages):
+    """Ids of `messages` liked by the current user, as a set of ints.
+
+    Computed once per request so templates can test `message.id in
+    liked_ids` without re-loading the user's likes for every message.
+    """
+
+    if not g.user:
+        return set()
+
+    return g.user.liked_message_ids([message.id for message in messages])
+
+
+def active_user_or_404(user_id):
+    """User `user_id`, or a 404 if there's none or they're being deleted."""
+
+    user = User.query.get_or_404(user_id)
+    if user.deactivated:
+        abort(404)
+
+    return user
+
+
+def followed_ids_for(users):
+    """Ids of `users` the current user follows, as a set of ints.
+
+    One query for the whole page, so templates can test `user.id in
+    followed_ids` instead of calling is_following for every user.
+    """
+
+    if not g.user:
+        return set()
+
+    return g.user.following_ids([user.id for user in users])
+
+
+def cacheable(view):
+    """Let browsers and proxies keep the pages this view returns.
+
+    See add_header for the Cache-Control this leads to; pages from views
+    without it aren't stored at all.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g._cacheable = True
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def check_not_modified(*stamps):
+    """Answer a conditional GET: a 304 response if the client's copy of
+    the page is current, else None.
+
+    `stamps` are datetimes that move whenever the page's content would
+    (e.g. the shown user's updated_at). The viewer's own updated_at is
+    added, as is the start of the current CSRF token window, since pages
+    show the viewer and embed tokens that expire. The page gets a weak
+    ETag from them (see add_header). Call this as soon as the stamps are
+    known, and return the 304 if there is one.
+
+    There's no Last-Modified: its one-second resolution would answer 304
+    for a change made in the same second as the client's copy. For the
+    same reason the viewer's updated_at comes from the database, not from
+    the current-user cache, which another process may hold for a few
+    seconds after a change.
+    """
+
+    if '_flashes' in session:
+        # This render shows (and uses up) flashed messages
+        return None
+
+    stamps = list(stamps)
+    viewer_id = g.user.id if g.user else None
+    if g.user and not g._user_from_cache:
+        stamps.append(g.user.updated_at)
+    elif g.user:
+        stamps.append(db.session
+                      .query(User.updated_at)
+                      .filter(User.id == viewer_id)
+                      .scalar())
+
+    csrf_time_limit = app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    if csrf_time_limit:
+        window = csrf_time_limit / 2
+        stamps.append(
+            datetime.utcfromtimestamp(time.time() // window * window))
+
+    etag = hashlib.sha1(repr((viewer_id, stamps)).encode()).hexdigest()
+    g._etag = etag
+
+    if not is_resource_modified(request.environ, etag=etag):
+        return Response(status=304)
+
+    return None
+
+
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
@@ -95,6 +456,7 @@ def signup():
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
+            user_search.user_changed(user)
 
         except IntegrityError:
             flash("Username already taken", 'danger')
@@ -119,6 +481,9 @@ def login():
                                  form.password.data)
 
         if user:
+            # Saves a rehashed password if the bcrypt cost changed
+            db.session.commit()
+
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -150,34 +515,86 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@read_from_replica
+@cacheable
 def users_list():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username (best
+    matches first) and a 'page' param. At most USERS_MAX_PAGES pages of
+    USERS_PAGE_SIZE users are shown.
     """
 
-    search = request.args.get('q')
+    search = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    page = min(max(page, 1), USERS_MAX_PAGES)
+    offset = (page - 1) * USERS_PAGE_SIZE
 
     if not search:
-        users = User.query.all()
+        users = (User
+                 .query
+                 .filter(User.deactivated.is_(False))
+                 .order_by(User.id)
+                 .limit(USERS_PAGE_SIZE + 1)
+                 .offset(offset)
+                 .all())
     else:
-        users = User.query.filter(User.username.ilike(f"%{search}%")).all()
+        users = user_search.search(
+            search, limit=USERS_PAGE_SIZE + 1, offset=offset)
 
-    return render_template('users/index.html', users=users)
+    has_next = len(users) > USERS_PAGE_SIZE and page < USERS_MAX_PAGES
+    users = users[:USERS_PAGE_SIZE]
+
+    return render_template(
+        'users/index.html',
+        users=users,
+        followed_ids=followed_ids_for(users),
+        search=search,
+        page=page,
+        has_next=has_next,
+    )
 
 
 @app.route('/users/<int:user_id>')
+@read_from_replica
+@cacheable
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile with one page of their messages.
 
-    user = User.query.get_or_404(user_id)
+    Takes 'before' / 'after' cursors in the querystring for older / newer
+    pages. Answers conditional GETs from the user's updated_at, which
+    moves with every message, follow and like they make.
+    """
+
+    user = active_user_or_404(user_id)
+
+    response = check_not_modified(user.updated_at)
+    if response is not None:
+        return response
+
+    messages = paginate(
+        Message.query.filter(Message.user_id == user.id),
+        Message.timestamp,
+        Message.id,
+        per_page=PROFILE_PAGE_SIZE,
+        before=request.args.get('before'),
+        after=request.args.get('after'),
+    )
 
     form = UserMessageLikeForm()
 
-    return render_template('users/show.html', user=user, form=form)
+    return render_template(
+        'users/show.html',
+        user=user,
+        messages=messages,
+        liked_ids=liked_ids_for(messages),
+        form=form,
+    )
 
 
 @app.route('/users/<int:user_id>/following')
+@read_from_replica
+@cacheable
 def users_following(user_id):
     """Show list of people this user is following."""
 
@@ -185,11 +602,25 @@ def users_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = active_user_or_404(user_id)
+    following = (User
+                 .query
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user.id)
+                 .filter(User.deactivated.is_(False))
+                 .all())
+
+    return render_template(
+        'users/following.html',
+        user=user,
+        following=following,
+        followed_ids=followed_ids_for(following),
+    )
 
 
 @app.route('/users/<int:user_id>/followers')
+@read_from_replica
+@cacheable
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -197,8 +628,20 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = active_user_or_404(user_id)
+    followers = (User
+                 .query
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == user.id)
+                 .filter(User.deactivated.is_(False))
+                 .all())
+
+    return render_template(
+        'users/followers.html',
+        user=user,
+        followers=followers,
+        followed_ids=followed_ids_for(followers),
+    )
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -209,11 +652,17 @@ def users_add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    followed_user = active_user_or_404(follow_id)
+    if followed_user.id == g.user.id:
+        flash("Cannot follow yourself", "danger")
+        return redirect(f"/users/{g.user.id}")
+
+    g.user.follow(followed_user.id)
     db.session.commit()
+    invalidate_cached_users(g.user.id, followed_user.id)
+    invalidate_timelines(g.user.id)
 
-    redirect_url = url_for('show_following', user_id=g.user.id)
+    redirect_url = url_for('users_following', user_id=g.user.id)
     return redirect(redirect_url)
 
 
@@ -225,9 +674,11 @@ def users_stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    followed_user = User.query.get_or_404(follow_id)
+    g.user.unfollow(followed_user.id)
     db.session.commit()
+    invalidate_cached_users(g.user.id, followed_user.id)
+    invalidate_timelines(g.user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -258,6 +709,8 @@ def users_edit_profile():
             user.bio = form.bio.data
             user.location = form.location.data
             db.session.commit()
+            invalidate_cached_users(user.id)
+            user_search.user_changed(user)
 
             flash("User has been edited!", "success")
             return redirect(f"/users/{user.id}")
@@ -269,7 +722,11 @@ def users_edit_profile():
 
 @app.route('/users/delete', methods=["POST"])
 def users_delete():
-    """Delete user."""
+    """Delete user.
+
+    They're deactivated at once; their rows are deleted by a background
+    job, in batches (see deletion.py).
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
@@ -277,10 +734,13 @@ def users_delete():
 
     do_logout()
 
-    Message.query.filter_by(user_id=g.user.id).delete()
-    db.session.flush()
-    db.session.delete(g.user)
+    user_id = g.user.id
+    User.query.filter_by(id=user_id).update(
+        {User.deactivated: True}, synchronize_session=False)
+    job_queue.enqueue(delete_deactivated_user, user_id=user_id)
     db.session.commit()
+    invalidate_cached_users(user_id)
+    user_search.user_removed(user_id)
 
     return redirect("/signup")
 
@@ -294,6 +754,9 @@ def messages_add():
     """Add a message:
 
     Show form if GET. If valid, update message and redirect to user page.
+
+    It goes on the author's timeline at once; a fan_out_message job adds
+    it to their followers'.
     """
 
     if not g.user:
@@ -305,24 +768,91 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        User.adjust_counters(g.user.id, messages_count=1)
+        TimelineEntry.fan_out(msg, followers=False)
+        job_queue.enqueue(fan_out_message, message_id=msg.id)
         db.session.commit()
+        invalidate_cached_users(g.user.id)
+        invalidate_timelines(g.user.id)
+        message_search.message_added(msg)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@job_queue.task
+def fan_out_message(message_id):
+    """Job: add a new message to its author's followers' timelines."""
+
+    msg = Message.query.get(message_id)
+    if msg is None:
+        return
+
+    TimelineEntry.fan_out_followers(msg)
+    readers = TimelineEntry.readers(message_id=message_id)
+    db.session.commit()
+    invalidate_timelines(*readers)
+
+
+@app.route('/messages/search')
+def messages_search():
+    """Search warbles by text, best matches first.
+
+    Takes the search in a 'q' param and, for later pages of results, the
+    previous page's cursor in 'after'.
+    """
+
+    search = request.args.get('q', '').strip()
+    messages = []
+    next_cursor = None
+
+    if search:
+        messages, next_cursor = message_search.search(
+            search,
+            limit=MESSAGE_SEARCH_PAGE_SIZE,
+            after=request.args.get('after'),
+        )
+
+    return render_template(
+        'messages/search.html',
+        form=UserMessageLikeForm(),
+        messages=messages,
+        liked_ids=liked_ids_for(messages),
+        search=search,
+        next_cursor=next_cursor,
+    )
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@read_from_replica
+@cacheable
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message.
+
+    Answers conditional GETs from the message's timestamp and its
+    author's updated_at.
+    """
+
+    msg = (Message
+           .query
+           .options(joinedload(Message.user))
+           .get_or_404(message_id))
+    if msg.user.deactivated:
+        abort(404)
+
+    response = check_not_modified(msg.timestamp, msg.user.updated_at)
+    if response is not None:
+        return response
 
     form = UserMessageLikeForm()
-    msg = Message.query.get_or_404(message_id)
 
     return render_template(
         'messages/show.html',
         form=form,
         message=msg,
+        liked_ids=liked_ids_for([msg]),
         user=g.user,
     )
 
@@ -340,8 +870,13 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    Message.remove_from_counters(msg)
+    readers = TimelineEntry.readers(message_id=msg.id)
+    TimelineEntry.remove_message(msg.id)
     db.session.delete(msg)
     db.session.commit()
+    invalidate(users=[g.user.id], timelines=readers, messages=[message_id])
+    message_search.message_removed(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -358,9 +893,26 @@ def users_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    messages = (Message
+                .query
+                .join(Like, Like.message_id == Message.id)
+                .join(User, User.id == Message.user_id)
+                .filter(Like.user_id == g.user.id)
+                .filter(User.deactivated.is_(False))
+                .options(contains_eager(Message.user))
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .all())
+
     form = UserMessageLikeForm()
 
-    return render_template('users/likes.html', form=form, user=g.user)
+    return render_template(
+        'users/likes.html',
+        form=form,
+        user=g.user,
+        messages=messages,
+        followed_ids=followed_ids_for(
+            {message.user for message in messages}),
+    )
 
 
 @app.route('/messages/<int:message_id>/like', methods=["POST"])
@@ -371,21 +923,23 @@ def messages_add_like(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    # Check if message exists
+    # Check if message exists (and its author isn't being deleted)
     message = Message.query.get_or_404(message_id)
+    if message.user.deactivated:
+        abort(404)
 
     # Check if user message, user cannot like own message
     if message.user_id == g.user.id:
         flash("Cannot like your own message", "danger")
         return redirect(f"/users/{g.user.id}/likes")
 
-    # Check if message is already liked or not for toggle
-    if message in g.user.messages_liked:
-        g.user.messages_liked.remove(message)
-    else:
-        g.user.messages_liked.append(message)
+    # Unlike if already liked, otherwise like
+    if not g.user.unlike(message.id):
+        g.user.like(message.id)
 
     db.session.commit()
+    invalidate_cached_users(g.user.id)
+    invalidate_timelines(g.user.id)
     return redirect(f"/users/{g.user.id}/likes")
 
 
@@ -394,42 +948,298 @@ def messages_add_like(message_id):
 
 
 @app.route('/')
+@read_from_replica
+@cacheable
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, read from
+      the user's materialized timeline; 'before' / 'after' cursors in the
+      querystring page to older / newer messages. The first page comes
+      from timeline_cache when it's there; when it isn't, it's read from
+      the primary (not a replica that may lag) and cached.
     """
 
     form = UserMessageLikeForm()
 
     if g.user:
-        following_ids = [following.id for following in g.user.following]
-        target_users = following_ids + [g.user.id]
+        before = request.args.get('before')
+        after = request.args.get('after')
+        use_cache = timeline_cache.enabled and not (before or after)
+        cached = None
+
+        if use_cache:
+            cached = timeline_cache.get_page(g.user.id)
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(target_users))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        if cached is not None:
+            messages, liked_ids = cached
+        else:
+            with reading_from_primary() if use_cache else nullcontext():
+                messages = paginate(
+                    (TimelineEntry
+                     .messages_query(g.user.id)
+                     .options(contains_eager(Message.user))),
+                    TimelineEntry.timestamp,
+                    TimelineEntry.message_id,
+                    per_page=TIMELINE_PAGE_SIZE,
+                    before=before,
+                    after=after,
+                )
+                liked_ids = liked_ids_for(messages)
+
+            if use_cache:
+                timeline_cache.set_page(g.user.id, messages, liked_ids)
 
         return render_template('home.html',
                                messages=messages,
+                               liked_ids=liked_ids,
                                user=g.user,
                                form=form,
                                )
 
-    else:
+    elif '_flashes' in session:
         return render_template('home-anon.html')
 
+    else:
+        # Without flashed messages the page is the same for everyone
+        return fragment_cache.render('home-anon.html', ())
+
+
+##############################################################################
+# Admin pages
+
+
+def require_bearer_token(token):
+    """Abort with 403 unless the request sends 'Authorization: Bearer
+    <token>'.
+    """
+
+    scheme, _, given = request.headers.get('Authorization', '').partition(' ')
+    # As bytes: compare_digest() refuses str with non-ASCII characters
+    if scheme != 'Bearer' or not hmac.compare_digest(
+            given.encode(), token.encode()):
+        abort(403)
+
+
+@app.route('/admin/metrics')
+def admin_metrics():
+    """Per-endpoint request and SQL totals for this process, as JSON.
+
+    Needs an 'Authorization: Bearer <ADMIN_METRICS_TOKEN>' header; the
+    page doesn't exist unless ADMIN_METRICS_TOKEN is set.
+    """
+
+    token = app.config['ADMIN_METRICS_TOKEN']
+    if not token:
+        abort(404)
+    require_bearer_token(token)
+
+    return jsonify(
+        pid=os.getpid(),
+        endpoints=sql_instrumentation.snapshot(),
+    )
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Request latency, DB pool and bcrypt metrics for Prometheus.
+
+    Needs an 'Authorization: Bearer <METRICS_TOKEN>' header if that is
+    set; otherwise keep the page off the public internet.
+    """
+
+    if app.config['METRICS_TOKEN']:
+        require_bearer_token(app.config['METRICS_TOKEN'])
+
+    return Response(
+        metrics.exposition(),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
+
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """Fail fast when too many logins/signups are queued for bcrypt."""
+
+    return (
+        "Too many sign-ins right now, please try again in a moment.",
+        503,
+        {'Retry-After': '1'},
+    )
+
 
 ##############################################################################
-# Turn off all caching in Flask
+# CLI commands
+
+
+@app.cli.command('backfill-timelines')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Number of users rebuilt per transaction.')
+def backfill_timelines(batch_size):
+    """Rebuild materialized home timelines for existing users."""
+
+    backfill_all_timelines(batch_size)
+
+
+def backfill_all_timelines(batch_size=500, echo=click.echo):
+    """Rebuild every user's home timeline, committing every `batch_size`
+    users. Also used by seed.py."""
+
+    user_ids = [user_id for (user_id,) in
+                db.session.query(User.id).order_by(User.id)]
+
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        TimelineEntry.backfill(batch)
+        db.session.commit()
+        invalidate_timelines(*batch)
+        echo(f"Rebuilt timelines for {start + len(batch)}"
+             f"/{len(user_ids)} users")
+
+
+@app.cli.group('db')
+def db_commands():
+    """Schema migrations and query plan checks (see migrations.py)."""
+
+
+@db_commands.command('upgrade')
+def db_upgrade():
+    """Apply pending schema revisions."""
+
+    applied = migrations.upgrade(db.engine, echo=click.echo)
+    click.echo(f"Applied {len(applied)} revision(s)")
+
+
+@db_commands.command('status')
+def db_status():
+    """List schema revisions and whether each is applied."""
+
+    for migration, applied in migrations.status(db.engine):
+        mark = 'x' if applied else ' '
+        click.echo(f"[{mark}] {migration.revision} {migration.description}")
+
+
+@db_commands.command('check-plans')
+@click.option('--strict', is_flag=True,
+              help='Rule out table scans and sorts, for small databases.')
+def db_check_plans(strict):
+    """EXPLAIN the hot queries; fail unless each uses its index."""
+
+    with db.engine.connect() as connection:
+        checks = migrations.check_plans(connection, strict)
+
+    for check in checks:
+        result = 'ok' if check.ok else 'FAILED'
+        click.echo(f"{check.name} ({check.index}): {result}")
+        if not check.ok:
+            click.echo(check.plan)
+
+    if not all(check.ok for check in checks):
+        raise SystemExit(1)
+
+
+@app.cli.command('worker')
+@click.option('--burst', is_flag=True,
+              help='Exit once no jobs are due, instead of waiting for more.')
+@click.option('--poll-interval', default=1.0, show_default=True,
+              help='Seconds to wait between checks when no jobs are due.')
+def worker(burst, poll_interval):
+    """Run background jobs (see jobs.py) until stopped."""
+
+    # Jobs drop the timelines they change from the cache; a memory://
+    # store is this process's own, so web processes would never see that
+    if isinstance(timeline_cache.store, DictBackend):
+        click.echo("The worker needs CACHE_REDIS_URL to be a shared "
+                   "store (redis://), or unset; not memory://")
+        raise SystemExit(1)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: job_queue.stop())
+
+    ran = job_queue.work(burst=burst, poll_interval=poll_interval)
+    click.echo(f"Ran {ran} job(s)")
+
+
+@app.cli.command('purge-deactivated-users')
+def purge_deactivated_users():
+    """Finish deleting deactivated users, e.g. after a worker restart."""
+
+    user_ids = [user_id for (user_id,) in
+                db.session.query(User.id).filter(User.deactivated)]
+
+    for user_id in user_ids:
+        # Their job is doing this, or will; both at once would only contend
+        if job_queue.pending(delete_deactivated_user, user_id=user_id):
+            click.echo(f"User {user_id}: deletion job pending, skipped")
+            continue
+
+        totals = delete_user(
+            user_id,
+            app.config['USER_DELETE_BATCH_SIZE'],
+            progress=lambda step, deleted: click.echo(
+                f"User {user_id}: deleted {deleted} {step}"),
+        )
+        click.echo(f"Deleted user {user_id} "
+                   f"({sum(totals.values())} rows in all)")
+
+
+@app.cli.command('reconcile-counters')
+@click.option('--batch-size', default=10000, show_default=True,
+              help='Number of ids recomputed per transaction.')
+def reconcile_counters(batch_size):
+    """Recompute denormalized follow/message/like counters in bulk."""
+
+    reconcile_all_counters(batch_size)
+
+
+def reconcile_all_counters(batch_size=10000, echo=click.echo):
+    """Recompute every user's and message's counters, committing every
+    `batch_size` ids. Also used by seed.py."""
+
+    for model in (User, Message):
+        max_id = db.session.query(db.func.max(model.id)).scalar() or 0
+
+        for first_id in range(1, max_id + 1, batch_size):
+            model.reconcile_counters(first_id, first_id + batch_size - 1)
+            db.session.commit()
+
+        echo(f"Reconciled {model.__tablename__} counters up to id {max_id}")
+
+
+##############################################################################
+# Cache policies
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Set Cache-Control for each response.
+
+    - static files: Flask's (SEND_FILE_MAX_AGE_DEFAULT)
+    - successful pages from @cacheable views: public for
+      PUBLIC_CACHE_MAX_AGE seconds when anonymous (varying on the
+      session cookie); otherwise private, and revalidated before reuse,
+      since they show the logged-in user or their flashed messages
+    - everything else (forms, redirects, errors): not stored at all
+
+    Pages that went through check_not_modified also get its ETag.
+    """
+
+    if request.endpoint == 'static':
+        return response
+
+    etag = g.get('_etag')
+    if etag and response.status_code in (200, 304):
+        response.set_etag(etag, weak=True)
+
+    if not g.get('_cacheable') or response.status_code not in (200, 304):
+        response.cache_control.no_store = True
+
+    elif CURR_USER_KEY in session or session.modified:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['PUBLIC_CACHE_MAX_AGE']
+        response.vary.add('Cookie')
 
-    response.cache_control.no_store = True
     return response
@@ -0,0 +1,74 @@
+"""Report login throughput for each bcrypt cost level.
+
+Run from the repo root, for example:
+
+    python -m benchmarks.bcrypt_cost --rounds 10 11 12 13 --workers 4
+
+Each login is one `check_password_hash`, the bcrypt work done by
+`User.authenticate`. With --workers the checks go through the same
+process pool the app uses, with that many checks kept in flight.
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passwords import PasswordHasher
+
+PASSWORD = "benchmark-password"
+
+
+def logins_per_second(hasher, pw_hash, duration, concurrency):
+    """ Run password checks for `duration` seconds; return checks/sec. """
+
+    deadline = time.perf_counter() + duration
+    done = 0
+
+    def check_until_deadline():
+        count = 0
+        while time.perf_counter() < deadline:
+            assert hasher.check_password_hash(pw_hash, PASSWORD)
+            count += 1
+        return count
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as threads:
+        futures = [threads.submit(check_until_deadline)
+                   for _ in range(concurrency)]
+        done = sum(future.result() for future in futures)
+
+    return done / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, nargs='+',
+                        default=[10, 11, 12, 13, 14])
+    parser.add_argument('--duration', type=float, default=3.0,
+                        help='seconds to run each cost level')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='password pool processes (0: inline)')
+    args = parser.parse_args()
+
+    concurrency = max(args.workers, 1)
+    print(f"{'cost':>4}  {'ms/login':>9}  {'logins/sec':>10}")
+
+    for rounds in args.rounds:
+        hasher = PasswordHasher(
+            workers=args.workers,
+            max_pending=concurrency,
+            timeout=None,
+            rounds=rounds,
+        )
+        try:
+            pw_hash = hasher.generate_password_hash(PASSWORD)
+            rate = logins_per_second(
+                hasher, pw_hash, args.duration, concurrency)
+        finally:
+            hasher.shutdown()
+
+        print(f"{rounds:>4}  {concurrency * 1000 / rate:>9.1f}  {rate:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
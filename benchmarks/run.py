@@ -0,0 +1,437 @@
+"""Benchmark Warbler's hot endpoints.
+
+Run from the repo root against a scratch database, for example:
+
+    createdb warbler-bench
+    python -m benchmarks.run --users 2000 --messages 20000 \\
+        --follows 40000 --save benchmarks/baseline.json
+
+and later, on the same dataset, check a change for regressions:
+
+    python -m benchmarks.run --skip-seed \\
+        --compare benchmarks/baseline.json
+
+Each scenario is run through Flask's test client in this process (which
+also counts SQL queries per request), or with --gunicorn against a local
+gunicorn server. Results are latency percentiles, queries per request and
+resident memory; --compare exits non-zero when p95 latency grows by more
+than --tolerance or a page runs more queries than the baseline did.
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urlsplit
+from urllib.request import (
+    HTTPCookieProcessor, HTTPRedirectHandler, Request, build_opener)
+
+BENCH_USERNAME = "benchmark"
+BENCH_PASSWORD = "benchmark-password"
+BENCH_FOLLOWING = 100
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, p):
+    """ The p-th percentile of `sorted_values`, interpolating linearly. """
+
+    if not sorted_values:
+        return None
+
+    position = (len(sorted_values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    fraction = position - lower
+    return (sorted_values[lower] * (1 - fraction) +
+            sorted_values[upper] * fraction)
+
+
+def summarize(seconds, queries, rss_bytes):
+    """ Result dict for one scenario from per-request timings. """
+
+    seconds = sorted(seconds)
+    result = {
+        f"p{p}_ms": round(percentile(seconds, p) * 1000, 3)
+        for p in PERCENTILES
+    }
+    result['mean_ms'] = round(sum(seconds) / len(seconds) * 1000, 3)
+    result['requests'] = len(seconds)
+    result['queries_per_request'] = (
+        round(sum(queries) / len(queries), 2) if queries else None)
+    result['rss_mb'] = round(rss_bytes / 2 ** 20, 1)
+    return result
+
+
+def compare(baseline, current, tolerance):
+    """ Print current vs baseline results; return regressed scenarios. """
+
+    regressions = []
+    if baseline['meta']['target'] != current['meta']['target']:
+        print(f"Note: baseline ran on {baseline['meta']['target']}, "
+              f"this run on {current['meta']['target']}")
+
+    print(f"{'scenario':<20} {'p95 base':>9} {'p95 now':>9} {'change':>8} "
+          f"{'queries':>11}")
+
+    for name, result in current['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if base is None:
+            print(f"{name:<20} {'(new)':>9} {result['p95_ms']:>9.1f}")
+            continue
+
+        change = result['p95_ms'] / base['p95_ms'] - 1 if base['p95_ms'] else 0
+        queries = (f"{base['queries_per_request']}->"
+                   f"{result['queries_per_request']}")
+        regressed = change > tolerance or (
+            result['queries_per_request'] is not None and
+            base['queries_per_request'] is not None and
+            result['queries_per_request'] > base['queries_per_request'])
+
+        print(f"{name:<20} {base['p95_ms']:>9.1f} {result['p95_ms']:>9.1f} "
+              f"{change:>+8.0%} {queries:>11}"
+              f"{'  REGRESSION' if regressed else ''}")
+
+        if regressed:
+            regressions.append(name)
+
+    return regressions
+
+
+##############################################################################
+# Drivers: issue requests and report (status, SQL queries or None,
+# redirect location or None)
+
+
+class TestClientDriver:
+    """ Requests through Flask's test client, counting SQL per request. """
+
+    def __init__(self, app, db):
+        from sqlalchemy import event
+
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.client = app.test_client()
+        self.queries = 0
+
+        def count_query(*args):
+            self.queries += 1
+
+        event.listen(db.engine, "before_cursor_execute", count_query)
+
+    def request(self, method, path, data=None):
+        self.queries = 0
+        resp = self.client.open(path, method=method, data=data)
+        return resp.status_code, self.queries, resp.headers.get('Location')
+
+    def rss_bytes(self):
+        # Peak RSS of this process; ru_maxrss is in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def close(self):
+        pass
+
+
+class NoRedirects(HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class GunicornDriver:
+    """ Requests over HTTP to a gunicorn server started for the run. """
+
+    def __init__(self, database_url, workers):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+
+        self.base_url = f"http://127.0.0.1:{port}"
+        self.server = subprocess.Popen(
+            ['gunicorn',
+             '--bind', f"127.0.0.1:{port}",
+             '--workers', str(workers),
+             'app:app'],
+            env=dict(os.environ, DATABASE_URL=database_url),
+        )
+        self.opener = build_opener(
+            HTTPCookieProcessor(CookieJar()), NoRedirects)
+        self.csrf_token = None
+
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                self.request('GET', '/login')
+                break
+            except OSError:
+                if (self.server.poll() is not None or
+                        time.monotonic() > deadline):
+                    self.close()
+                    raise
+                time.sleep(0.2)
+
+    def request(self, method, path, data=None):
+        body = None
+        if method == 'POST':
+            data = dict(data or {}, csrf_token=self.csrf_token)
+            body = urlencode(data).encode()
+
+        try:
+            with self.opener.open(Request(
+                    self.base_url + path, data=body, method=method)) as resp:
+                status, html = resp.status, resp.read().decode()
+                location = None
+        except HTTPError as error:  # includes the unfollowed redirects
+            status, html = error.code, ''
+            location = error.headers.get('Location')
+
+        # Forms share one CSRF token per session; keep the latest
+        match = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"',
+                          html)
+        if match:
+            self.csrf_token = match.group(1)
+
+        return status, None, location
+
+    def rss_bytes(self):
+        """ Current RSS of the gunicorn master plus its workers. """
+
+        total = 0
+        pids = [self.server.pid]
+        while pids:
+            pid = pids.pop()
+            try:
+                with open(f"/proc/{pid}/status") as status:
+                    for line in status:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1]) * 1024
+                with open(f"/proc/{pid}/task/{pid}/children") as children:
+                    pids.extend(int(child)
+                                for child in children.read().split())
+            except OSError:  # not Linux, or the process exited
+                pass
+        return total
+
+    def close(self):
+        self.server.terminate()
+        self.server.wait()
+
+
+##############################################################################
+# Dataset and fixtures
+
+
+def seed_dataset(args):
+    """ Generate CSVs of the requested size and load them with seed.py. """
+
+    env = dict(os.environ, DATABASE_URL=args.database_url)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        subprocess.run(
+            [sys.executable, 'generator/create_csvs.py',
+             '--users', str(args.users),
+             '--messages', str(args.messages),
+             '--follows', str(args.follows),
+             '--seed', args.seed,
+             '--out-dir', data_dir],
+            check=True,
+        )
+        subprocess.run(
+            [sys.executable, 'seed.py', '--data-dir', data_dir],
+            env=env,
+            check=True,
+        )
+
+
+def prepare_fixtures(driver):
+    """ Set up the benchmark user, log `driver` in as them and return the
+    scenarios to run.
+
+    The benchmark user follows the most-followed users, so their home
+    timeline is full, and profiles/search/likes target busy rows. The
+    login happens here, not only in the 'login' scenario, so the others
+    run logged in however --scenarios filters them.
+    """
+
+    from models import db, User, Message, Follows, TimelineEntry
+
+    user = User.query.filter_by(username=BENCH_USERNAME).first()
+    if user is None:
+        user = User.signup(BENCH_USERNAME, f"{BENCH_USERNAME}@example.com",
+                           BENCH_PASSWORD, None)
+        db.session.flush()
+
+        popular_ids = [
+            user_id for (user_id,) in
+            db.session
+            .query(Follows.user_being_followed_id)
+            .group_by(Follows.user_being_followed_id)
+            .order_by(db.func.count().desc())
+            .limit(BENCH_FOLLOWING)
+        ]
+        for followed_id in popular_ids:
+            db.session.add(Follows(user_being_followed_id=followed_id,
+                                   user_following_id=user.id))
+            User.adjust_counters(followed_id, followers_count=1)
+
+        db.session.flush()
+        TimelineEntry.backfill([user.id])
+        User.reconcile_counters(user.id, user.id)
+        db.session.commit()
+
+    login = {'username': BENCH_USERNAME, 'password': BENCH_PASSWORD}
+    driver.request('POST', '/login', login)
+    status, _, _ = driver.request('GET', '/messages/new')
+    if status != 200:  # logged-out users are sent home
+        raise RuntimeError(f"Could not log in as {BENCH_USERNAME}")
+
+    top_poster = User.query.order_by(User.messages_count.desc()).first()
+    liked = (TimelineEntry
+             .messages_query(user.id)
+             .filter(Message.user_id != user.id)
+             .order_by(TimelineEntry.timestamp.desc())
+             .first())
+
+    return [
+        ('login', 'POST', '/login', login),
+        ('homepage', 'GET', '/', None),
+        ('users_show', 'GET', f"/users/{top_poster.id}", None),
+        ('users_list', 'GET',
+         f"/users?{urlencode({'q': top_poster.username[:4]})}", None),
+        ('messages_add_like', 'POST', f"/messages/{liked.id}/like", None),
+    ]
+
+
+def logged_out(location):
+    """ Is a redirect to `location` where pages send logged-out users? """
+
+    return location is not None and urlsplit(location).path in ('/', '/login')
+
+
+def run_scenario(driver, name, method, path, data, requests, warmup):
+    """ Time `requests` requests after `warmup` untimed ones.
+
+    Errors fail the run, and so do redirects that mean the request wasn't
+    logged in (after logging in, that's where 'login' itself goes).
+    """
+
+    for _ in range(warmup):
+        driver.request(method, path, data)
+
+    seconds = []
+    queries = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        status, count, location = driver.request(method, path, data)
+        seconds.append(time.perf_counter() - start)
+
+        if status >= 400:
+            raise RuntimeError(f"{method} {path} answered {status}")
+        if name != 'login' and logged_out(location):
+            raise RuntimeError(
+                f"{method} {path} redirected to {location}: not logged in")
+        if count is not None:
+            queries.append(count)
+
+    return summarize(seconds, queries, driver.rss_bytes())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url',
+                        default='postgresql:///warbler-bench')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=40000)
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--skip-seed', action='store_true',
+                        help='reuse the data already in the database')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='timed requests per scenario')
+    parser.add_argument('--login-requests', type=int, default=20,
+                        help='timed logins (each is a bcrypt check)')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--scenarios', nargs='+',
+                        help='only run these scenarios')
+    parser.add_argument('--gunicorn', type=int, metavar='WORKERS',
+                        help='benchmark a local gunicorn with WORKERS')
+    parser.add_argument('--save', metavar='PATH',
+                        help='write results to PATH as JSON')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='compare with a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed p95 slowdown vs the baseline')
+    args = parser.parse_args()
+
+    if not args.skip_seed:
+        seed_dataset(args)
+
+    # The app reads DATABASE_URL at import
+    os.environ['DATABASE_URL'] = args.database_url
+    from app import app
+    from models import db, User
+
+    if args.gunicorn:
+        driver = GunicornDriver(args.database_url, args.gunicorn)
+    else:
+        driver = TestClientDriver(app, db)
+
+    try:
+        with app.app_context():
+            scenarios = prepare_fixtures(driver)
+            num_users = User.query.count()
+    except Exception:
+        driver.close()
+        raise
+
+    results = {
+        'meta': {
+            'date': datetime.utcnow().isoformat(),
+            'target': f"gunicorn x{args.gunicorn}" if args.gunicorn
+                      else 'test client',
+            'users': num_users,
+            'python': platform.python_version(),
+        },
+        'scenarios': {},
+    }
+
+    try:
+        for name, method, path, data in scenarios:
+            if args.scenarios and name not in args.scenarios:
+                continue
+
+            requests = (args.login_requests if name == 'login'
+                        else args.requests)
+            result = run_scenario(
+                driver, name, method, path, data, requests, args.warmup)
+            results['scenarios'][name] = result
+
+            print(f"{name:<20} p50 {result['p50_ms']:>8.1f}ms  "
+                  f"p95 {result['p95_ms']:>8.1f}ms  "
+                  f"p99 {result['p99_ms']:>8.1f}ms  "
+                  f"queries {result['queries_per_request']}  "
+                  f"rss {result['rss_mb']}MB")
+    finally:
+        driver.close()
+
+    if args.save:
+        with open(args.save, 'w') as out:
+            json.dump(results, out, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(baseline, results, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""Bulk CSV loading for seeding and staging snapshots.
+
+On PostgreSQL each CSV is streamed into its table with `COPY ... FROM
+STDIN`, with secondary indexes and foreign keys on the loaded tables
+dropped for the load and rebuilt afterwards (one sorted build and one
+validation pass, instead of per-row upkeep). Elsewhere (e.g. SQLite in
+tests) rows are inserted with chunked `executemany`.
+
+Either way, id sequences are moved past the loaded ids afterwards, so
+CSVs can carry explicit ids.
+"""
+
+import csv
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import Boolean, DateTime, Integer, func, select, text
+
+DEFAULT_CHUNK_SIZE = 10000
+
+
+class LoadResult:
+    """ How many rows were loaded into a table, and how fast. """
+
+    def __init__(self, table, rows, seconds):
+        self.table = table
+        self.rows = rows
+        self.seconds = seconds
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else float(self.rows)
+
+    def __str__(self):
+        return (f"{self.table}: {self.rows} rows in {self.seconds:.2f}s "
+                f"({self.rows_per_second:,.0f} rows/sec)")
+
+
+def bulk_load(connection, sources, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Load CSV files into tables; return a LoadResult per table.
+
+    `sources` is a list of (Table, csv path) pairs, in dependency order.
+    Each CSV's header row names the columns it fills. COPY only applies
+    server-side defaults to the rest, so columns with Python-side
+    defaults (like users.image_url) must be in the CSV.
+
+    Runs in `connection`'s transaction, which the caller owns.
+    """
+
+    tables = [table for (table, _) in sources]
+    results = []
+
+    with deferred_indexes(connection, tables):
+        for table, path in sources:
+            start = time.perf_counter()
+            with open(path, newline='') as csv_file:
+                if connection.dialect.name == 'postgresql':
+                    rows = copy_csv(connection, table, csv_file)
+                else:
+                    rows = insert_csv(connection, table, csv_file, chunk_size)
+            results.append(
+                LoadResult(table.name, rows, time.perf_counter() - start))
+
+    fix_sequences(connection, tables)
+    return results
+
+
+def copy_csv(connection, table, csv_file):
+    """ Stream `csv_file` into `table` with COPY; return rows loaded. """
+
+    columns = _header(csv_file)
+    preparer = connection.dialect.identifier_preparer
+    statement = (
+        f"COPY {preparer.format_table(table)} "
+        f"({', '.join(preparer.quote(column) for column in columns)}) "
+        f"FROM STDIN WITH (FORMAT csv, HEADER true)"
+    )
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(statement, csv_file)
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def insert_csv(connection, table, csv_file, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Insert `csv_file` into `table` in executemany chunks.
+
+    Values are converted from CSV text for the column types that need it;
+    empty fields in non-text columns become NULL, as with COPY.
+    """
+
+    reader = csv.DictReader(csv_file)
+    converters = {
+        name: _converter(table.c[name].type) for name in reader.fieldnames}
+
+    rows = 0
+    while True:
+        chunk = [
+            {name: converters[name](value) for (name, value) in row.items()}
+            for row in islice(reader, chunk_size)
+        ]
+        if not chunk:
+            return rows
+
+        connection.execute(table.insert(), chunk)
+        rows += len(chunk)
+
+
+@contextmanager
+def deferred_indexes(connection, tables):
+    """ Drop secondary indexes and foreign keys on `tables`; rebuild after.
+
+    PostgreSQL only (a no-op elsewhere). Primary keys and unique
+    constraints stay in place. DDL is transactional there, so if the
+    block fails the drops roll back with the rest of the load.
+    """
+
+    if connection.dialect.name != 'postgresql':
+        yield
+        return
+
+    names = [table.name for table in tables]
+    preparer = connection.dialect.identifier_preparer
+
+    foreign_keys = connection.execute(text("""
+        SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE contype = 'f'
+          AND conrelid = ANY(CAST(:tables AS regclass[]))
+    """), tables=names).fetchall()
+
+    indexes = connection.execute(text("""
+        SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid)
+        FROM pg_index
+        WHERE indrelid = ANY(CAST(:tables AS regclass[]))
+          AND NOT indisprimary
+          AND NOT EXISTS (
+              SELECT 1 FROM pg_constraint WHERE conindid = indexrelid)
+    """), tables=names).fetchall()
+
+    for table, name, _ in foreign_keys:
+        connection.execute(
+            f"ALTER TABLE {table} DROP CONSTRAINT {preparer.quote(name)}")
+    for index, _ in indexes:
+        connection.execute(f"DROP INDEX {index}")
+
+    yield
+
+    for _, definition in indexes:
+        connection.execute(definition)
+    for table, name, definition in foreign_keys:
+        connection.execute(
+            f"ALTER TABLE {table} "
+            f"ADD CONSTRAINT {preparer.quote(name)} {definition}")
+
+
+def fix_sequences(connection, tables):
+    """ Point each serial id sequence just past its table's largest id. """
+
+    if connection.dialect.name != 'postgresql':
+        return  # SQLite picks max(rowid) + 1 by itself
+
+    for table in tables:
+        columns = list(table.primary_key.columns)
+        if len(columns) != 1 or not isinstance(columns[0].type, Integer):
+            continue
+
+        # setval is strict: a NULL (no sequence) makes this a no-op
+        [column] = columns
+        connection.execute(select([func.setval(
+            func.pg_get_serial_sequence(table.name, column.name),
+            func.coalesce(func.max(column), 0) + 1,
+            False,
+        )]))
+
+
+def _header(csv_file):
+    """ Column names from the first line of `csv_file`, then rewind. """
+
+    columns = next(csv.reader(csv_file))
+    csv_file.seek(0)
+    return columns
+
+
+def _converter(column_type):
+    if isinstance(column_type, DateTime):
+        convert = datetime.fromisoformat
+    elif isinstance(column_type, Boolean):
+        convert = lambda value: value.lower() in ('t', 'true', '1')  # noqa
+    elif isinstance(column_type, Integer):
+        convert = int
+    else:
+        return lambda value: value
+
+    return lambda value: convert(value) if value != '' else None
@@ -0,0 +1,237 @@
+"""Caching helpers for Warbler.
+
+An in-process LRU with per-entry TTL, optionally backed by a shared store
+(Redis in production; `DictBackend` is a local stand-in for tests and
+single-process development).
+"""
+
+import pickle
+import time
+from collections import OrderedDict
+from threading import Lock
+
+try:
+    import redis
+except ImportError:  # only needed when CACHE_REDIS_URL points at redis://
+    redis = None
+
+
+class LRUCache:
+    """ Thread-safe least-recently-used cache with a time-to-live.
+
+    Values are stored as-is (no copying), so callers should cache data
+    they won't mutate.
+    """
+
+    def __init__(self, maxsize=1024, ttl=30, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """ Return the value for `key`, or `default` if missing/expired. """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """ Store `value` under `key` for `ttl` (default: self.ttl) secs. """
+
+        expires_at = self.clock() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """ Remove `key` if present. """
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_many(self, keys):
+        """ Values for `keys`, in order (None where missing/expired). """
+
+        return [self.get(key) for key in keys]
+
+    def set_many(self, mapping, ttl=None):
+        for key, value in mapping.items():
+            self.set(key, value, ttl)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """ Remove every entry. """
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DictBackend:
+    """ In-process stand-in for a shared byte store such as Redis. """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._data = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= self.clock():
+                del self._data[key]
+                return None
+
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = None if ttl is None else self.clock() + ttl
+
+        with self._lock:
+            self._data[key] = (expires_at, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set_many(self, mapping, ttl=None):
+        for key, value in mapping.items():
+            self.set(key, value, ttl)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisBackend:
+    """ Shared byte store on a Redis (or Redis-compatible) server. """
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError(
+                "CACHE_REDIS_URL is set but the redis package is not installed")
+
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, value, ex=ttl)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def get_many(self, keys):
+        return self.client.mget(keys) if keys else []
+
+    def set_many(self, mapping, ttl=None):
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipeline.set(key, value, ex=ttl)
+        pipeline.execute()
+
+    def delete_many(self, keys):
+        if keys:
+            self.client.delete(*keys)
+
+    def clear(self):
+        self.client.flushdb()
+
+
+def backend_from_url(url):
+    """ Build a shared backend from a URL, or None if `url` is empty.
+
+    'memory://' gives a DictBackend; redis:// and rediss:// a RedisBackend.
+    """
+
+    if not url:
+        return None
+
+    if url.startswith('memory://'):
+        return DictBackend()
+
+    return RedisBackend(url)
+
+
+class TieredCache:
+    """ A local LRU in front of an optional shared backend.
+
+    Reads check the LRU first, then the shared store (refilling the LRU).
+    Writes and deletes go to both. Other processes' LRUs only see a
+    delete once their local entry expires, so keep `local.ttl` short.
+    """
+
+    def __init__(self, local, shared=None, prefix='', shared_ttl=None):
+        self.local = local
+        self.shared = shared
+        self.prefix = prefix
+        self.shared_ttl = shared_ttl
+
+    def get(self, key, default=None):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+
+        if self.shared is not None:
+            raw = self.shared.get(self.prefix + str(key))
+            if raw is not None:
+                value = pickle.loads(raw)
+                self.local.set(key, value)
+                return value
+
+        return default
+
+    def set(self, key, value):
+        self.local.set(key, value)
+
+        if self.shared is not None:
+            self.shared.set(
+                self.prefix + str(key),
+                pickle.dumps(value),
+                ttl=self.shared_ttl,
+            )
+
+    def delete(self, key):
+        self.local.delete(key)
+
+        if self.shared is not None:
+            self.shared.delete(self.prefix + str(key))
+
+    def clear(self):
+        """ Clear the local LRU (the shared store is left alone). """
+
+        self.local.clear()
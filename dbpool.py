@@ -0,0 +1,85 @@
+"""Database connection pool settings for Warbler.
+
+Two modes, picked with DB_POOL_MODE:
+
+- 'queue' (default): each process keeps its own SQLAlchemy pool of
+  DB_POOL_SIZE connections (plus DB_MAX_OVERFLOW extra under load),
+  recycled after DB_POOL_RECYCLE seconds and pinged before use, so
+  connections the server or a firewall dropped are replaced instead of
+  failing a request.
+- 'pgbouncer': no pooling in the app (NullPool); every checkout opens a
+  connection to pgbouncer, which does the pooling in transaction mode.
+  Nothing here relies on per-connection server state across
+  transactions (psycopg2 doesn't use server-side prepared statements).
+
+Pool checkouts are timed, so waits for a free connection show up in
+/metrics when a pool is too small for its worker's threads.
+"""
+
+import time
+
+from sqlalchemy.pool import NullPool, QueuePool
+
+POOL_MODES = ('queue', 'pgbouncer')
+
+
+class TimedQueuePool(QueuePool):
+    """ A QueuePool that reports how long each checkout waited. """
+
+    # Called with the seconds spent getting each connection
+    observers = []
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            seconds = time.perf_counter() - start
+            for observer in self.observers:
+                observer(seconds)
+
+
+def engine_options(mode='queue', size=5, max_overflow=10, timeout=30,
+                   recycle=1800, pre_ping=True):
+    """ SQLALCHEMY_ENGINE_OPTIONS for a pool mode (see module docs). """
+
+    if mode not in POOL_MODES:
+        raise ValueError(
+            f"DB_POOL_MODE must be one of {', '.join(POOL_MODES)}")
+
+    if mode == 'pgbouncer':
+        return {'poolclass': NullPool}
+
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': size,
+        'max_overflow': max_overflow,
+        'pool_timeout': timeout,
+        'pool_recycle': recycle,
+        'pool_pre_ping': pre_ping,
+    }
+
+
+def warm_up(engine, connections):
+    """ Open up to `connections` pooled connections ahead of traffic.
+
+    Meant for worker start-up, so the first requests don't each pay for
+    a new connection. Never opens more than the pool keeps (overflow
+    connections would just be closed again); a no-op for NullPool.
+    """
+
+    if isinstance(engine.pool, NullPool):
+        return 0
+
+    if hasattr(engine.pool, 'size'):
+        connections = min(connections, engine.pool.size())
+
+    opened = []
+    try:
+        for _ in range(connections):
+            opened.append(engine.connect())
+    finally:
+        for connection in opened:
+            connection.close()
+
+    return len(opened)
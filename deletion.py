@@ -0,0 +1,239 @@
+"""Deleting users in the background, in batches.
+
+Deleting a large account in one transaction (with the ORM loading every
+follow and like to clear them) held locks for seconds. Instead the
+delete view only marks the user `deactivated`, so they can't log in,
+their pages are gone and timelines, lists and search leave them out, and
+queues a delete_deactivated_user job (see
+jobs.py). It removes their rows in batches, each a short transaction of
+set-based statements:
+
+    timeline_entries    their messages on others' home timelines (so
+                        these go first), and their own timeline
+    likes               their likes
+    likes_received      others' likes of their messages
+    following           who they follow
+    followers           who follows them
+    messages            their messages
+
+and then the user row. The other side's counters are adjusted in the
+same transaction as each batch, and cached users and timelines that a
+batch changed are dropped.
+
+A deletion that was cut short, say by a worker restart, starts again
+from whatever rows are left when the job is retried, or, once the job
+has failed, when `flask purge-deactivated-users` is run.
+"""
+
+import logging
+from collections import Counter, defaultdict
+
+from flask import current_app
+from sqlalchemy import tuple_
+
+from invalidation import invalidate
+from jobs import job_queue
+from models import db, Follows, Like, Message, TimelineEntry, User
+
+logger = logging.getLogger(__name__)
+
+
+##############################################################################
+# Batches
+#
+# Each takes a deactivated user's id and a batch size, deletes up to that
+# many rows (adjusting counters on the other side), and returns how many
+# it deleted, plus what to drop from caches once that's committed (as
+# keyword arguments for invalidate()). Nothing can add rows for a
+# deactivated user, so selecting a batch's keys and then deleting them by
+# key is safe. Two runners (a retried job and purge-deactivated-users,
+# say) can select the same batch, though, so counters are only adjusted
+# for the rows a runner's own DELETE removed.
+
+
+def delete_timeline_entries(user_id, batch_size):
+    rows = (db.session
+            .query(TimelineEntry.user_id, TimelineEntry.message_id)
+            .filter((TimelineEntry.author_id == user_id) |
+                    (TimelineEntry.user_id == user_id))
+            .limit(batch_size)
+            .all())
+
+    deleted = _delete_keys(
+        TimelineEntry.user_id, TimelineEntry.message_id, rows)
+    return len(rows), {'timelines': {reader_id for reader_id, _ in deleted}}
+
+
+def delete_likes(user_id, batch_size):
+    message_ids = _column(
+        Like.message_id, Like.user_id == user_id, batch_size)
+
+    deleted = _delete_keys(
+        Like.user_id, Like.message_id,
+        [(user_id, message_id) for message_id in message_ids])
+    _decrement(Message, 'likes_count',
+               Counter(message_id for _, message_id in deleted))
+    return len(message_ids), {}
+
+
+def delete_likes_received(user_id, batch_size):
+    rows = (db.session
+            .query(Like.user_id, Like.message_id)
+            .join(Message, Message.id == Like.message_id)
+            .filter(Message.user_id == user_id)
+            .limit(batch_size)
+            .all())
+
+    deleted = _delete_keys(Like.user_id, Like.message_id, rows)
+    likers = Counter(liker_id for liker_id, _ in deleted)
+    _decrement(User, 'likes_count', likers)
+    return len(rows), {'users': likers}
+
+
+def delete_following(user_id, batch_size):
+    followed_ids = _column(
+        Follows.user_being_followed_id,
+        Follows.user_following_id == user_id,
+        batch_size)
+
+    deleted = _delete_keys(
+        Follows.user_following_id, Follows.user_being_followed_id,
+        [(user_id, followed_id) for followed_id in followed_ids])
+    followed = Counter(followed_id for _, followed_id in deleted)
+    _decrement(User, 'followers_count', followed)
+    return len(followed_ids), {'users': followed}
+
+
+def delete_followers(user_id, batch_size):
+    follower_ids = _column(
+        Follows.user_following_id,
+        Follows.user_being_followed_id == user_id,
+        batch_size)
+
+    deleted = _delete_keys(
+        Follows.user_following_id, Follows.user_being_followed_id,
+        [(follower_id, user_id) for follower_id in follower_ids])
+    followers = Counter(follower_id for follower_id, _ in deleted)
+    _decrement(User, 'following_count', followers)
+    return len(follower_ids), {'users': followers}
+
+
+def delete_messages(user_id, batch_size):
+    message_ids = _column(Message.id, Message.user_id == user_id, batch_size)
+
+    (Message.query
+     .filter(Message.id.in_(message_ids))
+     .delete(synchronize_session=False))
+    return len(message_ids), {'messages': message_ids}
+
+
+STEPS = [
+    ('timeline_entries', delete_timeline_entries),
+    ('likes', delete_likes),
+    ('likes_received', delete_likes_received),
+    ('following', delete_following),
+    ('followers', delete_followers),
+    ('messages', delete_messages),
+]
+
+
+def delete_user(user_id, batch_size=1000, progress=None):
+    """ Delete deactivated user `user_id` and all their rows, committing
+    every `batch_size` rows. Returns {step: rows deleted}.
+
+    `progress(step, deleted)` is called after each batch with the step's
+    running total.
+    """
+
+    user = User.query.get(user_id)
+    if user is None:
+        return {}
+    if not user.deactivated:
+        raise ValueError(f"User {user_id} is not deactivated")
+
+    totals = {}
+
+    for step, delete_batch in STEPS:
+        totals[step] = 0
+
+        while True:
+            deleted, changed = delete_batch(user_id, batch_size)
+            db.session.commit()
+            invalidate(**changed)
+            if not deleted:
+                break
+
+            totals[step] += deleted
+            if progress is not None:
+                progress(step, totals[step])
+
+    User.query.filter_by(id=user_id).delete(synchronize_session=False)
+    db.session.commit()
+    invalidate(users=[user_id])
+
+    return totals
+
+
+def _column(column, criterion, batch_size):
+    return [value for (value,) in
+            db.session.query(column).filter(criterion).limit(batch_size)]
+
+
+def _delete_keys(first, second, keys):
+    """ Delete the rows of `first`'s table whose (first, second) is in
+    `keys`, and return the keys of those this deleted: not those another
+    transaction deleted first.
+    """
+
+    if not keys:
+        return []
+
+    table = first.class_.__table__
+
+    if db.engine.dialect.name == 'postgresql':
+        return db.session.execute(
+            table.delete()
+            .where(tuple_(first, second).in_(keys))
+            .returning(first, second)
+        ).fetchall()
+
+    # No DELETE ... RETURNING here; go by each row's rowcount
+    return [
+        (a, b) for (a, b) in keys
+        if db.session.execute(
+            table.delete().where(first == a).where(second == b)
+        ).rowcount
+    ]
+
+
+def _decrement(model, counter, counts):
+    """ Take counts[id] off `counter` of each row of `model`: one UPDATE
+    per distinct amount.
+    """
+
+    by_amount = defaultdict(list)
+    for ident, amount in counts.items():
+        by_amount[amount].append(ident)
+
+    column = getattr(model, counter)
+    for amount, idents in by_amount.items():
+        (model.query
+         .filter(model.id.in_(idents))
+         .update({column: column - amount}, synchronize_session=False))
+
+
+##############################################################################
+# Running in the background
+
+
+@job_queue.task
+def delete_deactivated_user(user_id):
+    """ Job: delete_user(), in batches of USER_DELETE_BATCH_SIZE. """
+
+    def progress(step, deleted):
+        logger.info("Deleting user %s: %d %s", user_id, deleted, step)
+        job_queue.heartbeat()
+
+    totals = delete_user(
+        user_id, current_app.config['USER_DELETE_BATCH_SIZE'], progress)
+    logger.info("Deleted user %s: %s", user_id, totals)
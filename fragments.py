@@ -0,0 +1,49 @@
+"""Render cache for template fragments.
+
+A fragment is a template rendered from a few entities (a profile header
+from a user, a message card from a message and its author) with nothing
+viewer-specific in it: no g.user, CSRF tokens or flashed messages. Its
+cache key is the template name plus a version of what it shows, normally
+the entities' `cache_version` (their column values). An edit, like or
+follow changes those columns, if only a counter, so the next render
+misses and the outdated entry ages out of the LRU. Nothing has to be
+deleted, and every process, and the shared store, agrees on the keys.
+"""
+
+import hashlib
+
+from flask import render_template
+from markupsafe import Markup
+
+
+class FragmentCache:
+    """ Rendered fragments in a cache (an LRUCache or TieredCache). """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def init_app(self, app):
+        """ Make `cached_fragment(template, version, **context)` available
+        to templates.
+        """
+
+        app.jinja_env.globals['cached_fragment'] = self.render
+
+    def render(self, template, version, **context):
+        """ `template` rendered with `context`, from the cache if a render
+        with the same `version` is there.
+        """
+
+        key = self.key(template, version)
+        html = self.cache.get(key)
+
+        if html is None:
+            html = render_template(template, **context)
+            self.cache.set(key, html)
+
+        return Markup(html)
+
+    @staticmethod
+    def key(template, version):
+        digest = hashlib.sha1(repr(version).encode()).hexdigest()
+        return f"{template}:{digest}"
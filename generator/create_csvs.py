@@ -2,76 +2,210 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
-"""
+tweak the CSV formats or generate fewer/more rows, e.g. a load-testing
+dataset:
 
-import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+    python generator/create_csvs.py --users 1000000 --messages 50000000 \\
+        --follows 100000000 --out-dir /tmp/warbler-big
+    python seed.py --data-dir /tmp/warbler-big
 
-MAX_WARBLER_LENGTH = 140
+Rows are written in fixed-size shards by a pool of worker processes and
+streamed to disk, so memory use doesn't grow with the row counts. Each
+shard draws from its own RNG seeded from `--seed`, so the same arguments
+give the same files whatever `--workers` is. Rows carry explicit ids.
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
+Who posts and who gets followed both follow a power law: a few users
+write most messages and have most followers, as on real networks.
+"""
+
+import argparse
+import csv
+import os
+import shutil
+import tempfile
+from datetime import date, datetime, timedelta
+from multiprocessing import Pool
+from random import Random
+
+from helpers import (
+    EMAIL_DOMAINS, FIRST_NAMES, HEADER_IMAGE_URLS, IMAGE_URLS, LAST_NAMES,
+    PASSWORD_HASH, PLACE_SUFFIXES, Shuffle, paragraph, power_law_rank,
+    random_datetime, sentence,
+)
+
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password',
+                     'bio', 'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
-
-fake = Faker()
-
-# Generate random profile image URLs to use for users
-
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
+NUM_FOLLOWS = 5000
+
+ROWS_PER_SHARD = 100000
+YEARS_OF_MESSAGES = 2
+
+
+def user_rows(rng, first_id, last_id, settings):
+    for user_id in range(first_id, last_id + 1):
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = rng.choice(LAST_NAMES)
+        username = f"{first_name}{last_name}{user_id}"
+
+        yield [
+            user_id,
+            f"{username}@{rng.choice(EMAIL_DOMAINS)}",
+            username,
+            rng.choice(IMAGE_URLS),
+            PASSWORD_HASH,
+            sentence(rng),
+            rng.choice(HEADER_IMAGE_URLS),
+            f"{rng.choice(LAST_NAMES).title()}{rng.choice(PLACE_SUFFIXES)}",
+        ]
+
+
+def message_rows(rng, first_id, last_id, settings):
+    for message_id in range(first_id, last_id + 1):
+        rank = power_law_rank(rng, settings['users'], settings['exponent'])
+
+        yield [
+            message_id,
+            paragraph(rng),
+            random_datetime(rng, settings['start'], settings['end']),
+            settings['posters'](rank),
+        ]
+
+
+def follow_rows(rng, first_id, last_id, settings):
+    """ Follows for followers `first_id`..`last_id`.
+
+    Each user follows floor or ceil of follows / users others (so totals
+    are exact); whom they follow is drawn by popularity.
+    """
+
+    num_users = settings['users']
+    num_follows = settings['follows']
+    exponent = settings['exponent']
+    popular = settings['popular']
+
+    for follower_id in range(first_id, last_id + 1):
+        count = (num_follows * follower_id // num_users -
+                 num_follows * (follower_id - 1) // num_users)
+
+        if count > (num_users - 1) // 2:
+            # Following most users: rejection sampling would crawl
+            followed = (
+                other_id if other_id < follower_id else other_id + 1
+                for other_id in rng.sample(range(1, num_users), count)
+            )
+        else:
+            followed = set()
+            while len(followed) < count:
+                user_id = popular(power_law_rank(rng, num_users, exponent))
+                if user_id != follower_id:
+                    followed.add(user_id)
+
+        for followed_id in followed:
+            yield [followed_id, follower_id]
+
+
+TABLES = [
+    ('users', USERS_CSV_HEADERS, user_rows),
+    ('messages', MESSAGES_CSV_HEADERS, message_rows),
+    ('follows', FOLLOWS_CSV_HEADERS, follow_rows),
 ]
 
-# Generate random header image URLs to use for users
-
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+def write_shard(task):
+    """ Write one shard of a table to a part file; return its path. """
+
+    name, rows, shard, first_id, last_id, settings = task
+
+    rng = Random(f"{settings['seed']}:{name}:{shard}")
+    path = os.path.join(settings['parts_dir'], f"{name}.{shard}.csv")
+
+    with open(path, 'w', newline='') as part:
+        csv.writer(part).writerows(rows(rng, first_id, last_id, settings))
+
+    return path
+
+
+def shards(count, per_shard):
+    """ (shard, first id, last id) ranges covering ids 1..count. """
+
+    for shard, first_id in enumerate(range(1, count + 1, per_shard)):
+        yield shard, first_id, min(first_id + per_shard - 1, count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS)
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--exponent', type=float, default=1.0,
+                        help='power-law exponent for posting and followers')
+    parser.add_argument('--until', type=date.fromisoformat,
+                        default=date.today(),
+                        help='date of the newest messages (YYYY-MM-DD)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out-dir', default='generator')
+    args = parser.parse_args()
+
+    if args.follows > args.users * (args.users - 1):
+        parser.error(f"{args.users} users can have at most "
+                     f"{args.users * (args.users - 1)} follows")
+
+    rng = Random(args.seed)
+    end = datetime.combine(args.until, datetime.min.time())
+    settings = {
+        'seed': args.seed,
+        'users': args.users,
+        'follows': args.follows,
+        'exponent': args.exponent,
+        'posters': Shuffle(rng, args.users),
+        'popular': Shuffle(rng, args.users),
+        'start': end - timedelta(days=365 * YEARS_OF_MESSAGES),
+        'end': end,
+        'parts_dir': tempfile.mkdtemp(dir=args.out_dir),
+    }
+
+    # Shard followers so each shard has about ROWS_PER_SHARD follows
+    per_shard = {
+        'users': ROWS_PER_SHARD,
+        'messages': ROWS_PER_SHARD,
+        'follows': max(1, ROWS_PER_SHARD * args.users // max(args.follows, 1)),
+    }
+    counts = {
+        'users': args.users,
+        'messages': args.messages,
+        'follows': args.users,  # sharded by follower id
+    }
+
+    try:
+        with Pool(args.workers) as pool:
+            for name, headers, rows in TABLES:
+                tasks = [
+                    (name, rows, shard, first_id, last_id, settings)
+                    for shard, first_id, last_id
+                    in shards(counts[name], per_shard[name])
+                ]
+
+                path = os.path.join(args.out_dir, f"{name}.csv")
+                with open(path, 'w', newline='') as out:
+                    csv.writer(out).writerow(headers)
+
+                    # imap yields parts in order as they finish, so each
+                    # is appended and deleted without waiting for the rest
+                    for part_path in pool.imap(write_shard, tasks):
+                        with open(part_path, newline='') as part:
+                            shutil.copyfileobj(part, out)
+                        os.remove(part_path)
+
+                print(f"Wrote {path}")
+    finally:
+        shutil.rmtree(settings['parts_dir'])
+
+
+if __name__ == '__main__':
+    main()
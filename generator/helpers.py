@@ -1,14 +1,241 @@
-"""Support functions for CSV generation."""
+"""Support functions for CSV generation.
 
-from datetime import datetime
-from random import uniform
+Everything here draws from a `random.Random` passed in, so generated data
+is reproducible from a seed, and uses only the word lists below, so no
+network access or third-party packages are needed.
+"""
 
+from math import gcd
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+MAX_WARBLER_LENGTH = 140
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-    return datetime.fromtimestamp(random_timestamp)
+IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
+
+# Header images fetched once from the splashbase API
+SPLASHBASE_URL = "https://splashbase.s3.amazonaws.com/unsplash/regular"
+
+HEADER_IMAGE_URLS = [
+    f"{SPLASHBASE_URL}/tumblr_{key}_1280.jpg"
+    for key in (
+        "mnh0n9pHJW1st5lhmo1",
+        "mnh0uemhCk1st5lhmo1",
+        "mnh121HEWa1st5lhmo1",
+        "mnh17lfd9R1st5lhmo1",
+        "mnh1d7s3UD1st5lhmo1",
+        "mnh1jdFvHR1st5lhmo1",
+        "mnh1uhYnog1st5lhmo1",
+        "mnh25vNOvI1st5lhmo1",
+        "mnh29fxz111st5lhmo1",
+        "mnh2m1hnS81st5lhmo1",
+        "mo1h6tGOZf1st5lhmo1",
+        "mo2wz2LTCs1st5lhmo1",
+        "mo2x3aAnRH1st5lhmo1",
+        "mo2x80NkDu1st5lhmo1",
+        "mo2x9xqeef1st5lhmo1",
+        "mo2xbk8JUK1st5lhmo1",
+        "mo2xdqmle51st5lhmo1",
+        "mo2xfarCvW1st5lhmo1",
+        "mo2xgqdEFn1st5lhmo1",
+        "mo2xijE2nr1st5lhmo1",
+        "mopq4kHmAg1st5lhmo1",
+        "mopq69jlcS1st5lhmo1",
+        "mopq8fyQwI1st5lhmo1",
+        "mopqamedKu1st5lhmo1",
+        "mopqc3ZZcz1st5lhmo1",
+        "mopqdfx05t1st5lhmo1",
+        "mopqfpSTPN1st5lhmo1",
+        "mopqhxFulr1st5lhmo1",
+        "mopqj9QUeq1st5lhmo1",
+        "mopqkkwK2M1st5lhmo1",
+        "mp6rzyNlAN1st5lhmo1",
+        "mp6s1hAudo1st5lhmo1",
+        "mp6s32zb6l1st5lhmo1",
+        "mp6s4dzqHA1st5lhmo1",
+        "mp6s661UgK1st5lhmo1",
+        "mp6s7lR1lS1st5lhmo1",
+        "mp6s995bvI1st5lhmo1",
+        "mp6sasSvPZ1st5lhmo1",
+        "mp6scv2xrZ1st5lhmo1",
+        "mpp6f50W261st5lhmo1",
+        "mpp6gwrYvm1st5lhmo1",
+        "mpp6l06zXi1st5lhmo1",
+        "mpp6poZxE51st5lhmo1",
+        "mpp6tjdFhf1st5lhmo1",
+        "mpp6w0dxAm1st5lhmo1",
+    )
+]
+
+FIRST_NAMES = """
+    aaron adam alex alice amanda amy andrea angela anna anthony ashley
+    barbara ben betty brandon brian carol chris cynthia daniel david
+    deborah dennis diane donna dorothy edward emily emma eric frank gary
+    george grace helen henry jacob james jason jennifer jessica john
+    joseph joshua julie karen kathy kevin kim laura linda lisa mark mary
+    matthew melissa michael michelle nancy nicole olivia patrick paul
+    rachel rebecca richard robert ronald ruth ryan sam sandra sarah scott
+    sharon stephen steven susan thomas timothy tyler victoria william
+""".split()
+
+LAST_NAMES = """
+    adams allen anderson baker bell brooks brown campbell carter clark
+    collins cook cooper davis diaz edwards evans fisher flores garcia
+    gomez gonzalez gray green hall harris hill howard hughes jackson james
+    johnson jones kelly king lee lewis lopez martin martinez miller
+    mitchell moore morgan morris murphy nelson parker perez peterson
+    phillips price reed reyes richardson rivera roberts robinson rogers
+    ross sanchez scott smith stewart taylor thomas thompson torres turner
+    walker ward watson white williams wilson wood wright young
+""".split()
+
+PLACE_SUFFIXES = ["burgh", "ville", "ton", "port", "field", " City",
+                  "mouth", "side", "borough", " Falls"]
+
+EMAIL_DOMAINS = ["gmail.com", "yahoo.com", "hotmail.com", "example.com",
+                 "example.org", "mail.net"]
+
+WORDS = """
+    able about across act action add after again against agent agree air
+    all almost along already also always among analysis and animal answer
+    any anyone area arm around art article ask attack away baby back bad
+    bag ball bank bar base beat beautiful because become bed before begin
+    behind believe best better between beyond big bill bit black blood
+    blue board body book born both box boy break bring brother budget
+    build building business buy call camera campaign can car card care
+    career carry case cat catch cause cell center central century certain
+    chair challenge chance change character charge check child choice
+    church citizen city civil claim class clear close coach coffee cold
+    collection college color come common community company computer
+    concern condition consider contain continue control cost could
+    country couple course court cover create crime cultural culture cup
+    current customer cut dark data daughter day dead deal debate decade
+    decide decision deep defense degree democrat describe design despite
+    detail determine develop difference different difficult dinner
+    direction director discover discuss disease doctor dog door down draw
+    dream drive drop drug during each early east easy eat economic
+    economy edge education effect effort eight either election else
+    employee end energy enjoy enough enter entire environment especially
+    establish even evening event ever every evidence exactly example
+    executive exist expect experience expert explain eye face fact factor
+    fail fall family far fast father fear federal feel feeling few field
+    fight figure fill film final finally financial find fine finger finish
+    fire firm first fish five floor fly focus follow food foot force
+    foreign forget form former forward four free friend front full fund
+    future game garden gas general generation get girl give glass goal
+    good government great green ground group grow growth guess gun guy
+    hair half hand hang happen happy hard have head health hear heart heat
+    heavy help here herself high himself history hit hold home hope
+    hospital hot hotel hour house however huge human hundred husband idea
+    identify image imagine impact important improve include including
+    increase indeed indicate individual industry information inside
+    instead institution interest interview into investment issue item
+    itself job join just keep key kid kill kind kitchen know knowledge land
+    language large last late later laugh law lawyer lay lead leader learn
+    least leave left leg legal less letter level lie life light like line
+    list listen little live local long look lose loss lot love low machine
+    magazine main maintain major majority make manage management manager
+    many market marriage material matter maybe mean measure media medical
+    meet meeting member memory mention message method middle might
+    military million mind minute miss mission model modern moment money
+    month more morning most mother mouth move movement movie much music
+    must myself name nation national natural nature near nearly necessary
+    need network never news newspaper next nice night none nor north note
+    nothing notice number occur off offer office officer official often
+    oil old once one only onto open operation opportunity option order
+    organization other others outside over own owner page pain painting
+    paper parent part participant particular partner party pass past
+    patient pattern pay peace people per perform performance perhaps
+    period person personal phone physical pick picture piece place plan
+    plant play player point police policy political politics poor popular
+    population position positive possible power practice prepare present
+    president pressure pretty prevent price private probably problem
+    process produce product production professional professor program
+    project property protect prove provide public pull purpose push put
+    quality question quickly quite race radio raise range rate rather
+    reach read ready real reality realize really reason receive recent
+    recently recognize record red reduce reflect region relate
+    relationship religious remain remember remove report represent
+    require research resource respond response rest result return reveal
+    rich right rise risk road rock role room rule run safe same save
+    scene school science scientist score sea season seat second section
+    security see seek seem sell send senior sense series serious serve
+    service set seven several shake share shoulder show side sign
+    significant similar simple simply since sing single sister sit site
+    situation six size skill skin small smile social society soldier some
+    somebody someone something sometimes son song soon sort sound source
+    south southern space speak special specific speech spend sport spring
+    staff stage stand standard star start state statement station stay
+    step still stock stop store story strategy street strong structure
+    student study stuff style subject success successful such suddenly
+    suffer suggest summer support sure surface system table take talk task
+    tax teach teacher team technology television tell ten tend term test
+    than thank theory thing think third those though thought thousand
+    threat three through throughout throw thus time today together
+    tonight too top total tough toward town trade traditional training
+    travel treat treatment tree trial trip trouble true truth try turn two
+    type under understand unit until upon use usually value various very
+    victim view violence visit voice vote wait walk wall want war watch
+    water way weapon wear week weight well west western whatever whether
+    while white whole whom whose why wide wife win wind window wish within
+    without woman wonder word work worker world worry would write writer
+    wrong yard yeah year yes yet young yourself
+""".split()
+
+
+def sentence(rng, min_words=4, max_words=12):
+    """A capitalized sentence of random words."""
+
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    return " ".join(words).capitalize() + "."
+
+
+def paragraph(rng, max_length=MAX_WARBLER_LENGTH):
+    """One to four sentences, cut to `max_length` characters."""
+
+    text = " ".join(sentence(rng) for _ in range(rng.randint(1, 4)))
+    return text[:max_length]
+
+
+def random_datetime(rng, start, end):
+    """A random datetime between `start` and `end`."""
+
+    return start + (end - start) * rng.random()
+
+
+def power_law_rank(rng, n, exponent=1.0):
+    """A rank in 1..n, where rank r is drawn with probability ~ r**-exponent.
+
+    Uses the inverse CDF of a continuous power law, so each draw is O(1)
+    with no tables, whatever `n` is.
+    """
+
+    u = rng.random()
+    if exponent == 1:
+        rank = n ** u
+    else:
+        a = 1 - exponent
+        rank = ((n ** a - 1) * u + 1) ** (1 / a)
+    return min(int(rank), n)
+
+
+class Shuffle:
+    """A cheap, seeded bijection of 1..n, to map ranks to ids.
+
+    Ranks are spread over ids with a multiplier coprime to `n`, so the
+    most popular users aren't simply the lowest ids.
+    """
+
+    def __init__(self, rng, n):
+        self.n = n
+        self.offset = rng.randrange(n)
+        self.step = rng.randrange(1, n) if n > 1 else 1
+        while gcd(self.step, n) != 1:
+            self.step += 1
+
+    def __call__(self, rank):
+        return ((rank - 1) * self.step + self.offset) % self.n + 1
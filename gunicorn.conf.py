@@ -0,0 +1,30 @@
+"""gunicorn settings for Warbler (picked up automatically from the cwd)."""
+
+import os
+import shutil
+
+# Threaded workers: a login waits on the bcrypt pool (passwords.py), and
+# with sync workers that wait would be the worker's only request, so
+# pages queued behind it and BCRYPT_POOL_MAX_PENDING could never be hit.
+# app.py reads GUNICORN_THREADS too, to size that limit.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+
+def on_starting(server):
+    """Start /metrics from zero: drop files left by earlier servers."""
+
+    directory = os.environ.get('METRICS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+
+def post_worker_init(worker):
+    """Open the worker's DB pool connections before it takes requests."""
+
+    from app import app, db
+    from dbpool import warm_up
+
+    opened = warm_up(db.engine, app.config['DB_POOL_WARMUP'])
+    worker.log.info("Warmed up %d database connections", opened)
@@ -0,0 +1,197 @@
+"""Per-request SQL instrumentation for Warbler.
+
+Every SQL statement run while handling a request is counted and timed
+(through SQLAlchemy engine events, so all engines are covered). Each
+response then gets a `Server-Timing` header with the request's query
+count, DB time and total time, and a structured (JSON) log line.
+Statements slower than SLOW_QUERY_THRESHOLD_MS are logged on their own,
+and per-endpoint totals are kept for the admin metrics page.
+
+Totals are per process: each gunicorn worker keeps its own.
+"""
+
+import json
+import logging
+import time
+from threading import Lock
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Longest statement text kept for logs and the slowest-statement stats
+MAX_STATEMENT_LENGTH = 500
+
+
+class RequestStats:
+    """ SQL done while handling one request. """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_statement = None
+
+    def record(self, statement, seconds):
+        self.queries += 1
+        self.db_seconds += seconds
+        if seconds > self.slowest_seconds:
+            self.slowest_seconds = seconds
+            self.slowest_statement = statement
+
+
+class EndpointStats:
+    """ Running totals for one endpoint, across requests. """
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.seconds = 0.0
+        self.db_seconds = 0.0
+        self.max_db_seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_statement = None
+
+    def add(self, stats, seconds):
+        self.requests += 1
+        self.queries += stats.queries
+        self.max_queries = max(self.max_queries, stats.queries)
+        self.seconds += seconds
+        self.db_seconds += stats.db_seconds
+        self.max_db_seconds = max(self.max_db_seconds, stats.db_seconds)
+        if stats.slowest_seconds > self.slowest_seconds:
+            self.slowest_seconds = stats.slowest_seconds
+            self.slowest_statement = stats.slowest_statement
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'queries': self.queries,
+            'mean_queries': round(self.queries / self.requests, 2),
+            'max_queries': self.max_queries,
+            'mean_ms': _ms(self.seconds / self.requests),
+            'mean_db_ms': _ms(self.db_seconds / self.requests),
+            'max_db_ms': _ms(self.max_db_seconds),
+            'slowest_query_ms': _ms(self.slowest_seconds),
+            'slowest_statement': self.slowest_statement,
+        }
+
+
+class SQLInstrumentation:
+    """ Query counts and timings per request and per endpoint.
+
+    Configured from the Flask app:
+
+    - SLOW_QUERY_THRESHOLD_MS: statements at least this slow are logged
+      as warnings (0 turns the slow-query log off)
+    """
+
+    def __init__(self, slow_query_ms=100):
+        self.slow_query_ms = slow_query_ms
+        self.endpoints = {}
+        self._lock = Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('SLOW_QUERY_THRESHOLD_MS', self.slow_query_ms)
+        self.slow_query_ms = app.config['SLOW_QUERY_THRESHOLD_MS']
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+        if not event.contains(
+                Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(
+                Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(
+                Engine, 'after_cursor_execute', _after_cursor_execute)
+
+        app.extensions['sql_instrumentation'] = self
+
+    def start_request(self):
+        g._sql_stats = RequestStats()
+
+    def finish_request(self, response):
+        stats = g.pop('_sql_stats', None)
+        if stats is None:
+            return response
+
+        seconds = time.perf_counter() - stats.started_at
+        endpoint = request.endpoint or 'unmatched'
+
+        response.headers.add(
+            'Server-Timing',
+            f'db;dur={stats.db_seconds * 1000:.1f};'
+            f'desc="{stats.queries} queries", '
+            f'total;dur={seconds * 1000:.1f}',
+        )
+
+        logger.info(json.dumps({
+            'event': 'request',
+            'method': request.method,
+            'path': request.path,
+            'endpoint': endpoint,
+            'status': response.status_code,
+            'duration_ms': _ms(seconds),
+            'queries': stats.queries,
+            'db_ms': _ms(stats.db_seconds),
+            'slowest_query_ms': _ms(stats.slowest_seconds),
+        }))
+
+        with self._lock:
+            self.endpoints.setdefault(endpoint, EndpointStats()).add(
+                stats, seconds)
+
+        return response
+
+    def query_finished(self, statement, seconds):
+        """ Called for every statement, in or out of a request. """
+
+        statement = statement[:MAX_STATEMENT_LENGTH]
+        in_request = has_request_context()
+
+        stats = g.get('_sql_stats') if in_request else None
+        if stats is not None:
+            stats.record(statement, seconds)
+
+        if self.slow_query_ms and seconds * 1000 >= self.slow_query_ms:
+            logger.warning(json.dumps({
+                'event': 'slow_query',
+                'endpoint': request.endpoint if in_request else None,
+                'duration_ms': _ms(seconds),
+                'statement': statement,
+            }))
+
+    def snapshot(self):
+        """ Per-endpoint totals as a dict, for the admin metrics page. """
+
+        with self._lock:
+            return {
+                endpoint: stats.to_dict()
+                for endpoint, stats in sorted(self.endpoints.items())
+            }
+
+    def reset(self):
+        with self._lock:
+            self.endpoints.clear()
+
+
+sql_instrumentation = SQLInstrumentation()
+
+
+def _before_cursor_execute(conn, cursor, statement, *args):
+    conn.info['query_started_at'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, *args):
+    started_at = conn.info.pop('query_started_at', None)
+    if started_at is not None:
+        sql_instrumentation.query_finished(
+            statement, time.perf_counter() - started_at)
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
@@ -0,0 +1,46 @@
+"""Dropping what a write changed from Warbler's caches.
+
+Every write path (the views, the JSON API, background jobs) calls these
+once its transaction has committed, so they all drop the same entries:
+
+    users       user rows that changed (counters, profile, deletion):
+                the current-user cache, and the timeline cache's authors
+    timelines   home timelines that gained or lost messages
+    messages    messages that changed or were deleted
+
+The caches are the app's `current_user_cache` and `timeline_cache`
+extensions (see app.py), looked up on the current app, so jobs and
+blueprints don't import app.py for them.
+"""
+
+from flask import current_app
+
+
+def invalidate(users=(), timelines=(), messages=()):
+    """ Drop the given users, home timelines and messages (ids) from the
+    app's caches.
+    """
+
+    user_cache = current_app.extensions.get('current_user_cache')
+    timeline_cache = current_app.extensions.get('timeline_cache')
+
+    if user_cache is not None:
+        for user_id in users:
+            user_cache.delete(user_id)
+
+    if timeline_cache is not None:
+        timeline_cache.invalidate_authors(list(users))
+        timeline_cache.invalidate_timelines(list(timelines))
+        timeline_cache.invalidate_messages(list(messages))
+
+
+def invalidate_cached_users(*user_ids):
+    """ Drop users whose rows changed. """
+
+    invalidate(users=user_ids)
+
+
+def invalidate_timelines(*user_ids):
+    """ Drop home timelines that a write changed. """
+
+    invalidate(timelines=user_ids)
@@ -0,0 +1,257 @@
+"""Background jobs for Warbler, queued in the database.
+
+Views queue slow work instead of doing it in the request:
+
+    job_queue.enqueue(fan_out_message, message_id=msg.id)
+    db.session.commit()
+
+The job is a row in the `jobs` table, added in the caller's transaction:
+it runs only if the request's changes were committed, and sees them when
+it does. Workers started with `flask worker` (the `worker:` line in the
+Procfile) claim due jobs and run the registered function with the job's
+keyword arguments, in an app context. There's no broker; the database
+is the queue, SQLite included.
+
+On PostgreSQL workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED,
+so they don't queue up behind each other's locks. Elsewhere, and as a
+guard everywhere, a claim is an UPDATE conditional on the job's attempt
+count, which only one worker can win.
+
+A job that raises is retried after JOB_RETRY_DELAY seconds, doubling
+each time, until it has run JOB_MAX_ATTEMPTS times; then it is marked
+'failed' and kept, with its traceback, for a look. A job left 'running'
+for JOB_TIMEOUT seconds (its worker died) is claimed again, so tasks
+should be safe to run twice; one that has used up its attempts that way
+is marked 'failed' instead. Long tasks call job_queue.heartbeat() as
+they go, so they aren't taken for abandoned while they're still running.
+"""
+
+import json
+import logging
+import os
+import socket
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_
+
+from models import db, Job
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """ Registered tasks, and queueing and running jobs for them. """
+
+    def __init__(self):
+        self.tasks = {}
+        self.app = None
+        self.max_attempts = 5
+        self.retry_delay = 10
+        self.timeout = 3600
+        self._stopping = False
+        self._current = None
+
+    def init_app(self, app):
+        self.app = app
+        self.max_attempts = app.config.setdefault('JOB_MAX_ATTEMPTS', 5)
+        self.retry_delay = app.config.setdefault('JOB_RETRY_DELAY', 10)
+        self.timeout = app.config.setdefault('JOB_TIMEOUT', 3600)
+        app.extensions['job_queue'] = self
+
+    def task(self, func):
+        """ Register `func` (by name) as something jobs can run. """
+
+        self.tasks[func.__name__] = func
+        return func
+
+    def enqueue(self, func, delay=0, **kwargs):
+        """ Queue `func(**kwargs)` in the current transaction; callers
+        commit. `kwargs` must be JSON-serializable.
+        """
+
+        if self.tasks.get(func.__name__) is not func:
+            raise ValueError(f"{func.__name__} is not a registered task")
+
+        job = Job(
+            task=func.__name__,
+            args=json.dumps(kwargs),
+            run_at=datetime.utcnow() + timedelta(seconds=delay),
+        )
+        db.session.add(job)
+        return job
+
+    def pending(self, func, **kwargs):
+        """ Whether a job for `func(**kwargs)` is queued or running. """
+
+        return db.session.query(
+            Job.query
+            .filter(Job.task == func.__name__)
+            .filter(Job.args == json.dumps(kwargs))
+            .filter(Job.status.in_(['queued', 'running']))
+            .exists()
+        ).scalar()
+
+    ##########################################################################
+    # Running
+
+    def claim(self, worker_id):
+        """ Mark the next due job as running for `worker_id` and return
+        (id, task, args), or None if nothing is due.
+        """
+
+        while True:
+            now = datetime.utcnow()
+            abandoned = now - timedelta(seconds=self.timeout)
+
+            row = (db.session
+                   .query(Job.id, Job.task, Job.args, Job.attempts,
+                          Job.locked_by)
+                   .filter(or_(
+                       and_(Job.status == 'queued', Job.run_at <= now),
+                       and_(Job.status == 'running',
+                            Job.locked_at < abandoned),
+                   ))
+                   .order_by(Job.run_at, Job.id)
+                   .limit(1)
+                   .with_for_update(skip_locked=True)
+                   .first())
+
+            if row is None:
+                db.session.rollback()
+                return None
+
+            if row.attempts >= self.max_attempts:
+                # Only an abandoned job gets here: its last run never
+                # finished, and there are no runs left
+                (Job.query
+                 .filter_by(id=row.id, attempts=row.attempts)
+                 .update(
+                     {
+                         Job.status: 'failed',
+                         Job.locked_at: None,
+                         Job.locked_by: None,
+                         Job.last_error: f"Abandoned by {row.locked_by}",
+                     },
+                     synchronize_session=False,
+                 ))
+                db.session.commit()
+                logger.error("Job %s (%s) abandoned, and out of attempts",
+                             row.id, row.task)
+                continue
+
+            claimed = (Job.query
+                       .filter_by(id=row.id, attempts=row.attempts)
+                       .update(
+                           {
+                               Job.status: 'running',
+                               Job.attempts: row.attempts + 1,
+                               Job.locked_at: now,
+                               Job.locked_by: worker_id,
+                           },
+                           synchronize_session=False,
+                       ))
+            db.session.commit()
+
+            if claimed:
+                return row.id, row.task, json.loads(row.args)
+
+    def run(self, job_id, task, args):
+        """ Run a claimed job, then delete it, or schedule its retry. """
+
+        with self.app.app_context():
+            self._current = job_id
+            try:
+                return self._run(job_id, task, args)
+            finally:
+                self._current = None
+
+    def heartbeat(self):
+        """ From a running task: note that its job is still going, so it
+        isn't claimed again as abandoned. Commits the task's session, so
+        call it between units of work (after each batch, say).
+        """
+
+        if self._current is None:
+            return
+
+        (Job.query
+         .filter_by(id=self._current, status='running')
+         .update({Job.locked_at: datetime.utcnow()},
+                 synchronize_session=False))
+        db.session.commit()
+
+    def _run(self, job_id, task, args):
+        started = time.monotonic()
+
+        try:
+            func = self.tasks.get(task)
+            if func is None:
+                raise LookupError(f"No task named {task!r}")
+
+            func(**args)
+            db.session.commit()
+
+        except Exception:
+            db.session.rollback()
+            logger.exception("Job %s (%s) failed", job_id, task)
+            self._failed(job_id, traceback.format_exc())
+            return False
+
+        finally:
+            db.session.remove()
+
+        Job.query.filter_by(id=job_id).delete(synchronize_session=False)
+        db.session.commit()
+        logger.info("Job %s (%s) took %.1fms", job_id, task,
+                    (time.monotonic() - started) * 1000)
+        return True
+
+    def _failed(self, job_id, error):
+        job = Job.query.get(job_id)
+        if job is None:
+            return
+
+        if job.attempts >= self.max_attempts:
+            job.status = 'failed'
+        else:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(
+                seconds=self.retry_delay * 2 ** (job.attempts - 1))
+
+        job.locked_at = None
+        job.locked_by = None
+        job.last_error = error
+        db.session.commit()
+
+    def work(self, burst=False, poll_interval=1.0, worker_id=None):
+        """ Run due jobs until stop() is called (or, with `burst`, until
+        none are due). Returns how many ran.
+        """
+
+        worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        ran = 0
+        self._stopping = False
+
+        while not self._stopping:
+            claimed = self.claim(worker_id)
+
+            if claimed is None:
+                if burst:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            self.run(*claimed)
+            ran += 1
+
+        return ran
+
+    def stop(self):
+        """ Have work() return once the current job is done. """
+
+        self._stopping = True
+
+
+job_queue = JobQueue()
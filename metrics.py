@@ -0,0 +1,349 @@
+"""Prometheus-style metrics for Warbler, served at /metrics.
+
+Counters, gauges and fixed-bucket histograms live in plain dicts in each
+process, so recording a request costs a few dict updates. Under gunicorn
+each worker also writes its values to METRICS_MULTIPROC_DIR (at most every
+METRICS_FLUSH_INTERVAL seconds), and whichever worker answers /metrics
+adds up every worker's file. Counters and histograms from exited workers
+keep counting; their gauges are dropped. Clear the directory when the
+server starts (gunicorn.conf.py does).
+"""
+
+import json
+import os
+import time
+from bisect import bisect_left
+from threading import Lock
+
+from flask import g, request
+
+from dbpool import TimedQueuePool
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BCRYPT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+POOL_WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+
+
+class Metric:
+    """ A named family of samples, one per tuple of label values. """
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._lock = Lock()
+
+    def dump(self):
+        with self._lock:
+            return [[list(labels), value]
+                    for labels, value in self.values.items()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, labels, value):
+        with self._lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    """ Counts of observations per fixed bucket, plus their sum.
+
+    Each sample is a list: one (non-cumulative) count per bucket, one for
+    +Inf, then the sum of all observed values.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            sample = self.values.get(labels)
+            if sample is None:
+                sample = self.values[labels] = [0] * (len(self.buckets) + 2)
+            sample[index] += 1
+            sample[-1] += value
+
+
+class Registry:
+    """ A set of metrics, with optional callbacks run before each dump. """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def dump(self):
+        """ Current values as JSON-friendly data, keyed by metric name. """
+
+        for collect in self.collectors:
+            collect()
+
+        return {
+            metric.name: {
+                'type': metric.type,
+                'help': metric.help,
+                'labelnames': list(metric.labelnames),
+                'buckets': list(getattr(metric, 'buckets', ())),
+                'samples': metric.dump(),
+            }
+            for metric in self.metrics
+        }
+
+
+def merge(dumps):
+    """ Add up dumps from several processes into one.
+
+    Each item is (pid or None, dump). Gauges get a `pid` label when
+    there's a pid, since adding up e.g. pool sizes isn't meaningful.
+    """
+
+    merged = {}
+    for pid, dump in dumps:
+        for name, family in dump.items():
+            target = merged.setdefault(name, dict(family, samples={}))
+            if family['type'] == 'gauge' and pid is not None:
+                target['labelnames'] = family['labelnames'] + ['pid']
+
+            for labels, value in family['samples']:
+                if family['type'] == 'gauge' and pid is not None:
+                    labels = labels + [str(pid)]
+                key = tuple(labels)
+
+                if family['type'] == 'histogram':
+                    total = target['samples'].setdefault(key, [0] * len(value))
+                    for i, part in enumerate(value):
+                        total[i] += part
+                else:
+                    target['samples'][key] = (
+                        target['samples'].get(key, 0) + value)
+
+    return merged
+
+
+def render(merged):
+    """ Prometheus text exposition format for merged dumps. """
+
+    lines = []
+    for name, family in sorted(merged.items()):
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+
+        for labels, value in sorted(family['samples'].items()):
+            pairs = list(zip(family['labelnames'], labels))
+
+            if family['type'] != 'histogram':
+                lines.append(f"{name}{_labels(pairs)} {_number(value)}")
+                continue
+
+            cumulative = 0
+            bounds = [_number(b) for b in family['buckets']] + ['+Inf']
+            for bound, count in zip(bounds, value):
+                cumulative += count
+                lines.append(f"{name}_bucket"
+                             f"{_labels(pairs + [('le', bound)])} "
+                             f"{cumulative}")
+            lines.append(f"{name}_sum{_labels(pairs)} {_number(value[-1])}")
+            lines.append(f"{name}_count{_labels(pairs)} {cumulative}")
+
+    return "\n".join(lines) + "\n"
+
+
+class MultiprocessStore:
+    """ One JSON file of metric values per process in a shared directory.
+    """
+
+    def __init__(self, directory, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._flushed_at = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def maybe_flush(self, registry):
+        if time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush(registry)
+
+    def flush(self, registry):
+        pid = os.getpid()
+        path = os.path.join(self.directory, f"{pid}.json")
+        tmp_path = f"{path}.tmp"
+
+        with open(tmp_path, 'w') as tmp:
+            json.dump(registry.dump(), tmp)
+        os.replace(tmp_path, path)
+
+        self._flushed_at = time.monotonic()
+
+    def collect(self):
+        """ (pid, dump) for every process's file; dead ones lose gauges. """
+
+        dumps = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+
+            pid = int(filename[:-len('.json')])
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    dump = json.load(f)
+            except (OSError, ValueError):  # removed or being replaced
+                continue
+
+            if not _is_running(pid):
+                dump = {name: family for name, family in dump.items()
+                        if family['type'] != 'gauge'}
+            dumps.append((pid, dump))
+
+        return dumps
+
+
+class Metrics:
+    """ Request, DB pool and bcrypt metrics for the Flask app.
+
+    Configured from the Flask app:
+
+    - METRICS_MULTIPROC_DIR: directory shared by worker processes (unset:
+      report only this process)
+    - METRICS_FLUSH_INTERVAL: seconds between writes to that directory
+    """
+
+    def __init__(self):
+        self.registry = Registry()
+        self.store = None
+
+        self.request_duration = self.registry.add(Histogram(
+            'warbler_request_duration_seconds',
+            'Time spent handling requests, by view.',
+            ['endpoint', 'method'],
+        ))
+        self.requests = self.registry.add(Counter(
+            'warbler_requests_total',
+            'Requests handled, by view and status code.',
+            ['endpoint', 'method', 'status'],
+        ))
+        self.bcrypt_duration = self.registry.add(Histogram(
+            'warbler_bcrypt_seconds',
+            'Time spent on password hashing and checking.',
+            ['op'],
+            buckets=BCRYPT_BUCKETS,
+        ))
+        self.pool_connections = self.registry.add(Gauge(
+            'warbler_db_pool_connections',
+            'Database pool connections, by state.',
+            ['state'],
+        ))
+        self.pool_wait = self.registry.add(Histogram(
+            'warbler_db_pool_wait_seconds',
+            'Time spent waiting to check a connection out of the pool.',
+            buckets=POOL_WAIT_BUCKETS,
+        ))
+
+    def init_app(self, app, db, password_hasher):
+        app.config.setdefault('METRICS_MULTIPROC_DIR', None)
+        app.config.setdefault('METRICS_FLUSH_INTERVAL', 1.0)
+
+        if app.config['METRICS_MULTIPROC_DIR']:
+            self.store = MultiprocessStore(
+                app.config['METRICS_MULTIPROC_DIR'],
+                app.config['METRICS_FLUSH_INTERVAL'],
+            )
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+        password_hasher.observers.append(
+            lambda op, seconds: self.bcrypt_duration.observe((op,), seconds))
+        TimedQueuePool.observers.append(
+            lambda seconds: self.pool_wait.observe((), seconds))
+
+        self.registry.collectors.append(
+            lambda: self.collect_pool_stats(db.engine.pool))
+
+    def start_request(self):
+        g._metrics_started_at = time.perf_counter()
+
+    def finish_request(self, response):
+        started_at = g.pop('_metrics_started_at', None)
+        if started_at is None:
+            return response
+
+        endpoint = request.endpoint or 'unmatched'
+        self.request_duration.observe(
+            (endpoint, request.method), time.perf_counter() - started_at)
+        self.requests.inc(
+            (endpoint, request.method, str(response.status_code)))
+
+        if self.store is not None:
+            self.store.maybe_flush(self.registry)
+
+        return response
+
+    def collect_pool_stats(self, pool):
+        """ Gauge the engine's pool (QueuePool and friends only). """
+
+        for state, method in (('size', 'size'),
+                              ('checked_out', 'checkedout'),
+                              ('checked_in', 'checkedin'),
+                              ('overflow', 'overflow')):
+            if hasattr(pool, method):
+                # overflow() counts up from -size until the pool is full
+                self.pool_connections.set(
+                    (state,), max(getattr(pool, method)(), 0))
+
+    def exposition(self):
+        """ Prometheus text for this process, or every worker's. """
+
+        if self.store is None:
+            return render(merge([(None, self.registry.dump())]))
+
+        self.store.flush(self.registry)
+        return render(merge(self.store.collect()))
+
+
+metrics = Metrics()
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+
+    def escape(value):
+        return (str(value)
+                .replace('\\', '\\\\')
+                .replace('\n', '\\n')
+                .replace('"', '\\"'))
+
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
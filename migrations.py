@@ -0,0 +1,369 @@
+"""Schema migrations for Warbler.
+
+`db.create_all()` only creates missing tables; it won't add a column or
+an index to a table that already exists. Changes for existing databases
+are revisions here instead, applied in the order they're defined:
+
+    (venv) flask db upgrade         apply pending revisions
+    (venv) flask db status          list revisions, applied or not
+    (venv) flask db check-plans     EXPLAIN the hot queries; fail unless
+                                    they use their indexes
+
+Applied revisions are recorded in the `schema_migrations` table. A new,
+empty database is built with create_all() and marked as fully migrated.
+Revisions look before they change anything, so they also bring databases
+created by an older create_all() up to date.
+
+Each revision runs in its own transaction, except those registered with
+`transaction=False`: on PostgreSQL they get an autocommit connection, so
+indexes on big tables can be built CONCURRENTLY, without blocking writes.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import (
+    Column, DateTime, MetaData, String, Table, func, inspect, select, text,
+)
+from sqlalchemy.schema import CreateIndex
+
+from models import db, Follows, Job, Like, Message, TimelineEntry
+from search import (
+    MESSAGE_TEXT_INDEX, USERNAME_TRIGRAM_INDEX, full_text_query,
+    trigram_query,
+)
+
+schema_migrations = Table(
+    'schema_migrations',
+    MetaData(),
+    Column('revision', String(64), primary_key=True),
+    Column('applied_at', DateTime, nullable=False, server_default=func.now()),
+)
+
+Migration = namedtuple(
+    'Migration', ['revision', 'description', 'upgrade', 'transaction'])
+
+MIGRATIONS = []
+
+
+def migration(revision, description, transaction=True):
+    """ Register the decorated function, called with a connection, as
+    `revision`.
+    """
+
+    def register(upgrade):
+        MIGRATIONS.append(
+            Migration(revision, description, upgrade, transaction))
+        return upgrade
+
+    return register
+
+
+##############################################################################
+# Running
+
+
+def applied_revisions(connection):
+    """ Set of revisions recorded as applied (creating the table if new). """
+
+    schema_migrations.create(connection, checkfirst=True)
+    return {revision for (revision,) in
+            connection.execute(select([schema_migrations.c.revision]))}
+
+
+def upgrade(engine, echo=print):
+    """ Apply pending revisions in order; return the ones applied. """
+
+    with engine.begin() as connection:
+        fresh = not engine.dialect.has_table(connection, 'users')
+        applied = applied_revisions(connection)
+
+        if fresh:
+            db.metadata.create_all(connection)
+            _record(connection, [m.revision for m in MIGRATIONS])
+            echo("Created a new database at the latest revision")
+            return []
+
+    pending = [m for m in MIGRATIONS if m.revision not in applied]
+
+    for m in pending:
+        echo(f"Applying {m.revision}: {m.description}")
+
+        if m.transaction or engine.dialect.name != 'postgresql':
+            with engine.begin() as connection:
+                m.upgrade(connection)
+                _record(connection, [m.revision])
+        else:
+            with engine.connect() as connection:
+                connection = connection.execution_options(
+                    isolation_level='AUTOCOMMIT')
+                m.upgrade(connection)
+                _record(connection, [m.revision])
+
+    return pending
+
+
+def stamp(engine):
+    """ Record every revision as applied, for a schema just built with
+    create_all().
+    """
+
+    with engine.begin() as connection:
+        applied = applied_revisions(connection)
+        _record(connection,
+                [m.revision for m in MIGRATIONS if m.revision not in applied])
+
+
+def status(engine):
+    """ (migration, applied?) for every revision. """
+
+    with engine.begin() as connection:
+        applied = applied_revisions(connection)
+
+    return [(m, m.revision in applied) for m in MIGRATIONS]
+
+
+def _record(connection, revisions):
+    if revisions:
+        connection.execute(
+            schema_migrations.insert(),
+            [{'revision': revision} for revision in revisions],
+        )
+
+
+def has_column(connection, table, column):
+    return any(info['name'] == column
+               for info in inspect(connection).get_columns(table))
+
+
+def create_index(connection, index):
+    """ Build `index` unless it's already there (and valid).
+
+    On PostgreSQL it is built CONCURRENTLY, which needs an autocommit
+    connection. A concurrent build that failed leaves an invalid index
+    behind; that is dropped and built again.
+    """
+
+    name = index.name
+
+    if connection.dialect.name == 'postgresql':
+        create_index_concurrently(
+            connection, name,
+            str(CreateIndex(index).compile(dialect=connection.dialect)))
+
+    else:
+        existing = inspect(connection).get_indexes(index.table.name)
+        if name not in {info['name'] for info in existing}:
+            index.create(connection)
+
+
+def create_index_concurrently(connection, name, ddl):
+    """ On PostgreSQL, run `ddl` (a CREATE INDEX for index `name`)
+    CONCURRENTLY, unless a valid `name` is already there.
+    """
+
+    valid = connection.execute(text(
+        "SELECT indisvalid FROM pg_index "
+        "WHERE indexrelid = to_regclass(:name)"
+    ), name=name).scalar()
+
+    if valid:
+        return
+    if valid is not None:
+        connection.execute(text(f"DROP INDEX CONCURRENTLY {name}"))
+
+    connection.execute(text(
+        ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)))
+
+
+##############################################################################
+# Revisions
+
+
+@migration('0001', "Tables added since the original schema")
+def create_missing_tables(connection):
+    # timeline_entries, for databases from before timelines were
+    # materialized; fill them in with `flask backfill-timelines`
+    db.metadata.create_all(connection)
+
+
+@migration('0002', "Counter and updated_at columns on users and messages")
+def add_user_and_message_columns(connection):
+    # Counters start at 0; correct them with `flask reconcile-counters`
+    columns = [
+        ('users', 'messages_count', "INTEGER NOT NULL DEFAULT 0"),
+        ('users', 'following_count', "INTEGER NOT NULL DEFAULT 0"),
+        ('users', 'followers_count', "INTEGER NOT NULL DEFAULT 0"),
+        ('users', 'likes_count', "INTEGER NOT NULL DEFAULT 0"),
+        ('users', 'updated_at',
+         "TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()"),
+        ('messages', 'likes_count', "INTEGER NOT NULL DEFAULT 0"),
+    ]
+
+    for table, column, definition in columns:
+        if not has_column(connection, table, column):
+            connection.execute(text(
+                f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+
+
+@migration('0003', "Indexes for messages by user, follows by follower and "
+                   "likes by message", transaction=False)
+def add_hot_path_indexes(connection):
+    for table, name in [
+        (Message.__table__, 'ix_messages_user_timestamp'),
+        (Follows.__table__, 'ix_follows_follower_followed'),
+        (Like.__table__, 'ix_likes_message_user'),
+    ]:
+        index, = [index for index in table.indexes if index.name == name]
+        create_index(connection, index)
+
+
+@migration('0004', "users.deactivated, for deletion in the background")
+def add_users_deactivated(connection):
+    if not has_column(connection, 'users', 'deactivated'):
+        connection.execute(text(
+            "ALTER TABLE users "
+            "ADD COLUMN deactivated BOOLEAN NOT NULL DEFAULT false"))
+
+
+@migration('0005', "jobs, the background job queue")
+def create_jobs(connection):
+    Job.__table__.create(connection, checkfirst=True)
+
+
+@migration('0006', "pg_trgm and the user and message search indexes",
+           transaction=False)
+def add_search_indexes(connection):
+    # New databases get these from search.py's after_create DDL; older
+    # ones never did, and searched with sequential scans. Elsewhere
+    # search uses in-process indexes.
+    if connection.dialect.name != 'postgresql':
+        return
+
+    if connection.execute(text(
+            "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).scalar():
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        create_index_concurrently(
+            connection, 'ix_users_username_trgm', USERNAME_TRIGRAM_INDEX)
+
+    create_index_concurrently(
+        connection, 'ix_messages_text_search', MESSAGE_TEXT_INDEX)
+
+
+##############################################################################
+# Query plan checks
+
+
+PlanCheck = namedtuple('PlanCheck', ['name', 'index', 'ok', 'plan'])
+
+
+def hot_queries(user_id=1, message_id=1, per_page=100, search="warble",
+                user_search=True):
+    """ (name, query, index it should use, whether the index gives the
+    rows in order) for the hot read paths, built the way the views build
+    them. `user_search` includes the pg_trgm username search.
+    """
+
+    queries = [
+        (
+            "homepage timeline",
+            (TimelineEntry
+             .messages_query(user_id)
+             .order_by(TimelineEntry.timestamp.desc(),
+                       TimelineEntry.message_id.desc())
+             .limit(per_page + 1)),
+            'ix_timeline_entries_user_timestamp',
+            True,
+        ),
+        (
+            "profile messages",
+            (Message
+             .query
+             .filter(Message.user_id == user_id)
+             .order_by(Message.timestamp.desc(), Message.id.desc())
+             .limit(per_page + 1)),
+            'ix_messages_user_timestamp',
+            True,
+        ),
+        (
+            "users followed",
+            (db.session
+             .query(Follows.user_being_followed_id)
+             .filter(Follows.user_following_id == user_id)),
+            'ix_follows_follower_followed',
+            True,
+        ),
+        (
+            "message likers",
+            (db.session
+             .query(Like.user_id)
+             .filter(Like.message_id == message_id)),
+            'ix_likes_message_user',
+            True,
+        ),
+        # Ranked after the index finds the matches, so these sort
+        (
+            "message search",
+            full_text_query(search).limit(per_page + 1),
+            'ix_messages_text_search',
+            False,
+        ),
+    ]
+
+    if user_search:
+        queries.append((
+            "user search",
+            trigram_query(search).limit(per_page),
+            'ix_users_username_trgm',
+            False,
+        ))
+
+    return queries
+
+
+def check_plans(connection, strict=False):
+    """ EXPLAIN each of hot_queries() on PostgreSQL; a check is ok when
+    the plan uses the expected index.
+
+    On a small or new database the planner would rather scan whole tables
+    (or sort a few rows), so `strict` turns sequential scans off for the
+    checks. For queries whose index gives rows in order it also turns
+    bitmap scans and sorts off, and fails any plan that still sorts: the
+    checks then show each index exists and returns rows in the order its
+    query wants. The search indexes (GIN) are only read by bitmap scans,
+    and their matches are ranked afterwards, so for those plain index
+    scans (and nested loops, which would probe messages by user instead)
+    are what's turned off, and sorts are allowed.
+
+    The username search is checked where pg_trgm is installed; elsewhere
+    user search doesn't use the database.
+    """
+
+    checks = []
+
+    with connection.begin():
+        has_trigram = connection.execute(text(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+        )).scalar() is not None
+
+        for name, query, index, ordered in hot_queries(
+                user_search=has_trigram):
+            if strict:
+                connection.execute(text("SET LOCAL enable_seqscan = off"))
+                for setting, on in (('enable_indexscan', ordered),
+                                    ('enable_bitmapscan', not ordered),
+                                    ('enable_nestloop', ordered),
+                                    ('enable_sort', not ordered)):
+                    connection.execute(text(
+                        f"SET LOCAL {setting} = {'on' if on else 'off'}"))
+
+            compiled = query.statement.compile(dialect=connection.dialect)
+            plan = "\n".join(
+                line for (line,) in connection.execute(
+                    f"EXPLAIN {compiled}", compiled.params))
+
+            ok = index in plan and not (
+                strict and ordered and "Sort Key" in plan)
+            checks.append(PlanCheck(name, index, ok, plan))
+
+    return checks
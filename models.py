@@ -2,11 +2,14 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import exists, false, func, literal, select, union_all
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import PasswordHasher
+from replicas import RoutingSQLAlchemy
+
+bcrypt = PasswordHasher()
+db = RoutingSQLAlchemy()
 
 
 class Follows(db.Model):
@@ -14,6 +17,16 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    # The primary key leads with the followed user; this covers the other
+    # direction ("who does X follow") without touching the table
+    __table_args__ = (
+        db.Index(
+            'ix_follows_follower_followed',
+            'user_following_id',
+            'user_being_followed_id',
+        ),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -26,12 +39,79 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """ Does `follower_id` follow `followed_id`? (primary-key lookup) """
+
+        query = cls.query.filter_by(
+            user_being_followed_id=followed_id,
+            user_following_id=follower_id,
+        )
+        return db.session.query(query.exists()).scalar()
+
+
+class CounterMixin:
+    """ Denormalized counter columns kept in step with their source rows.
+
+    Counters are changed with `UPDATE ... SET col = col + n` in the
+    caller's transaction, so concurrent requests can't lose updates and a
+    rollback undoes them along with the rows they count.
+    """
+
+    @classmethod
+    def adjust_counters(cls, ident, **deltas):
+        """ Add `deltas` (counter column name -> int) to row `ident`. """
+
+        (cls.query
+         .filter(cls.id == ident)
+         .update(
+             {
+                 getattr(cls, name): getattr(cls, name) + delta
+                 for name, delta in deltas.items()
+             },
+             synchronize_session='evaluate',
+         ))
+
+
+def counter_column():
+    """ Non-null integer counter, defaulting to 0 (also for bulk loads). """
+
+    return db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+
+class VersionMixin:
+    """ `cache_version`: a row's identity and column values, as a tuple.
+
+    Whatever is cached from a row (see fragments.py) is keyed by this, so
+    it changes with any column: an edit, or a counter moved by a like or
+    follow.
+    """
+
+    # Columns left out (not shown anywhere, or not always loaded)
+    unversioned_columns = ()
 
-class User(db.Model):
+    @property
+    def cache_version(self):
+        return (self.__tablename__,) + tuple(
+            getattr(self, attr.key)
+            for attr in self.__mapper__.column_attrs
+            if attr.key not in self.unversioned_columns
+        )
+
+
+class User(CounterMixin, VersionMixin, db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
 
+    # The cached current user has no password hash (see app.py)
+    unversioned_columns = ('password',)
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -78,6 +158,35 @@ class User(db.Model):
         nullable=False,
     )
 
+    messages_count = counter_column()
+
+    following_count = counter_column()
+
+    followers_count = counter_column()
+
+    likes_count = counter_column()
+
+    # Bumped by every UPDATE of the row, bulk counter updates included
+    # (onupdate applies to Query.update too): a cheap version stamp for
+    # pages that show the user
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        server_default=func.now(),
+    )
+
+    # Set when the user deletes their account; their rows are removed in
+    # the background (see deletion.py), and until then they can't log in
+    # and their pages are gone
+    deactivated = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=false(),
+    )
+
     messages = db.relationship('Message', order_by='Message.timestamp.desc()')
 
     followers = db.relationship(
@@ -104,25 +213,151 @@ class User(db.Model):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
     def is_followed_by(self, other_user):
-        """Is this user followed by `other_user`?"""
+        """Is this user followed by `other_user`?
 
-        found_user_list = [
-            user for user in self.followers if user == other_user
-        ]
-        return len(found_user_list) == 1
+        One primary-key lookup on follows, without loading `followers`.
+        """
+
+        return Follows.exists(other_user.id, self.id)
 
     def is_following(self, other_user):
-        """Is this user following `other_user`?"""
+        """Is this user following `other_user`?
+
+        One primary-key lookup on follows, without loading `following`.
+        """
+
+        return Follows.exists(self.id, other_user.id)
+
+    def following_ids(self, user_ids):
+        """ Which of `user_ids` this user follows, as a set, in one query.
+
+        Lets list pages show follow buttons for N users without N lookups.
+        """
 
-        found_user_list = [
-            user for user in self.following if user == other_user
-        ]
-        return len(found_user_list) == 1
+        if not user_ids:
+            return set()
 
-    def relationship_hash(self, relationship):
-        """ Takes in the relationship table and puts into a Set. """
+        query = (db.session
+                 .query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == self.id)
+                 .filter(Follows.user_being_followed_id.in_(user_ids)))
 
-        return set(relationship)
+        return {user_id for (user_id,) in query}
+
+    def follow(self, user_id):
+        """ Start following `user_id`, keeping counters and this user's
+        timeline in step.
+
+        Returns False (changing nothing) if already following. Callers
+        commit.
+        """
+
+        if Follows.exists(self.id, user_id):
+            return False
+
+        db.session.add(Follows(
+            user_being_followed_id=user_id,
+            user_following_id=self.id,
+        ))
+        User.adjust_counters(self.id, following_count=1)
+        User.adjust_counters(user_id, followers_count=1)
+        TimelineEntry.add_follow(self.id, user_id)
+        return True
+
+    def unfollow(self, user_id):
+        """ Stop following `user_id`; False if this user wasn't. """
+
+        removed = (Follows.query
+                   .filter_by(user_being_followed_id=user_id,
+                              user_following_id=self.id)
+                   .delete(synchronize_session=False))
+        if not removed:
+            return False
+
+        User.adjust_counters(self.id, following_count=-1)
+        User.adjust_counters(user_id, followers_count=-1)
+        TimelineEntry.remove_follow(self.id, user_id)
+        return True
+
+    def like(self, message_id):
+        """ Like `message_id`, updating both like counters.
+
+        Returns False (changing nothing) if already liked. Callers commit.
+
+        The like is a single INSERT that skips an existing row (ON
+        CONFLICT DO NOTHING; OR IGNORE on SQLite), so there's no check
+        first and a double click can't insert, or count, it twice.
+        """
+
+        if db.engine.dialect.name == 'postgresql':
+            insert = pg_insert(Like.__table__).on_conflict_do_nothing()
+        else:
+            insert = Like.__table__.insert().prefix_with(
+                'OR IGNORE', dialect='sqlite')
+
+        added = db.session.execute(
+            insert.values(user_id=self.id, message_id=message_id)).rowcount
+        if not added:
+            return False
+
+        User.adjust_counters(self.id, likes_count=1)
+        Message.adjust_counters(message_id, likes_count=1)
+        return True
+
+    def unlike(self, message_id):
+        """ Take back a like of `message_id`; False if there wasn't one. """
+
+        removed = (Like.query
+                   .filter_by(user_id=self.id, message_id=message_id)
+                   .delete(synchronize_session=False))
+        if not removed:
+            return False
+
+        User.adjust_counters(self.id, likes_count=-1)
+        Message.adjust_counters(message_id, likes_count=-1)
+        return True
+
+    def liked_message_ids(self, message_ids=None):
+        """ Set of ids of messages this user has liked.
+
+        Pass `message_ids` to only check those messages (e.g. the ones on
+        the page being rendered) instead of loading every like.
+        """
+
+        query = db.session.query(Like.message_id).filter(
+            Like.user_id == self.id)
+
+        if message_ids is not None:
+            if not message_ids:
+                return set()
+            query = query.filter(Like.message_id.in_(message_ids))
+
+        return {message_id for (message_id,) in query}
+
+    @classmethod
+    def reconcile_counters(cls, first_id, last_id):
+        """ Recompute counters for users with ids in [first_id, last_id]. """
+
+        def count_of(column, where):
+            return select([func.count(column)]).where(where).as_scalar()
+
+        (cls.query
+         .filter(cls.id.between(first_id, last_id))
+         .update(
+             {
+                 cls.messages_count: count_of(
+                     Message.id, Message.user_id == cls.id),
+                 cls.following_count: count_of(
+                     Follows.user_being_followed_id,
+                     Follows.user_following_id == cls.id),
+                 cls.followers_count: count_of(
+                     Follows.user_following_id,
+                     Follows.user_being_followed_id == cls.id),
+                 cls.likes_count: count_of(
+                     Like.message_id, Like.user_id == cls.id),
+             },
+             synchronize_session=False,
+         ))
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -131,7 +366,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = bcrypt.generate_password_hash(password)
 
         user = User(
             username=username,
@@ -151,24 +386,36 @@ class User(db.Model):
         It searches for a user whose password hash matches this password
         and, if it finds such a user, returns that user object.
 
-        If can't find matching user (or if password is wrong), returns False.
+        If can't find matching user (or if password is wrong, or the user
+        is deactivated), returns False.
+
+        If the stored hash uses a different bcrypt cost than the configured
+        BCRYPT_LOG_ROUNDS, it is replaced with a hash at the target cost;
+        callers commit to save it.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username,
+                                   deactivated=False).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
             if is_auth:
+                if bcrypt.needs_rehash(user.password):
+                    user.password = bcrypt.generate_password_hash(password)
                 return user
 
         return False
 
 
-class Message(db.Model):
+class Message(CounterMixin, VersionMixin, db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
+    # Moved by other users' likes; message cards don't show it, and the
+    # timeline cache (timelines.py) doesn't keep it
+    unversioned_columns = ('likes_count',)
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -182,7 +429,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -191,8 +438,42 @@ class Message(db.Model):
         nullable=False,
     )
 
+    likes_count = counter_column()
+
     user = db.relationship('User')
 
+    @classmethod
+    def remove_from_counters(cls, message):
+        """ Take `message` out of its author's and likers' counters.
+
+        Call before deleting the message.
+        """
+
+        User.adjust_counters(message.user_id, messages_count=-1)
+
+        (User.query
+         .filter(User.id.in_(
+             select([Like.user_id]).where(Like.message_id == message.id)))
+         .update(
+             {User.likes_count: User.likes_count - 1},
+             synchronize_session=False,
+         ))
+
+    @classmethod
+    def reconcile_counters(cls, first_id, last_id):
+        """ Recompute like counts for messages with ids in [first, last]. """
+
+        (cls.query
+         .filter(cls.id.between(first_id, last_id))
+         .update(
+             {cls.likes_count: (
+                 select([func.count(Like.user_id)])
+                 .where(Like.message_id == cls.id)
+                 .as_scalar()
+             )},
+             synchronize_session=False,
+         ))
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -202,6 +483,18 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
+
+
+# A user's messages, newest first: profile pages, and copying messages
+# into timelines on follow. Both columns descend like the keyset pages, so
+# the scan needs no sort in either direction.
+db.Index(
+    'ix_messages_user_timestamp',
+    Message.user_id,
+    Message.timestamp.desc(),
+    Message.id.desc(),
+)
 
 
 class Like(db.Model):
@@ -209,6 +502,11 @@ class Like(db.Model):
 
     __tablename__ = "likes"
 
+    # The primary key leads with the user; this finds a message's likers
+    __table_args__ = (
+        db.Index('ix_likes_message_user', 'message_id', 'user_id'),
+    )
+
     user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete='CASCADE'),
@@ -219,3 +517,278 @@ class Like(db.Model):
         db.ForeignKey('messages.id', ondelete='CASCADE'),
         primary_key=True,
     )
+
+
+class TimelineEntry(db.Model):
+    """ Materialized home timeline: one row per message per reader.
+
+    Rows are written when a message is posted (fan-out on write) so the
+    homepage is a single range scan on (user_id, timestamp) instead of a
+    sort across every followed user's messages.
+    """
+
+    __tablename__ = "timeline_entries"
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_timeline_entries_user_timestamp',
+            'user_id',
+            'timestamp',
+            'message_id',
+        ),
+        db.Index('ix_timeline_entries_author_user', 'author_id', 'user_id'),
+    )
+
+    COLUMNS = ['user_id', 'message_id', 'author_id', 'timestamp']
+
+    @classmethod
+    def messages_query(cls, user_id):
+        """ Query of the messages on `user_id`'s home timeline, leaving
+        out authors being deleted (their entries go in the background).
+        Joined to their authors: load them with contains_eager.
+
+        Unordered: sort (or paginate) on `cls.timestamp, cls.message_id`
+        so the scan uses the timeline index.
+        """
+
+        return (Message
+                .query
+                .join(cls, cls.message_id == Message.id)
+                .join(User, User.id == Message.user_id)
+                .filter(cls.user_id == user_id)
+                .filter(User.deactivated.is_(False)))
+
+    @classmethod
+    def fan_out(cls, message, followers=True):
+        """ Add a flushed `message` to its author's timeline and, unless
+        `followers` is False, their followers'.
+
+        Posting leaves the followers to a job (see fan_out_followers), so
+        an author with many followers doesn't wait for the insert.
+        """
+
+        own = select([
+            literal(message.user_id),
+            literal(message.id),
+            literal(message.user_id),
+            literal(message.timestamp, db.DateTime),
+        ])
+
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                cls.COLUMNS,
+                union_all(own, cls._followers_of(message))
+                if followers else own,
+            )
+        )
+
+    @classmethod
+    def fan_out_followers(cls, message):
+        """ Add `message` to its author's followers' timelines.
+
+        Skips timelines that already have it: a follow made since it was
+        posted copied it in, or this is a retry.
+        """
+
+        existing = (
+            exists()
+            .where(cls.user_id == Follows.user_following_id)
+            .where(cls.message_id == message.id)
+        )
+
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                cls.COLUMNS,
+                cls._followers_of(message).where(~existing),
+            )
+        )
+
+    @classmethod
+    def _followers_of(cls, message):
+        """ Timeline rows for `message` for each of its author's followers.
+        """
+
+        # Older databases can have self-follows; the author's own row is
+        # added separately
+        return (
+            select([
+                Follows.user_following_id,
+                literal(message.id),
+                literal(message.user_id),
+                literal(message.timestamp, db.DateTime),
+            ])
+            .where(Follows.user_being_followed_id == message.user_id)
+            .where(Follows.user_following_id != message.user_id)
+        )
+
+    @classmethod
+    def add_follow(cls, follower_id, followed_id):
+        """ Copy `followed_id`'s messages into `follower_id`'s timeline. """
+
+        if follower_id == followed_id:
+            return  # their own messages are there already
+
+        followed_messages = (
+            select([
+                literal(follower_id),
+                Message.id,
+                Message.user_id,
+                Message.timestamp,
+            ])
+            .where(Message.user_id == followed_id)
+        )
+
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                cls.COLUMNS,
+                followed_messages,
+            )
+        )
+
+    @classmethod
+    def remove_follow(cls, follower_id, followed_id):
+        """ Drop `followed_id`'s messages from `follower_id`'s timeline. """
+
+        if follower_id == followed_id:
+            return  # an old self-follow; their own messages stay
+
+        (cls.query
+         .filter_by(user_id=follower_id, author_id=followed_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def remove_message(cls, message_id):
+        """ Drop a message from every timeline it was fanned out to. """
+
+        (cls.query
+         .filter_by(message_id=message_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def readers(cls, **criteria):
+        """ Ids of the users with entries matching `criteria` (e.g.
+        message_id=..., author_id=...) on their timelines.
+        """
+
+        return [user_id for (user_id,) in
+                db.session.query(cls.user_id).filter_by(**criteria).distinct()]
+
+    @classmethod
+    def backfill(cls, user_ids):
+        """ Rebuild the timelines of `user_ids` from messages and follows.
+
+        Existing entries for these users are replaced, so it is safe to
+        re-run. Callers commit.
+        """
+
+        (cls.query
+         .filter(cls.user_id.in_(user_ids))
+         .delete(synchronize_session=False))
+
+        own = (
+            select([
+                Message.user_id.label('user_id'),
+                Message.id,
+                Message.user_id.label('author_id'),
+                Message.timestamp,
+            ])
+            .where(Message.user_id.in_(user_ids))
+        )
+        followed = (
+            select([
+                Follows.user_following_id,
+                Message.id,
+                Message.user_id,
+                Message.timestamp,
+            ])
+            .select_from(
+                Follows.__table__.join(
+                    Message.__table__,
+                    Message.user_id == Follows.user_being_followed_id,
+                )
+            )
+            .where(Follows.user_following_id.in_(user_ids))
+            .where(Follows.user_being_followed_id !=
+                   Follows.user_following_id)
+        )
+
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                cls.COLUMNS,
+                union_all(own, followed),
+            )
+        )
+
+
+class Job(db.Model):
+    """ Deferred work, run by `flask worker` (see jobs.py). """
+
+    __tablename__ = "jobs"
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # Name of a function registered with JobQueue.task, and its keyword
+    # arguments as JSON
+    task = db.Column(
+        db.String(100),
+        nullable=False,
+    )
+    args = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    # 'queued' (waiting for run_at), 'running' or 'failed' (out of
+    # attempts); finished jobs are deleted
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default='queued',
+    )
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+    locked_at = db.Column(db.DateTime)
+    locked_by = db.Column(db.String(100))
+    last_error = db.Column(db.Text)
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
@@ -0,0 +1,93 @@
+"""Keyset (cursor) pagination for Warbler message lists."""
+
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+
+class Page:
+    """ One page of results plus cursors for the neighbouring pages.
+
+    `older` / `newer` are cursor strings (or None when there is nothing
+    further in that direction) to pass back as `before` / `after`.
+    """
+
+    def __init__(self, items, older=None, newer=None):
+        self.items = items
+        self.older = older
+        self.newer = newer
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(timestamp, item_id):
+    """ Turn a (timestamp, id) sort key into a URL-safe cursor. """
+
+    return f"{timestamp.isoformat()}_{item_id}"
+
+
+def decode_cursor(cursor):
+    """ Parse a cursor back into (timestamp, id), or None if malformed. """
+
+    try:
+        timestamp, item_id = cursor.rsplit("_", 1)
+        return datetime.fromisoformat(timestamp), int(item_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def paginate(query, timestamp_col, id_col, per_page, before=None, after=None):
+    """ Return a newest-first Page of `query` keyed on (timestamp, id).
+
+    `before` fetches the page older than that cursor, `after` the page
+    newer than it. Each page is a single indexed range scan: there is no
+    OFFSET, so deep pages cost the same as the first one.
+
+    Items must have `timestamp` and `id` attributes matching the columns.
+    """
+
+    sort_key = tuple_(timestamp_col, id_col)
+    after_key = decode_cursor(after) if after else None
+    before_key = decode_cursor(before) if before else None
+
+    if after_key:
+        rows = (query
+                .filter(sort_key > tuple_(*after_key))
+                .order_by(timestamp_col.asc(), id_col.asc())
+                .limit(per_page + 1)
+                .all())
+
+        if rows:
+            items = list(reversed(rows[:per_page]))
+            has_newer = len(rows) > per_page
+            return Page(
+                items,
+                older=_cursor_for(items[-1]),
+                newer=_cursor_for(items[0]) if has_newer else None,
+            )
+
+        # Nothing newer any more (e.g. messages deleted): show the top.
+        before_key = None
+
+    if before_key:
+        query = query.filter(sort_key < tuple_(*before_key))
+
+    rows = (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(per_page + 1)
+            .all())
+    items = rows[:per_page]
+
+    return Page(
+        items,
+        older=_cursor_for(items[-1]) if len(rows) > per_page else None,
+        newer=_cursor_for(items[0]) if before_key and items else None,
+    )
+
+
+def _cursor_for(item):
+    return encode_cursor(item.timestamp, item.id)
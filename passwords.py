@@ -0,0 +1,170 @@
+"""Password hashing for Warbler, run off the request thread.
+
+bcrypt is deliberately slow (~250ms at the default cost), so hashing and
+checking run in a small, bounded process pool. When too much password
+work is already queued we fail fast with `PasswordHasherBusy` (served as
+a 503) instead of letting a login storm tie up every web worker.
+"""
+
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from threading import BoundedSemaphore, Lock
+
+import bcrypt
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROUNDS = 12
+
+
+class PasswordHasherBusy(Exception):
+    """ Too much password work is queued; try again shortly. """
+
+
+def _hash(password, rounds):
+    """ Hash `password` (bytes); returns (hash str, seconds spent). """
+
+    start = time.perf_counter()
+    pw_hash = bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('UTF-8')
+    return pw_hash, time.perf_counter() - start
+
+
+def _check(pw_hash, password):
+    """ Check `password` against `pw_hash` (bytes); returns (bool, secs). """
+
+    start = time.perf_counter()
+    try:
+        matches = bcrypt.checkpw(password, pw_hash)
+    except ValueError:  # not a bcrypt hash
+        matches = False
+    return matches, time.perf_counter() - start
+
+
+class PasswordHasher:
+    """ bcrypt hashing in a bounded process pool, with latency stats.
+
+    Configured from the Flask app:
+
+    - BCRYPT_POOL_WORKERS: processes doing bcrypt work (0 runs it inline)
+    - BCRYPT_POOL_MAX_PENDING: calls allowed in flight at once; more
+      raise PasswordHasherBusy straight away
+    - BCRYPT_POOL_TIMEOUT: seconds to wait for a result before giving up
+    - BCRYPT_LOG_ROUNDS: bcrypt cost for new hashes
+    """
+
+    def __init__(self, workers=0, max_pending=None, timeout=5,
+                 rounds=DEFAULT_ROUNDS):
+        self.configure(workers, max_pending, timeout, rounds)
+        self.stats = {
+            op: {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+            for op in ('hash', 'check')
+        }
+        self.observers = []
+        self._stats_lock = Lock()
+
+    def configure(self, workers, max_pending=None, timeout=5,
+                  rounds=DEFAULT_ROUNDS):
+        self.workers = workers
+        self.max_pending = max_pending or max(workers, 1) * 4
+        self.timeout = timeout
+        self.rounds = rounds
+        self._slots = BoundedSemaphore(self.max_pending)
+        self._executor = None
+
+    def init_app(self, app):
+        app.config.setdefault('BCRYPT_POOL_WORKERS', 2)
+        app.config.setdefault('BCRYPT_POOL_MAX_PENDING', None)
+        app.config.setdefault('BCRYPT_POOL_TIMEOUT', 5)
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', DEFAULT_ROUNDS)
+
+        self.configure(
+            workers=app.config['BCRYPT_POOL_WORKERS'],
+            max_pending=app.config['BCRYPT_POOL_MAX_PENDING'],
+            timeout=app.config['BCRYPT_POOL_TIMEOUT'],
+            rounds=app.config['BCRYPT_LOG_ROUNDS'],
+        )
+
+    def generate_password_hash(self, password, rounds=None):
+        """ Return a bcrypt hash (str) of `password`. """
+
+        if not password:
+            raise ValueError("Password must be non-empty.")
+
+        return self._run('hash', _hash, _to_bytes(password),
+                         rounds or self.rounds)
+
+    def check_password_hash(self, pw_hash, password):
+        """ Does `password` match `pw_hash`? """
+
+        return self._run('check', _check, _to_bytes(pw_hash),
+                         _to_bytes(password))
+
+    def needs_rehash(self, pw_hash):
+        """ Is `pw_hash` not a bcrypt hash at the configured cost? """
+
+        try:
+            prefix, cost = pw_hash.split('$')[1:3]
+            is_bcrypt = prefix in ('2a', '2b', '2y')
+            return not is_bcrypt or int(cost) != self.rounds
+        except (AttributeError, ValueError):
+            return True
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _run(self, op, func, *args):
+        start = time.perf_counter()
+
+        if not self.workers:
+            result, work_seconds = func(*args)
+            self._record(op, time.perf_counter() - start, work_seconds)
+            return result
+
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy(f"{self.max_pending} {op} calls pending")
+
+        try:
+            future = self._get_executor().submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            result, work_seconds = future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise PasswordHasherBusy(f"{op} timed out after {self.timeout}s")
+
+        self._record(op, time.perf_counter() - start, work_seconds)
+        return result
+
+    def _get_executor(self):
+        # Created on first use so each (forked) web worker gets its own
+        # pool; forkserver keeps children from inheriting DB connections.
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('forkserver'),
+            )
+        return self._executor
+
+    def _record(self, op, seconds, work_seconds):
+        with self._stats_lock:
+            stats = self.stats[op]
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+        logger.debug("bcrypt %s took %.1fms (%.1fms hashing)",
+                     op, seconds * 1000, work_seconds * 1000)
+
+        for observer in self.observers:
+            observer(op, seconds)
+
+
+def _to_bytes(value):
+    return value.encode('UTF-8') if isinstance(value, str) else value
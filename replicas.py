@@ -0,0 +1,182 @@
+"""Read-replica routing for Warbler.
+
+Views decorated with `@read_from_replica` run their SELECTs on a read
+replica; everything else, and every write, uses the primary. Within a
+request, once the session has written (a flush or an UPDATE/DELETE), the
+rest of the request reads from the primary too. A user who has just
+written also reads from the primary for DB_REPLICA_STICKY_SECONDS after
+(tracked in their session cookie), so replication lag can't hide their
+own changes from them.
+
+A request picks one replica, the first time it reads, and uses it for
+all its reads: replicas lag by different amounts, and a page built from
+two of them (say a count from one and the list from another) might not
+add up.
+
+Rows read to fill a shared cache are read from the primary, inside
+`reading_from_primary()`: the cache entry may have just been dropped for
+a write, and one refilled from a lagging replica would keep serving the
+old row until it expires.
+
+Replicas that fail with a connection error are skipped for
+DB_REPLICA_COOLDOWN seconds; with none left, reads go to the primary. A
+view whose replica fails part-way is run again against the primary
+(they're read-only, so that's safe).
+"""
+
+import random
+import time
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+
+from flask import current_app, g, has_request_context, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.selectable import SelectBase
+
+# Session key: time (epoch seconds) until which this user reads from the
+# primary
+PRIMARY_UNTIL_KEY = 'primary_until'
+
+
+class ReplicaSet:
+    """ Replica engines, each skipped for a while after it fails. """
+
+    def __init__(self, engines=(), cooldown=30):
+        self.engines = list(engines)
+        self.cooldown = cooldown
+        self._down_until = {}
+        self._lock = Lock()
+
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self._connection_failed)
+
+    def healthy(self):
+        now = time.monotonic()
+        with self._lock:
+            return [engine for engine in self.engines
+                    if self._down_until.get(engine, 0) <= now]
+
+    def choose(self):
+        """ A random healthy replica, or None if there isn't one. """
+
+        engines = self.healthy()
+        return random.choice(engines) if engines else None
+
+    def mark_down(self, engine):
+        with self._lock:
+            self._down_until[engine] = time.monotonic() + self.cooldown
+
+    def _connection_failed(self, context):
+        if (context.is_disconnect or
+                isinstance(context.sqlalchemy_exception, OperationalError)):
+            self.mark_down(context.engine)
+            if has_request_context():
+                g._replica_failed = True
+
+
+class RoutingSession(SignallingSession):
+    """ Session that sends SELECTs to a replica when the request allows.
+    """
+
+    def __init__(self, db, **options):
+        self._db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+        elif (isinstance(clause, SelectBase) and
+                not self.info.get('wrote') and
+                has_request_context() and g.get('_read_from_replica')):
+            if '_replica' not in g:
+                g._replica = self._db.replicas.choose()
+            if g._replica is not None:
+                return g._replica
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with read replicas (see module docs).
+
+    Configured from the Flask app:
+
+    - SQLALCHEMY_REPLICA_URLS: database URLs of the read replicas (none:
+      everything uses the primary)
+    - DB_REPLICA_COOLDOWN: seconds a failed replica is left out
+    - DB_REPLICA_STICKY_SECONDS: seconds a user reads from the primary
+      after writing
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replicas = ReplicaSet()
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_REPLICA_URLS', [])
+        app.config.setdefault('DB_REPLICA_COOLDOWN', 30)
+        app.config.setdefault('DB_REPLICA_STICKY_SECONDS', 5)
+        super().init_app(app)
+
+        options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+        self.replicas = ReplicaSet(
+            [create_engine(url, **options)
+             for url in app.config['SQLALCHEMY_REPLICA_URLS']],
+            cooldown=app.config['DB_REPLICA_COOLDOWN'],
+        )
+
+        app.after_request(self._stick_to_primary)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def _stick_to_primary(self, response):
+        """ After a write, read from the primary for a few seconds. """
+
+        if self.replicas.engines and self.session().info.get('wrote'):
+            config = self.get_app().config
+            session[PRIMARY_UNTIL_KEY] = (
+                time.time() + config['DB_REPLICA_STICKY_SECONDS'])
+        return response
+
+
+@contextmanager
+def reading_from_primary():
+    """ Send the reads in this block to the primary, even in a view that
+    may use a replica.
+    """
+
+    if not has_request_context():
+        yield
+        return
+
+    previous = g.get('_read_from_replica')
+    g._read_from_replica = False
+    try:
+        yield
+    finally:
+        g._read_from_replica = previous
+
+
+def read_from_replica(view):
+    """ Let a read-only view's queries go to a replica. """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g._read_from_replica = (
+            session.get(PRIMARY_UNTIL_KEY, 0) <= time.time())
+        try:
+            return view(*args, **kwargs)
+        except OperationalError:
+            if not g.pop('_replica_failed', False):
+                raise
+
+        current_app.extensions['sqlalchemy'].db.session.rollback()
+        g._read_from_replica = False
+        return view(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,466 @@
+"""Search for Warbler.
+
+On PostgreSQL, usernames are searched with a pg_trgm trigram GIN index
+(when the extension is available) and warble text with a full-text
+`tsvector` GIN index. Both indexes are maintained by the database as
+rows change.
+
+Elsewhere (SQLite test runs, Postgres without pg_trgm) searches fall back
+to pure-Python inverted indexes kept in each process: updated as this
+process adds/removes rows, and rebuilt from the database periodically to
+pick up other processes' changes.
+"""
+
+import re
+import time
+from collections import Counter
+from threading import Lock
+
+from sqlalchemy import (
+    DDL, Float, case, cast, event, func, literal_column, or_, tuple_)
+from sqlalchemy.orm import contains_eager
+
+from models import db, User, Message
+
+# pg_trgm's default similarity() threshold for the `%` operator
+SIMILARITY_THRESHOLD = 0.3
+
+# Must match the expression in the messages full-text index
+TEXT_SEARCH_CONFIG = literal_column("'english'::regconfig")
+
+STOP_WORDS = frozenset("""
+    a an and are as at be but by for from has have i if in into is it its
+    me my no not of on or our so that the their then there these they this
+    to was we were what when which who will with you your
+""".split())
+
+
+def trigrams(text):
+    """ Set of lower-cased trigrams of each word in `text`, like pg_trgm.
+
+    Words are padded with two spaces in front and one behind, so short
+    words and word prefixes still produce trigrams.
+    """
+
+    grams = set()
+    for word in re.findall(r"\w+", text.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def words(text):
+    """ Counter of the searchable (lower-cased, non-stop) words in `text`.
+    """
+
+    return Counter(
+        word for word in re.findall(r"\w+", text.lower())
+        if word not in STOP_WORDS
+    )
+
+
+def similarity(a_grams, b_grams):
+    """ pg_trgm-style similarity: shared trigrams / all trigrams. """
+
+    if not a_grams or not b_grams:
+        return 0.0
+
+    shared = len(a_grams & b_grams)
+    return shared / (len(a_grams) + len(b_grams) - shared)
+
+
+def escape_like(text):
+    """ Escape LIKE wildcards so `text` matches literally. """
+
+    return (text
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def encode_cursor(rank, item_id):
+    """ Cursor for keyset paging through ranked results. """
+
+    return f"{rank!r}_{item_id}"
+
+
+def decode_cursor(cursor):
+    """ Parse a ranked-results cursor into (rank, id), or None. """
+
+    try:
+        rank, item_id = cursor.rsplit("_", 1)
+        return float(rank), int(item_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+class InvertedIndex:
+    """ term -> document ids, with per-document terms for removal.
+
+    `terms` for a document can be a set or a Counter of term frequencies.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.terms = {}
+
+    def add(self, doc_id, terms):
+        self.remove(doc_id)
+        self.terms[doc_id] = terms
+        for term in terms:
+            self.postings.setdefault(term, set()).add(doc_id)
+
+    def remove(self, doc_id):
+        for term in self.terms.pop(doc_id, ()):
+            docs = self.postings.get(term)
+            if docs is not None:
+                docs.discard(doc_id)
+                if not docs:
+                    del self.postings[term]
+
+    def matching_counts(self, terms):
+        """ Counter of doc id -> how many of `terms` it contains. """
+
+        counts = Counter()
+        for term in terms:
+            counts.update(self.postings.get(term, ()))
+        return counts
+
+    def matching_all(self, terms):
+        """ Set of doc ids containing every one of `terms`. """
+
+        postings = sorted(
+            (self.postings.get(term, set()) for term in terms), key=len)
+        if not postings:
+            return set()
+        return set(postings[0]).intersection(*postings[1:])
+
+    def __len__(self):
+        return len(self.terms)
+
+
+class LocalIndex:
+    """ An InvertedIndex over one text column, kept in this process.
+
+    `load` returns (id, text) rows for a full rebuild, which happens
+    every `refresh_interval` seconds; `analyze` turns text into terms.
+    """
+
+    def __init__(self, load, analyze, refresh_interval=60):
+        self.load = load
+        self.analyze = analyze
+        self.refresh_interval = refresh_interval
+        self.index = None
+        self.texts = {}
+        self.lock = Lock()
+        self._built_at = None
+
+    def refresh_if_stale(self):
+        now = time.monotonic()
+        if (self._built_at is not None and
+                now - self._built_at < self.refresh_interval):
+            return
+
+        index = InvertedIndex()
+        texts = {}
+        for doc_id, text in self.load():
+            texts[doc_id] = text
+            index.add(doc_id, self.analyze(text))
+
+        with self.lock:
+            self.index = index
+            self.texts = texts
+            self._built_at = now
+
+    def add(self, doc_id, text):
+        """ Index a new or changed document (if the index is built). """
+
+        if self.index is not None:
+            with self.lock:
+                self.texts[doc_id] = text
+                self.index.add(doc_id, self.analyze(text))
+
+    def remove(self, doc_id):
+        if self.index is not None:
+            with self.lock:
+                self.texts.pop(doc_id, None)
+                self.index.remove(doc_id)
+
+
+class UserSearch:
+    """ Ranked username search: prefix matches, then closest names. """
+
+    def __init__(self, refresh_interval=60):
+        self._has_trigram_index = None
+        self.local = LocalIndex(
+            lambda: (db.session
+                     .query(User.id, User.username)
+                     .filter(User.deactivated.is_(False))),
+            trigrams,
+            refresh_interval,
+        )
+
+    @property
+    def refresh_interval(self):
+        return self.local.refresh_interval
+
+    @refresh_interval.setter
+    def refresh_interval(self, seconds):
+        self.local.refresh_interval = seconds
+
+    def search(self, query, limit, offset=0):
+        """ Users matching `query`, best match first. """
+
+        query = query.strip()
+
+        if self.uses_trigram_index():
+            return self._search_trigram_index(query, limit, offset)
+
+        ids = self._search_local(query)[offset:offset + limit]
+        users = {user.id: user for user in
+                 User.query.filter(User.id.in_(ids))} if ids else {}
+        return [users[user_id] for user_id in ids if user_id in users]
+
+    def uses_trigram_index(self):
+        """ Is pg_trgm installed in the database? (checked once) """
+
+        if self._has_trigram_index is None:
+            self._has_trigram_index = (
+                db.engine.dialect.name == 'postgresql' and
+                db.session.execute(
+                    "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+                ).scalar() is not None
+            )
+        return self._has_trigram_index
+
+    def user_changed(self, user):
+        """ Index a new or renamed user (no-op with pg_trgm). """
+
+        self.local.add(user.id, user.username)
+
+    def user_removed(self, user_id):
+        """ Drop a deleted user from the index (no-op with pg_trgm). """
+
+        self.local.remove(user_id)
+
+    def _search_trigram_index(self, query, limit, offset):
+        return (trigram_query(query)
+                .limit(limit)
+                .offset(offset)
+                .all())
+
+    def _search_local(self, query):
+        """ Ranked user ids from the in-process trigram index. """
+
+        self.local.refresh_if_stale()
+        lowered = query.lower()
+        query_grams = trigrams(query)
+
+        with self.local.lock:
+            usernames = self.local.texts
+            if len(lowered) < 3:
+                # Too short to have trigrams inside a word: scan names
+                candidates = usernames.keys()
+            else:
+                candidates = self.local.index.matching_counts(query_grams)
+
+            scored = []
+            for user_id in candidates:
+                username = usernames[user_id].lower()
+                score = similarity(
+                    query_grams, self.local.index.terms[user_id])
+                if lowered in username or score >= SIMILARITY_THRESHOLD:
+                    rank = 0 if username.startswith(lowered) else 1
+                    scored.append((rank, -score, username, user_id))
+
+        return [user_id for (*_, user_id) in sorted(scored)]
+
+
+class MessageSearch:
+    """ Full-text search over warble text, best match first.
+
+    Every query word must appear (stop words are ignored). Results are
+    paged by keyset on (rank, id): pass a page's `next_cursor` back as
+    `after` for the next page.
+    """
+
+    def __init__(self, refresh_interval=60):
+        self.local = LocalIndex(
+            lambda: (db.session
+                     .query(Message.id, Message.text)
+                     .join(User, Message.user_id == User.id)
+                     .filter(User.deactivated.is_(False))),
+            words,
+            refresh_interval,
+        )
+
+    @property
+    def refresh_interval(self):
+        return self.local.refresh_interval
+
+    @refresh_interval.setter
+    def refresh_interval(self, seconds):
+        self.local.refresh_interval = seconds
+
+    def search(self, query, limit, after=None):
+        """ Return (messages, next_cursor) for up to `limit` matches.
+
+        `next_cursor` is None when there are no more results.
+        """
+
+        after = decode_cursor(after) if after else None
+
+        if db.engine.dialect.name == 'postgresql':
+            ranked = self._search_full_text_index(query, limit + 1, after)
+        else:
+            ranked = self._search_local(query, limit + 1, after)
+
+        next_cursor = None
+        if len(ranked) > limit:
+            ranked = ranked[:limit]
+            next_cursor = encode_cursor(*ranked[-1])
+
+        # The local index may still hold authors deactivated since it
+        # was built
+        ids = [message_id for (_, message_id) in ranked]
+        messages = {
+            message.id: message
+            for message in (Message
+                            .query
+                            .join(User, Message.user_id == User.id)
+                            .filter(Message.id.in_(ids))
+                            .filter(User.deactivated.is_(False))
+                            .options(contains_eager(Message.user)))
+        } if ids else {}
+
+        return (
+            [messages[message_id] for message_id in ids
+             if message_id in messages],
+            next_cursor,
+        )
+
+    def message_added(self, message):
+        """ Index a new message (no-op on PostgreSQL). """
+
+        self.local.add(message.id, message.text)
+
+    def message_removed(self, message_id):
+        """ Drop a deleted message (no-op on PostgreSQL). """
+
+        self.local.remove(message_id)
+
+    def _search_full_text_index(self, query, limit, after):
+        """ (rank, id) pairs from the tsvector GIN index. """
+
+        return full_text_query(query, after).limit(limit).all()
+
+    def _search_local(self, query, limit, after):
+        """ (rank, id) pairs from the in-process word index. """
+
+        self.local.refresh_if_stale()
+        query_words = list(words(query))
+        if not query_words:
+            return []
+
+        with self.local.lock:
+            index = self.local.index
+            ranked = []
+            for message_id in index.matching_all(query_words):
+                counts = index.terms[message_id]
+                rank = (sum(counts[word] for word in query_words) /
+                        sum(counts.values()))
+                if after is None or (rank, message_id) < after:
+                    ranked.append((rank, message_id))
+
+        ranked.sort(reverse=True)
+        return ranked[:limit]
+
+
+##############################################################################
+# Database search (PostgreSQL)
+
+
+def trigram_query(query):
+    """ Users whose username contains or resembles `query`, prefix
+    matches first, using ix_users_username_trgm.
+    """
+
+    pattern = escape_like(query)
+    is_prefix = User.username.ilike(f"{pattern}%", escape='\\')
+
+    # pg_trgm's similarity operator `%`, doubled for psycopg2's
+    # pyformat params (SQLAlchemy doesn't escape custom operators)
+    is_similar = User.username.op('%%')(query)
+
+    return (User
+            .query
+            .filter(User.deactivated.is_(False))
+            .filter(or_(
+                User.username.ilike(f"%{pattern}%", escape='\\'),
+                is_similar,
+            ))
+            .order_by(
+                case([(is_prefix, 0)], else_=1),
+                func.similarity(User.username, query).desc(),
+                User.username,
+            ))
+
+
+def full_text_query(query, after=None):
+    """ (rank, id) of messages by active users matching `query`, best
+    first, using ix_messages_text_search. `after` is a (rank, id) to
+    continue from.
+    """
+
+    vector = func.to_tsvector(TEXT_SEARCH_CONFIG, Message.text)
+    tsquery = func.plainto_tsquery(TEXT_SEARCH_CONFIG, query)
+    # ts_rank is a float4; as a float8 it round-trips through cursors
+    rank = cast(func.ts_rank(vector, tsquery), Float)
+
+    matches = (db.session
+               .query(rank, Message.id)
+               .join(User, Message.user_id == User.id)
+               .filter(vector.op('@@')(tsquery))
+               .filter(User.deactivated.is_(False)))
+
+    if after:
+        matches = matches.filter(tuple_(rank, Message.id) < tuple_(*after))
+
+    return matches.order_by(rank.desc(), Message.id.desc())
+
+
+# The search indexes, built with the tables on a new database, and by
+# migration 0006 on older ones.
+USERNAME_TRIGRAM_INDEX = (
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+    "ON users USING gin (username gin_trgm_ops)"
+)
+MESSAGE_TEXT_INDEX = (
+    "CREATE INDEX IF NOT EXISTS ix_messages_text_search "
+    "ON messages USING gin (to_tsvector('english'::regconfig, text))"
+)
+
+
+# Trigram index for username search, where pg_trgm is available. Created
+# with the users table; without the extension the Python index is used.
+event.listen(
+    User.__table__,
+    'after_create',
+    DDL(
+        "DO $$ BEGIN "
+        "IF EXISTS (SELECT 1 FROM pg_available_extensions "
+        "           WHERE name = 'pg_trgm') THEN "
+        "  CREATE EXTENSION IF NOT EXISTS pg_trgm; "
+        f"  {USERNAME_TRIGRAM_INDEX}; "
+        "END IF; "
+        "END $$"
+    ).execute_if(dialect='postgresql'),
+)
+
+# Full-text index for message search; PostgreSQL keeps it up to date as
+# messages are inserted and deleted.
+event.listen(
+    Message.__table__,
+    'after_create',
+    DDL(MESSAGE_TEXT_INDEX).execute_if(dialect='postgresql'),
+)
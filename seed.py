@@ -1,19 +1,71 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
+By default the CSVs are bulk-loaded (COPY on PostgreSQL); pass
+`--loader orm` to go through SQLAlchemy's bulk_insert_mappings instead.
+`--data-dir` points at another set of users/messages/follows CSVs, such
+as a staging snapshot.
+
+Home timelines and counters are then built the way `flask
+backfill-timelines` and `flask reconcile-counters` build them, in
+batches of their own transactions, so a large snapshot doesn't become
+one huge insert. Each step's time is printed.
+"""
+
+import argparse
+import os
+import time
 from csv import DictReader
-from app import db
+
+from app import db, backfill_all_timelines, reconcile_all_counters
+from bulkload import bulk_load
+from migrations import stamp
 from models import User, Message, Follows
 
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--loader', choices=['bulk', 'orm'], default='bulk')
+parser.add_argument('--data-dir', default='generator')
+parser.add_argument('--timeline-batch-size', type=int, default=500,
+                    help='users whose timelines are built per transaction')
+parser.add_argument('--counter-batch-size', type=int, default=10000,
+                    help='ids whose counters are recomputed per transaction')
+args = parser.parse_args()
+
+
+def quiet(message):
+    pass
+
+
+sources = [
+    (User, os.path.join(args.data_dir, 'users.csv')),
+    (Message, os.path.join(args.data_dir, 'messages.csv')),
+    (Follows, os.path.join(args.data_dir, 'follows.csv')),
+]
+
 db.drop_all()
 db.create_all()
+stamp(db.engine)
+
+if args.loader == 'bulk':
+    with db.engine.begin() as connection:
+        results = bulk_load(
+            connection,
+            [(model.__table__, path) for (model, path) in sources],
+        )
+
+    for result in results:
+        print(result)
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+else:
+    for model, path in sources:
+        with open(path) as csv_file:
+            db.session.bulk_insert_mappings(model, DictReader(csv_file))
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    db.session.commit()
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+start = time.perf_counter()
+backfill_all_timelines(args.timeline_batch_size, echo=quiet)
+print(f"timeline_entries: built in {time.perf_counter() - start:.2f}s")
 
-db.session.commit()
+start = time.perf_counter()
+reconcile_all_counters(args.counter_batch_size, echo=quiet)
+print(f"counters: reconciled in {time.perf_counter() - start:.2f}s")
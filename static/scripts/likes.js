@@ -0,0 +1,37 @@
+/* Star buttons (forms with class "like-form") like and unlike through the
+ * JSON API, so the page stays put. Without JavaScript, or if the API
+ * call fails, the form posts to /messages/<id>/like as before. */
+
+document.addEventListener("submit", async function (evt) {
+  const form = evt.target.closest("form.like-form");
+  if (!form) return;
+
+  evt.preventDefault();
+
+  const star = form.querySelector(".fa-star");
+  const button = form.querySelector("button");
+  const liked = star.classList.contains("fas");
+
+  button.disabled = true;
+
+  try {
+    const resp = await fetch(
+      `/api/v1/messages/${form.dataset.messageId}/like`,
+      {
+        method: liked ? "DELETE" : "POST",
+        headers: { "Content-Type": "application/json" },
+        credentials: "same-origin",
+      }
+    );
+    if (!resp.ok) throw new Error(`HTTP ${resp.status}`);
+
+    const data = await resp.json();
+    star.classList.toggle("fas", data.liked);
+    star.classList.toggle("far", !data.liked);
+    button.title = `${data.likes_count} like${data.likes_count === 1 ? "" : "s"}`;
+  } catch (err) {
+    form.submit();
+  } finally {
+    button.disabled = false;
+  }
+});
@@ -0,0 +1,206 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_api.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Follows, Like, Message, User, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, current_user_cache
+
+db.create_all()
+
+JSON = {'Content-Type': 'application/json'}
+
+
+class APITestCase(TestCase):
+    """ Reads, pagination and writes through /api/v1. """
+
+    def setUp(self):
+        db.session.remove()
+        User.query.delete()
+        Message.query.delete()
+
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        author = User.signup("author", "author@test.com", "password", None)
+        db.session.flush()
+
+        start = datetime(2021, 1, 1)
+        messages = [
+            Message(text=f"warble {i}", user_id=author.id,
+                    timestamp=start + timedelta(minutes=i))
+            for i in range(5)
+        ]
+        db.session.add_all(messages)
+        db.session.flush()
+        reader.follow(author.id)
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.author_id = author.id
+        self.message_ids = [message.id for message in messages]
+        current_user_cache.clear()
+
+        self.client = app.test_client()
+
+    def login(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+    def test_timeline_pages(self):
+        """ Is the timeline paged newest first, with a cursor? """
+
+        self.login()
+
+        resp = self.client.get('/api/v1/timeline?limit=3')
+        body = resp.get_json()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/json')
+        self.assertEqual([m['text'] for m in body['messages']],
+                         ["warble 4", "warble 3", "warble 2"])
+        self.assertEqual(body['messages'][0]['user'], {
+            'id': self.author_id,
+            'username': "author",
+            'image_url': "/static/images/default-pic.png",
+        })
+        self.assertFalse(body['messages'][0]['liked'])
+
+        resp = self.client.get(
+            f"/api/v1/timeline?limit=3&cursor={body['next']}")
+        body = resp.get_json()
+
+        self.assertEqual([m['text'] for m in body['messages']],
+                         ["warble 1", "warble 0"])
+        self.assertIsNone(body['next'])
+
+    def test_streamed_list_spans_chunks(self):
+        """ Does a streamed list come out whole across chunks? """
+
+        self.login()
+
+        with app.app_context():
+            db.session.add_all([
+                Message(text=f"bulk {i}", user_id=self.author_id)
+                for i in range(245)
+            ])
+            db.session.commit()
+
+        body = self.client.get(
+            f'/api/v1/users/{self.author_id}/messages?limit=500').get_json()
+
+        self.assertEqual(len(body['messages']), 250)
+        self.assertEqual(len({m['id'] for m in body['messages']}), 250)
+
+    def test_timeline_needs_login(self):
+        """ Does the timeline answer 401 without a login? """
+
+        resp = self.client.get('/api/v1/timeline')
+
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.get_json(), {'error': "Log in first"})
+
+    def test_bad_cursor(self):
+        """ Is a malformed cursor a 400? """
+
+        self.login()
+        resp = self.client.get('/api/v1/timeline?cursor=nope')
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_user(self):
+        """ Does a profile show counts and follow state, but no secrets? """
+
+        self.login()
+        body = self.client.get(f'/api/v1/users/{self.author_id}').get_json()
+
+        self.assertEqual(body['username'], "author")
+        self.assertEqual(body['messages_count'], 0)  # added directly
+        self.assertEqual(body['followers_count'], 1)
+        self.assertTrue(body['following'])
+        self.assertNotIn('email', body)
+        self.assertNotIn('password', body)
+
+        resp = self.client.get('/api/v1/users/0')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_message(self):
+        """ Is a single message served with a UTC timestamp? """
+
+        resp = self.client.get(f'/api/v1/messages/{self.message_ids[0]}')
+
+        self.assertEqual(resp.get_json()['text'], "warble 0")
+        self.assertEqual(resp.get_json()['timestamp'], "2021-01-01T00:00:00Z")
+
+    def test_like_and_unlike(self):
+        """ Do like and unlike change the counts, once each? """
+
+        self.login()
+        message_id = self.message_ids[0]
+
+        resp = self.client.post(f'/api/v1/messages/{message_id}/like',
+                                headers=JSON)
+        self.assertEqual(resp.get_json(), {'liked': True, 'likes_count': 1})
+
+        # Liking twice changes nothing
+        resp = self.client.post(f'/api/v1/messages/{message_id}/like',
+                                headers=JSON)
+        self.assertEqual(resp.get_json(), {'liked': True, 'likes_count': 1})
+
+        body = self.client.get(
+            f'/api/v1/users/{self.reader_id}/likes').get_json()
+        self.assertEqual([m['id'] for m in body['messages']], [message_id])
+        self.assertTrue(body['messages'][0]['liked'])
+
+        # Only your own likes are listed
+        resp = self.client.get(f'/api/v1/users/{self.author_id}/likes')
+        self.assertEqual(resp.status_code, 403)
+
+        resp = self.client.delete(f'/api/v1/messages/{message_id}/like',
+                                  headers=JSON)
+        self.assertEqual(resp.get_json(), {'liked': False, 'likes_count': 0})
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(User.query.get(self.reader_id).likes_count, 0)
+
+    def test_writes_need_json(self):
+        """ Are writes without a JSON content type refused? """
+
+        self.login()
+        resp = self.client.post(
+            f'/api/v1/messages/{self.message_ids[0]}/like')
+
+        self.assertEqual(resp.status_code, 415)
+        self.assertEqual(Like.query.count(), 0)
+
+    def test_follow_and_unfollow(self):
+        """ Do follow and unfollow change follows and timelines? """
+
+        self.login()
+
+        resp = self.client.delete(f'/api/v1/users/{self.author_id}/follow',
+                                  headers=JSON)
+        self.assertEqual(resp.get_json(),
+                         {'following': False, 'followers_count': 0})
+        self.assertFalse(Follows.exists(self.reader_id, self.author_id))
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.reader_id).count(), 0)
+
+        resp = self.client.post(f'/api/v1/users/{self.author_id}/follow',
+                                headers=JSON)
+        self.assertEqual(resp.get_json(),
+                         {'following': True, 'followers_count': 1})
+
+        body = self.client.get(
+            f'/api/v1/users/{self.author_id}/followers').get_json()
+        self.assertEqual([u['username'] for u in body['users']], ["reader"])
+        self.assertIsNone(body['next'])
+
+        resp = self.client.post(f'/api/v1/users/{self.reader_id}/follow',
+                                headers=JSON)
+        self.assertEqual(resp.status_code, 400)
@@ -0,0 +1,59 @@
+"""Benchmark harness tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_benchmarks.py
+
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import TestCase
+
+from benchmarks.run import percentile, summarize, compare
+
+
+def results(p95_ms, queries):
+    return {
+        'meta': {'target': 'test client'},
+        'scenarios': {'homepage': {
+            'p95_ms': p95_ms, 'queries_per_request': queries}},
+    }
+
+
+class BenchmarkHarnessTestCase(TestCase):
+    """ Summaries and baseline comparisons. """
+
+    def test_percentile(self):
+        """ Are percentiles interpolated between samples? """
+
+        values = [1, 2, 3, 4, 5]
+
+        self.assertEqual(percentile(values, 50), 3)
+        self.assertEqual(percentile(values, 95), 4.8)
+        self.assertEqual(percentile([7], 99), 7)
+        self.assertIsNone(percentile([], 50))
+
+    def test_summarize(self):
+        """ Are timings reported in ms, with queries per request? """
+
+        result = summarize([0.003, 0.001, 0.002], [3, 3, 4], 2 ** 21)
+
+        self.assertEqual(result['p50_ms'], 2)
+        self.assertEqual(result['mean_ms'], 2)
+        self.assertEqual(result['requests'], 3)
+        self.assertEqual(result['queries_per_request'], 3.33)
+        self.assertEqual(result['rss_mb'], 2)
+
+        self.assertIsNone(summarize([0.1], [], 0)['queries_per_request'])
+
+    def test_compare(self):
+        """ Are slower p95s and extra queries flagged as regressions? """
+
+        with redirect_stdout(StringIO()):
+            self.assertEqual(
+                compare(results(10, 3), results(11.5, 3), tolerance=0.2), [])
+            self.assertEqual(
+                compare(results(10, 3), results(13, 3), tolerance=0.2),
+                ['homepage'])
+            self.assertEqual(
+                compare(results(10, 3), results(9, 4), tolerance=0.2),
+                ['homepage'])
@@ -0,0 +1,144 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_bulkload.py
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from bulkload import bulk_load
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+db.create_all()
+
+CSVS = {
+    'users.csv': (
+        "id,email,username,image_url,header_image_url,bio,location,password\n"
+        "7,one@test.com,one,/one.jpg,/hero.jpg,Hi,Here,HASHED_PASSWORD\n"
+        "9,two@test.com,two,/two.jpg,/hero.jpg,Hi,There,HASHED_PASSWORD\n"
+    ),
+    'messages.csv': (
+        "id,text,timestamp,user_id\n"
+        "20,\"hello, world\",2020-01-02 03:04:05.000006,7\n"
+        "21,second,2020-01-03 00:00:00,9\n"
+    ),
+    'follows.csv': (
+        "user_being_followed_id,user_following_id\n"
+        "7,9\n"
+    ),
+}
+
+
+class BulkLoadTestCase(TestCase):
+    """ Load the same CSVs with COPY (PostgreSQL) and executemany (SQLite).
+    """
+
+    def setUp(self):
+        db.session.remove()
+        User.query.delete()
+        Message.query.delete()
+        db.session.commit()
+
+        self.data_dir = tempfile.mkdtemp()
+        for name, contents in CSVS.items():
+            with open(os.path.join(self.data_dir, name), 'w') as csv_file:
+                csv_file.write(contents)
+
+        self.sources = [
+            (User.__table__, os.path.join(self.data_dir, 'users.csv')),
+            (Message.__table__, os.path.join(self.data_dir, 'messages.csv')),
+            (Follows.__table__, os.path.join(self.data_dir, 'follows.csv')),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        db.session.commit()
+
+    def check_loaded(self, engine, results):
+        self.assertEqual(
+            [(result.table, result.rows) for result in results],
+            [('users', 2), ('messages', 2), ('follows', 1)],
+        )
+
+        with engine.begin() as connection:
+            self.assertEqual(
+                connection.execute(
+                    "SELECT text FROM messages WHERE id = 20").scalar(),
+                "hello, world",
+            )
+            self.assertEqual(
+                connection.execute(
+                    "SELECT followers_count FROM users WHERE id = 7").scalar(),
+                0,
+            )
+
+            # New rows get ids after the loaded ones
+            connection.execute(User.__table__.insert(), {
+                'email': 'three@test.com',
+                'username': 'three',
+                'password': 'HASHED_PASSWORD',
+            })
+            self.assertEqual(
+                connection.execute(
+                    "SELECT id FROM users WHERE username = 'three'").scalar(),
+                10,
+            )
+
+    def test_copy_load(self):
+        """ Are CSVs COPYed in, with indexes rebuilt and sequences moved? """
+
+        def index_names():
+            return {name for (name,) in db.session.execute(
+                "SELECT indexname FROM pg_indexes "
+                "WHERE tablename IN ('users', 'messages', 'follows')")}
+
+        indexes_before = index_names()
+        db.session.commit()
+
+        with db.engine.begin() as connection:
+            results = bulk_load(connection, self.sources)
+
+        self.check_loaded(db.engine, results)
+        self.assertEqual(index_names(), indexes_before)
+        self.assertIn("ix_messages_text_search", indexes_before)
+
+    def test_copy_load_rolls_back(self):
+        """ Does a bad CSV leave the tables and their indexes untouched? """
+
+        with open(self.sources[2][1], 'a') as csv_file:
+            csv_file.write("7,12345\n")  # no such user
+
+        with self.assertRaises(Exception):
+            with db.engine.begin() as connection:
+                bulk_load(connection, self.sources)
+
+        self.assertEqual(User.query.count(), 0)
+        self.assertEqual(
+            db.session.execute(
+                "SELECT count(*) FROM pg_indexes "
+                "WHERE indexname = 'ix_messages_text_search'").scalar(),
+            1,
+        )
+
+    def test_executemany_load(self):
+        """ Does the SQLite fallback load the same data? """
+
+        engine = create_engine("sqlite://")
+        db.metadata.create_all(engine)
+
+        with engine.begin() as connection:
+            results = bulk_load(connection, self.sources, chunk_size=1)
+
+        self.check_loaded(engine, results)
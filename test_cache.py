@@ -0,0 +1,87 @@
+"""Cache helper tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+from unittest import TestCase
+
+from cache import LRUCache, DictBackend, TieredCache
+
+
+class FakeClock:
+    """ Clock the tests can move forward by hand. """
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the in-process LRU."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LRUCache(maxsize=2, ttl=10, clock=self.clock)
+
+    def test_get_set_delete(self):
+        """ Are values stored, returned and deleted? """
+
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+
+        self.cache.delete("a")
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.get("a", "missing"), "missing")
+
+    def test_ttl(self):
+        """ Do entries expire after their TTL? """
+
+        self.cache.set("a", 1)
+        self.cache.set("b", 2, ttl=100)
+        self.clock.now = 10
+
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.get("b"), 2)
+
+    def test_evicts_least_recently_used(self):
+        """ Is the least recently read entry evicted when full? """
+
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(len(self.cache), 2)
+
+    def test_many(self):
+        """ Do the bulk methods match the single-key ones? """
+
+        self.cache.set_many({"a": 1, "b": 2})
+        self.assertEqual(self.cache.get_many(["a", "b", "c"]), [1, 2, None])
+
+        self.cache.delete_many(["a", "c"])
+        self.assertEqual(self.cache.get_many(["a", "b"]), [None, 2])
+
+
+class TieredCacheTestCase(TestCase):
+    """Test the LRU + shared backend combination."""
+
+    def test_shared_backend_read_through(self):
+        """ Does a second process's LRU fill from the shared store? """
+
+        shared = DictBackend()
+        first = TieredCache(LRUCache(), shared, prefix="t:")
+        second = TieredCache(LRUCache(), shared, prefix="t:")
+
+        first.set(1, {"username": "warbler"})
+        self.assertIsNotNone(shared.get("t:1"))
+        self.assertEqual(second.get(1), {"username": "warbler"})
+
+        first.delete(1)
+        second.local.clear()
+        self.assertIsNone(second.get(1))
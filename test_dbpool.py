@@ -0,0 +1,69 @@
+"""Connection pool configuration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_dbpool.py
+
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+
+from dbpool import TimedQueuePool, engine_options, warm_up
+
+DATABASE_URL = "postgresql:///warbler-test"
+
+
+class EngineOptionsTestCase(TestCase):
+    """ Pool settings for each mode. """
+
+    def test_queue_mode(self):
+        """ Does the default mode pool, recycle and pre-ping? """
+
+        options = engine_options(size=3, max_overflow=2, recycle=60)
+
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertEqual(options['pool_size'], 3)
+        self.assertEqual(options['max_overflow'], 2)
+        self.assertEqual(options['pool_recycle'], 60)
+        self.assertTrue(options['pool_pre_ping'])
+
+    def test_pgbouncer_mode(self):
+        """ Does pgbouncer mode leave pooling to pgbouncer? """
+
+        self.assertEqual(engine_options('pgbouncer'), {'poolclass': NullPool})
+
+        with self.assertRaises(ValueError):
+            engine_options('session')
+
+
+class PoolTestCase(TestCase):
+    """ Warm-up and checkout timing against a real database. """
+
+    def make_engine(self, mode):
+        engine = create_engine(DATABASE_URL, **engine_options(mode, size=3))
+        self.addCleanup(engine.dispose)
+        return engine
+
+    def test_warm_up(self):
+        """ Are pool connections opened up front, up to the pool size? """
+
+        engine = self.make_engine('queue')
+
+        self.assertEqual(warm_up(engine, 10), 3)
+        self.assertEqual(engine.pool.checkedin(), 3)
+
+        self.assertEqual(warm_up(self.make_engine('pgbouncer'), 3), 0)
+
+    def test_checkout_observers(self):
+        """ Is the wait for each checkout reported? """
+
+        waits = []
+        TimedQueuePool.observers.append(waits.append)
+        self.addCleanup(TimedQueuePool.observers.remove, waits.append)
+
+        with self.make_engine('queue').connect() as connection:
+            connection.execute("SELECT 1")
+
+        self.assertEqual(len(waits), 1)
+        self.assertGreaterEqual(waits[0], 0)
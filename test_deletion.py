@@ -0,0 +1,222 @@
+"""Background user deletion tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_deletion.py
+
+import os
+import threading
+import time
+from unittest import TestCase
+
+from deletion import delete_likes, delete_user
+from invalidation import invalidate_cached_users
+from models import db, Follows, Like, Message, TimelineEntry, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import (
+    app, CURR_USER_KEY, current_user_cache, job_queue, message_search,
+    timeline_cache,
+)
+from cache import DictBackend
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class UserDeletionTestCase(TestCase):
+    """ Deleted users are deactivated at once and removed in batches. """
+
+    def setUp(self):
+        db.session.remove()
+        User.query.delete()
+        Message.query.delete()
+
+        leaving = User.signup("leaving", "leaving@test.com", "password",
+                              None)
+        friend = User.signup("friend", "friend@test.com", "password", None)
+        db.session.flush()
+
+        for user, other in ((leaving, friend), (friend, leaving)):
+            user.follow(other.id)
+            for i in range(3):
+                message = Message(text=f"{user.username} {i}",
+                                  user_id=user.id)
+                db.session.add(message)
+                db.session.flush()
+                User.adjust_counters(user.id, messages_count=1)
+                TimelineEntry.fan_out(message)
+                other.like(message.id)
+        db.session.commit()
+
+        self.leaving_id = leaving.id
+        self.friend_id = friend.id
+        current_user_cache.clear()
+
+        self.client = app.test_client()
+
+    def test_deactivated_at_once(self):
+        """ Are pages and logins gone before the rows are deleted? """
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.leaving_id
+
+        resp = self.client.post('/users/delete')
+        self.assertEqual(resp.status_code, 302)
+
+        # Pages and logins go before the rows do
+        self.assertEqual(
+            self.client.get(f'/users/{self.leaving_id}').status_code, 404)
+        self.assertFalse(User.authenticate("leaving", "password"))
+
+        job_queue.work(burst=True)
+        db.session.expire_all()
+        self.assertIsNone(User.query.get(self.leaving_id))
+
+    def test_hidden_before_deletion(self):
+        """ Do the API and search leave out a deactivated user? """
+
+        User.query.filter_by(id=self.leaving_id).update(
+            {User.deactivated: True})
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.friend_id
+
+        for path in ('messages', 'following', 'followers'):
+            resp = self.client.get(
+                f'/api/v1/users/{self.leaving_id}/{path}')
+            self.assertEqual(resp.status_code, 404, path)
+
+        resp = self.client.get(f'/api/v1/users/{self.friend_id}/followers')
+        self.assertEqual(resp.get_json()['users'], [])
+
+        resp = self.client.get('/api/v1/timeline')
+        self.assertEqual(
+            {m['user']['id'] for m in resp.get_json()['messages']},
+            {self.friend_id})
+
+        with app.app_context():
+            messages, _ = message_search.search("leaving", 10)
+        self.assertEqual(messages, [])
+
+    def test_hidden_from_pages_before_deletion(self):
+        """ Do the timeline, likes and follow lists leave out a
+        deactivated user, cached timeline included? """
+
+        old_store, timeline_cache.store = timeline_cache.store, DictBackend()
+        try:
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.friend_id
+            self.assertIn("leaving 0",
+                          self.client.get('/').get_data(as_text=True))
+
+            User.query.filter_by(id=self.leaving_id).update(
+                {User.deactivated: True})
+            db.session.commit()
+            # As the delete view does; the cached page itself stays
+            with app.app_context():
+                invalidate_cached_users(self.leaving_id)
+
+            self.assertIsNotNone(timeline_cache.get_page(self.friend_id))
+            for path in ('/', f'/users/{self.friend_id}/likes',
+                         f'/users/{self.friend_id}/following',
+                         f'/users/{self.friend_id}/followers'):
+                html = self.client.get(path).get_data(as_text=True)
+                self.assertNotIn("leaving", html, path)
+
+            timeline_cache.clear()
+            html = self.client.get('/').get_data(as_text=True)
+            self.assertNotIn("leaving", html)
+            self.assertIn("friend 0", html)
+        finally:
+            timeline_cache.store = old_store
+
+    def test_batches(self):
+        """ Are all rows deleted in batches, with counters adjusted? """
+
+        User.query.filter_by(id=self.leaving_id).update(
+            {User.deactivated: True})
+        db.session.commit()
+
+        progress = []
+        with app.app_context():
+            totals = delete_user(
+                self.leaving_id,
+                batch_size=2,
+                progress=lambda step, n: progress.append((step, n)),
+            )
+
+        self.assertEqual(totals, {
+            'timeline_entries': 9,  # 3 + 3 on their own, 3 on friend's
+            'likes': 3,
+            'likes_received': 3,
+            'following': 1,
+            'followers': 1,
+            'messages': 3,
+        })
+        self.assertIn(('timeline_entries', 2), progress)
+        self.assertIn(('timeline_entries', 9), progress)
+
+        self.assertIsNone(User.query.get(self.leaving_id))
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.friend_id).count(), 3)
+
+        friend = User.query.get(self.friend_id)
+        self.assertEqual(friend.likes_count, 0)
+        self.assertEqual(friend.followers_count, 0)
+        self.assertEqual(friend.following_count, 0)
+        self.assertEqual(friend.messages_count, 3)
+        self.assertEqual(
+            {m.likes_count for m in Message.query.all()}, {0})
+
+    def test_concurrent_batches_count_once(self):
+        """ Do two runners on one batch adjust counters once? """
+
+        User.query.filter_by(id=self.leaving_id).update(
+            {User.deactivated: True})
+        db.session.commit()
+
+        # The other runner picks the same batch, and waits on our locks
+        delete_likes(self.leaving_id, 10)
+        other = threading.Thread(target=self.delete_likes_in_app)
+        other.start()
+        time.sleep(0.2)
+        db.session.commit()
+        other.join()
+
+        self.assertEqual(
+            {m.likes_count for m in
+             Message.query.filter_by(user_id=self.friend_id)}, {0})
+
+    def delete_likes_in_app(self):
+        with app.app_context():
+            delete_likes(self.leaving_id, 10)
+            db.session.commit()
+            db.session.remove()
+
+    def test_purge_leaves_pending_jobs(self):
+        """ Does purging leave users whose job is pending alone? """
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.leaving_id
+        self.client.post('/users/delete')
+
+        result = app.test_cli_runner().invoke(
+            args=['purge-deactivated-users'])
+        self.assertIn("deletion job pending, skipped", result.output)
+        self.assertIsNotNone(User.query.get(self.leaving_id))
+
+        job_queue.work(burst=True)
+        db.session.expire_all()
+        self.assertIsNone(User.query.get(self.leaving_id))
+
+    def test_active_users_are_not_deleted(self):
+        """ Is deleting an active user refused? """
+
+        with self.assertRaises(ValueError), app.app_context():
+            delete_user(self.friend_id)
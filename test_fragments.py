@@ -0,0 +1,161 @@
+"""Fragment cache and cache policy tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_fragments.py
+
+import os
+from unittest import TestCase
+
+from cache import LRUCache
+from fragments import FragmentCache
+from models import db, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, current_user_cache, fragment_cache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FragmentCacheTestCase(TestCase):
+    """ Fragments are reused until what they show changes. """
+
+    def setUp(self):
+        db.session.remove()
+        User.query.delete()
+        Message.query.delete()
+
+        self.author = User.signup("author", "author@test.com", "password",
+                                  None)
+        self.reader = User.signup("reader", "reader@test.com", "password",
+                                  None)
+        db.session.flush()
+        self.message = Message(text="cached warble", user_id=self.author.id)
+        db.session.add(self.message)
+        db.session.commit()
+
+        self.author_id = self.author.id
+        self.reader_id = self.reader.id
+
+        current_user_cache.clear()
+        fragment_cache.cache.clear()
+
+        self.client = app.test_client()
+
+    def test_render_reuses_cached_html(self):
+        """ Is a fragment rendered once per version? """
+
+        fragments = FragmentCache(LRUCache())
+        first_version = self.author.cache_version
+
+        with app.test_request_context():
+            first = fragments.render(
+                'users/sidebar.html', first_version,
+                user=self.author)
+
+            # Same version: the cached render, even though the bio changed
+            self.author.bio = "A new bio"
+            self.assertEqual(
+                fragments.render('users/sidebar.html', first_version,
+                                 user=self.author),
+                first,
+            )
+
+            # The changed row has a new version, so it's rendered again
+            second = fragments.render(
+                'users/sidebar.html', self.author.cache_version,
+                user=self.author)
+
+        self.assertIn("Story has yet to be written", first)
+        self.assertIn("A new bio", second)
+        db.session.rollback()
+
+    def test_cache_version_changes_with_counters(self):
+        """ Does a counter change give the user a new version? """
+
+        version = self.author.cache_version
+        User.adjust_counters(self.author_id, followers_count=1)
+
+        self.assertNotEqual(self.author.cache_version, version)
+        db.session.rollback()
+
+    def test_profile_shows_new_counts(self):
+        """ Does a profile show new counts after a follow? """
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+        html = self.client.get(f'/users/{self.author_id}').get_data(
+            as_text=True)
+        self.assertIn('cached warble', html)
+        self.assertIn(f'/users/{self.author_id}/followers">0</a>', html)
+
+        self.client.post(f'/users/follow/{self.author_id}')
+
+        html = self.client.get(f'/users/{self.author_id}').get_data(
+            as_text=True)
+        self.assertIn(f'/users/{self.author_id}/followers">1</a>', html)
+
+    def test_anonymous_home_page(self):
+        """ Is the anonymous home page served from cache? """
+
+        first = self.client.get('/')
+        second = self.client.get('/')
+
+        self.assertIn('Sign up now', first.get_data(as_text=True))
+        self.assertEqual(first.get_data(), second.get_data())
+
+
+class CachePolicyTestCase(TestCase):
+    """ Cache-Control is set per view. """
+
+    def setUp(self):
+        db.session.remove()
+        User.query.delete()
+        self.user = User.signup("policy", "policy@test.com", "password",
+                                None)
+        db.session.commit()
+        self.user_id = self.user.id
+        current_user_cache.clear()
+
+        self.client = app.test_client()
+
+    def test_anonymous_pages_are_public(self):
+        """ May shared caches keep pages shown to anonymous users? """
+
+        resp = self.client.get(f'/users/{self.user_id}')
+
+        self.assertTrue(resp.cache_control.public)
+        self.assertEqual(resp.cache_control.max_age,
+                         app.config['PUBLIC_CACHE_MAX_AGE'])
+        self.assertIn('Cookie', resp.vary)
+
+    def test_logged_in_pages_are_private(self):
+        """ Are logged-in users' pages private and revalidated? """
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        resp = self.client.get(f'/users/{self.user_id}')
+
+        self.assertTrue(resp.cache_control.private)
+        self.assertTrue(resp.cache_control.no_cache)
+        self.assertFalse(resp.cache_control.public)
+
+    def test_other_responses_are_not_stored(self):
+        """ Are forms and errors kept out of caches? """
+
+        self.assertTrue(self.client.get('/login').cache_control.no_store)
+        self.assertTrue(
+            self.client.get('/users/0').cache_control.no_store)
+
+    def test_static_files_keep_flask_policy(self):
+        """ Are static files left to Flask's cache policy? """
+
+        resp = self.client.get('/static/stylesheets/style.css')
+
+        self.assertFalse(resp.cache_control.no_store)
+        resp.close()
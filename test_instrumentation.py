@@ -0,0 +1,93 @@
+"""SQL instrumentation tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_instrumentation.py
+
+import os
+import re
+from unittest import TestCase
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from instrumentation import sql_instrumentation
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class SQLInstrumentationTestCase(TestCase):
+    """ Server-Timing headers, slow-query logs and the metrics page. """
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+
+        user = User(
+            username="testuser",
+            email="test@test.com",
+            password="HASHED_PASSWORD",
+        )
+        db.session.add(user)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.client = app.test_client()
+        sql_instrumentation.reset()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['ADMIN_METRICS_TOKEN'] = None
+        sql_instrumentation.slow_query_ms = 100
+
+    def test_server_timing(self):
+        """ Does each response report its SQL in Server-Timing? """
+
+        resp = self.client.get(f"/users/{self.user_id}")
+
+        timing = resp.headers['Server-Timing']
+        match = re.match(
+            r'db;dur=[\d.]+;desc="(\d+) queries", total;dur=[\d.]+$', timing)
+        self.assertIsNotNone(match, timing)
+        self.assertGreater(int(match.group(1)), 0)
+
+    def test_slow_query_log(self):
+        """ Are statements over the threshold logged with their endpoint? """
+
+        sql_instrumentation.slow_query_ms = 1e-6
+
+        with self.assertLogs('instrumentation', 'WARNING') as logs:
+            self.client.get(f"/users/{self.user_id}")
+
+        self.assertIn('"event": "slow_query"', logs.output[0])
+        self.assertIn('"endpoint": "users_show"', logs.output[0])
+
+    def test_admin_metrics(self):
+        """ Are per-endpoint totals served only with the admin token? """
+
+        self.assertEqual(self.client.get("/admin/metrics").status_code, 404)
+
+        app.config['ADMIN_METRICS_TOKEN'] = "s3cret"
+        self.client.get(f"/users/{self.user_id}")
+        self.client.get(f"/users/{self.user_id}")
+
+        resp = self.client.get(
+            "/admin/metrics", headers={"Authorization": "Bearer wrong"})
+        self.assertEqual(resp.status_code, 403)
+
+        resp = self.client.get(
+            "/admin/metrics", headers={"Authorization": "Bearer s3crét"})
+        self.assertEqual(resp.status_code, 403)
+
+        resp = self.client.get(
+            "/admin/metrics", headers={"Authorization": "Bearer s3cret"})
+        self.assertEqual(resp.status_code, 200)
+
+        stats = resp.json['endpoints']['users_show']
+        self.assertEqual(stats['requests'], 2)
+        self.assertGreater(stats['queries'], 0)
+        self.assertTrue(stats['slowest_statement'].startswith("SELECT"))
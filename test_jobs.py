@@ -0,0 +1,214 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_jobs.py
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from flask import Flask
+
+from cache import DictBackend
+from jobs import JobQueue, job_queue
+from models import db, Job
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, timeline_cache
+
+db.create_all()
+
+done = []
+
+
+@job_queue.task
+def remember(value):
+    done.append(value)
+
+
+@job_queue.task
+def explode():
+    raise RuntimeError("boom")
+
+
+@job_queue.task
+def beat():
+    job_queue.heartbeat()
+    done.append(Job.query.one().locked_at)
+
+
+class JobQueueTestCase(TestCase):
+    """ Jobs run once, are retried when they fail and survive workers. """
+
+    def setUp(self):
+        db.session.remove()
+        Job.query.delete()
+        db.session.commit()
+        done.clear()
+
+    def test_enqueue_and_run(self):
+        """ Do committed jobs run once, in order, and go away? """
+
+        job_queue.enqueue(remember, value="first")
+        job_queue.enqueue(remember, value="second")
+        db.session.commit()
+
+        self.assertEqual(job_queue.work(burst=True), 2)
+        self.assertEqual(done, ["first", "second"])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_uncommitted_jobs_are_dropped(self):
+        """ Is a job queued in a rolled back transaction never run? """
+
+        job_queue.enqueue(remember, value="rolled back")
+        db.session.rollback()
+
+        self.assertEqual(job_queue.work(burst=True), 0)
+        self.assertEqual(done, [])
+
+    def test_unregistered_task(self):
+        """ Is queueing an unregistered function refused? """
+
+        with self.assertRaises(ValueError):
+            job_queue.enqueue(print)
+
+    def test_retries_then_fails(self):
+        """ Is a failing job retried later, then kept as failed? """
+
+        job = job_queue.enqueue(explode)
+        db.session.commit()
+        job_id = job.id
+
+        job_queue.work(burst=True)
+
+        job = Job.query.get(job_id)
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertIn("boom", job.last_error)
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+        # Not due yet, so a second pass leaves it alone
+        self.assertEqual(job_queue.work(burst=True), 0)
+
+        for attempt in range(2, job_queue.max_attempts + 1):
+            Job.query.filter_by(id=job_id).update(
+                {Job.run_at: datetime.utcnow()})
+            db.session.commit()
+            job_queue.work(burst=True)
+
+        job = Job.query.get(job_id)
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, job_queue.max_attempts)
+        self.assertEqual(job_queue.work(burst=True), 0)
+
+    def test_abandoned_job_is_run_again(self):
+        """ Is a job whose worker died claimed again? """
+
+        job = job_queue.enqueue(remember, value="again")
+        db.session.commit()
+        job_id = job.id
+
+        self.assertIsNotNone(job_queue.claim("dead-worker"))
+        self.assertIsNone(job_queue.claim("other-worker"))
+
+        Job.query.filter_by(id=job_id).update(
+            {Job.locked_at: datetime.utcnow() - timedelta(
+                seconds=job_queue.timeout + 1)})
+        db.session.commit()
+
+        self.assertEqual(job_queue.work(burst=True), 1)
+        self.assertEqual(done, ["again"])
+
+    def test_abandoned_without_attempts_fails(self):
+        """ Is an abandoned job with no runs left marked failed? """
+
+        job = job_queue.enqueue(remember, value="never")
+        db.session.commit()
+        job_id = job.id
+
+        Job.query.filter_by(id=job_id).update({
+            Job.status: 'running',
+            Job.attempts: job_queue.max_attempts,
+            Job.locked_at: datetime.utcnow() - timedelta(
+                seconds=job_queue.timeout + 1),
+            Job.locked_by: "dead-worker",
+        })
+        db.session.commit()
+
+        self.assertEqual(job_queue.work(burst=True), 0)
+        self.assertEqual(done, [])
+
+        job = Job.query.get(job_id)
+        self.assertEqual(job.status, 'failed')
+        self.assertIn("dead-worker", job.last_error)
+
+    def test_heartbeat(self):
+        """ Does a heartbeat keep a running job from looking abandoned? """
+
+        job_queue.enqueue(beat)
+        db.session.commit()
+        job_id, task, args = job_queue.claim("worker")
+
+        long_ago = datetime.utcnow() - timedelta(
+            seconds=job_queue.timeout + 1)
+        Job.query.filter_by(id=job_id).update({Job.locked_at: long_ago})
+        db.session.commit()
+
+        self.assertTrue(job_queue.run(job_id, task, args))
+        self.assertGreater(done[0], long_ago)
+
+    def test_cli(self):
+        """ Does flask worker --burst run the queued jobs? """
+
+        job_queue.enqueue(remember, value="from cli")
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['worker', '--burst'])
+
+        self.assertIn("Ran 1 job(s)", result.output)
+        self.assertEqual(done, ["from cli"])
+
+    def test_cli_needs_shared_timeline_cache(self):
+        """ Does the worker refuse a process-local cache store? """
+
+        store, timeline_cache.store = timeline_cache.store, DictBackend()
+        try:
+            result = app.test_cli_runner().invoke(
+                args=['worker', '--burst'])
+        finally:
+            timeline_cache.store = store
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("CACHE_REDIS_URL", result.output)
+
+    def test_sqlite(self):
+        """ Do jobs run on SQLite too? """
+
+        directory = tempfile.mkdtemp()
+        sqlite_app = Flask(__name__)
+        sqlite_app.config['SQLALCHEMY_DATABASE_URI'] = (
+            f"sqlite:///{os.path.join(directory, 'jobs.db')}")
+        sqlite_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(sqlite_app)
+
+        queue = JobQueue()
+        queue.init_app(sqlite_app)
+        queue.task(remember)
+
+        try:
+            with sqlite_app.app_context():
+                Job.__table__.create(db.engine)
+                queue.enqueue(remember, value="on sqlite")
+                db.session.commit()
+
+                self.assertEqual(queue.work(burst=True), 1)
+                self.assertEqual(Job.query.count(), 0)
+                db.session.remove()
+                db.get_engine().dispose()
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(done, ["on sqlite"])
@@ -3,7 +3,7 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, TimelineEntry
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
@@ -51,3 +51,47 @@ class MessageModelTestCase(TestCase):
         self.assertIn("This is a test message.", self.m.text)
         self.assertEqual(self.m.user_id, self.u.id)
         self.assertEqual(len(self.u.messages), 1)
+
+    def test_timeline_backfill(self):
+        """ Does backfill build timelines from existing follows? """
+
+        follower = User(
+            username="follower",
+            email="follower@test.com",
+            password="HASHED_PASSWORD",
+            image_url=None,
+        )
+        follower.following.append(self.u)
+        db.session.add(follower)
+        db.session.commit()
+
+        TimelineEntry.backfill([self.u.id, follower.id])
+        TimelineEntry.backfill([self.u.id, follower.id])
+        db.session.commit()
+
+        self.assertEqual(
+            TimelineEntry.messages_query(follower.id).all(),
+            [self.m],
+        )
+        self.assertEqual(
+            TimelineEntry.messages_query(self.u.id).all(), [self.m])
+        self.assertEqual(TimelineEntry.query.count(), 2)
+
+    def test_timelines_ignore_self_follows(self):
+        """ Do an old self-follow's rows stay out of timelines? """
+
+        # Following yourself is refused now, but older databases have some
+        db.session.add(Follows(user_being_followed_id=self.u.id,
+                               user_following_id=self.u.id))
+        db.session.commit()
+
+        TimelineEntry.backfill([self.u.id])
+        message = Message(text="Another", user_id=self.u.id)
+        db.session.add(message)
+        db.session.flush()
+        TimelineEntry.fan_out(message)
+        TimelineEntry.fan_out_followers(message)
+        db.session.commit()
+
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.u.id).count(), 2)
@@ -6,8 +6,8 @@
 
 import os
 from unittest import TestCase
-from models import db, Message, User
-from app import app, CURR_USER_KEY
+from models import db, Message, User, TimelineEntry
+from app import app, CURR_USER_KEY, job_queue, message_search
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -31,6 +31,8 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+message_search.refresh_interval = 0
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -158,6 +160,50 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.get(test_msg.id)
             self.assertEqual(msg.text, "test_message")
 
+    def test_message_show_not_modified(self):
+        """ Is an unchanged message answered with 304 for its ETag only? """
+
+        message_id = self.testmsg.id
+        resp = self.client.get(f"/messages/{message_id}")
+        self.assertIsNone(resp.last_modified)
+
+        # Dates are too coarse to tell a change in the same second
+        resp = self.client.get(
+            f"/messages/{message_id}",
+            headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.client.get(
+            f"/messages/{message_id}",
+            headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, 304)
+
+        # Another viewer gets the full page
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        resp = self.client.get(
+            f"/messages/{message_id}",
+            headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_message_show_like_toggle(self):
+        """ Does a liked message show a filled star that toggles the like? """
+
+        message_id = self.testmsg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/messages/{message_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn(f'action="/messages/{message_id}/like"', html)
+            self.assertIn('class="like-form"', html)
+            self.assertIn('class="fas fa-star"', html)
+            self.assertNotIn('/unlike', html)
+
     def test_message_show_invalid(self):
         """ 404 error if trying to access a message that does not exist? """
 
@@ -283,3 +329,159 @@ class MessageViewTestCase(TestCase):
             self.assertIn('id="liked-messages-page"', html)
             self.assertIn('test_liked_message', html)
             self.assertNotIn('test_message', html)
+
+    def test_homepage_timeline(self):
+        """ Are followed users' new messages fanned out to the homepage? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u2_id}")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post("/messages/new", data={"text": "fanned out warble"})
+            job_queue.work(burst=True)
+
+            msg = Message.query.filter_by(text="fanned out warble").one()
+            readers = {
+                entry.user_id
+                for entry in TimelineEntry.query.filter_by(message_id=msg.id)
+            }
+            self.assertEqual(readers, {self.u1_id, self.u2_id})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/")
+            self.assertIn("fanned out warble", resp.get_data(as_text=True))
+
+            c.post(f"/users/stop-following/{self.u2_id}")
+
+            resp = c.get("/")
+            self.assertNotIn("fanned out warble", resp.get_data(as_text=True))
+
+    def test_message_destroy_timeline(self):
+        """ Does deleting a message remove it from every timeline? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "short-lived"})
+            msg = Message.query.filter_by(text="short-lived").one()
+            self.assertEqual(
+                TimelineEntry.query.filter_by(message_id=msg.id).count(), 1)
+
+            c.post(f"/messages/{msg.id}/delete")
+
+            self.assertEqual(
+                TimelineEntry.query.filter_by(message_id=msg.id).count(), 0)
+
+    def test_message_counters(self):
+        """ Do posting, liking and deleting keep counters correct? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post("/messages/new", data={"text": "counted"})
+            msg = Message.query.filter_by(text="counted").one()
+            self.assertEqual(User.query.get(self.u2_id).messages_count, 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/messages/{msg.id}/like")
+            self.assertEqual(Message.query.get(msg.id).likes_count, 1)
+            self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/messages/{msg.id}/delete")
+
+        db.session.expire_all()
+        self.assertEqual(User.query.get(self.u2_id).messages_count, 0)
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 0)
+
+    def test_message_search(self):
+        """ Does search rank matching warbles and page through them? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for text in ("pancakes", "pancakes pancakes pancakes",
+                         "waffles", "pancakes and waffles"):
+                c.post("/messages/new", data={"text": text})
+
+            resp = c.get("/messages/search?q=Pancakes")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("<p>waffles</p>", html)
+            self.assertLess(html.index("<p>pancakes pancakes pancakes</p>"),
+                            html.index("<p>pancakes</p>"))
+
+            resp = c.get("/messages/search?q=pancakes waffles")
+            html = resp.get_data(as_text=True)
+            self.assertIn("<p>pancakes and waffles</p>", html)
+            self.assertNotIn("<p>pancakes</p>", html)
+
+            msg = Message.query.filter_by(text="pancakes").one()
+            c.post(f"/messages/{msg.id}/delete")
+
+            resp = c.get("/messages/search?q=pancakes")
+            self.assertNotIn("<p>pancakes</p>", resp.get_data(as_text=True))
+
+    def test_message_search_pages(self):
+        """ Does each page of results pick up after the last one? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for i in range(3):
+                c.post("/messages/new", data={"text": f"paged {i}"})
+
+        seen = []
+        after = None
+        for _ in range(3):
+            messages, after = message_search.search(
+                "paged", limit=1, after=after)
+            seen.extend(message.text for message in messages)
+
+        self.assertEqual(sorted(seen), ["paged 0", "paged 1", "paged 2"])
+        self.assertIsNone(after)
+
+    def test_message_search_local_index(self):
+        """ Is the in-process index kept up to date as messages change? """
+
+        message_search.local.refresh_if_stale()
+        message_search.refresh_interval = 60
+
+        try:
+            msg = Message(text="Brunch with the brunch crowd",
+                          user_id=self.u1_id)
+            db.session.add(msg)
+            db.session.commit()
+
+            # Not indexed until the next rebuild...
+            self.assertEqual(
+                message_search._search_local("brunch", 10, None), [])
+
+            # ...unless this process tells the index about it
+            message_search.message_added(msg)
+            [(rank, message_id)] = message_search._search_local(
+                "the BRUNCH", 10, None)
+            self.assertEqual(message_id, msg.id)
+            self.assertEqual(rank, 2 / 3)
+
+            message_search.message_removed(msg.id)
+            self.assertEqual(
+                message_search._search_local("brunch", 10, None), [])
+        finally:
+            message_search.refresh_interval = 0
@@ -0,0 +1,112 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_metrics.py
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, bcrypt, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from metrics import Histogram, MultiprocessStore, Registry, merge, render
+
+db.create_all()
+
+
+class HistogramTestCase(TestCase):
+    """ Fixed-bucket histograms and their text format. """
+
+    def test_render_histogram(self):
+        """ Are buckets cumulative, with a sum and count? """
+
+        registry = Registry()
+        histogram = registry.add(
+            Histogram('latency', 'Latency.', ['view'], buckets=(0.1, 1)))
+
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(('home',), value)
+
+        text = render(merge([(None, registry.dump())]))
+
+        self.assertIn('# TYPE latency histogram', text)
+        self.assertIn('latency_bucket{view="home",le="0.1"} 2', text)
+        self.assertIn('latency_bucket{view="home",le="1"} 3', text)
+        self.assertIn('latency_bucket{view="home",le="+Inf"} 4', text)
+        self.assertIn('latency_sum{view="home"} 3.65', text)
+        self.assertIn('latency_count{view="home"} 4', text)
+
+    def test_multiprocess_merge(self):
+        """ Are files from several processes added up? """
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        registry = Registry()
+        histogram = registry.add(Histogram('latency', 'Latency.', ['view']))
+        histogram.observe(('home',), 0.2)
+
+        store = MultiprocessStore(directory)
+        store.flush(registry)
+
+        # Another (exited) worker's file
+        os.rename(os.path.join(directory, f"{os.getpid()}.json"),
+                  os.path.join(directory, "999999999.json"))
+        histogram.observe(('home',), 0.3)
+        store.flush(registry)
+
+        text = render(merge(store.collect()))
+        self.assertIn('latency_count{view="home"} 3', text)
+
+
+class MetricsViewTestCase(TestCase):
+    """ The /metrics endpoint. """
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def test_metrics_endpoint(self):
+        """ Are requests, pool stats and bcrypt timings reported? """
+
+        self.client.get("/login")
+        for observer in bcrypt.observers:
+            observer('check', 0.3)
+
+        resp = self.client.get("/metrics")
+        text = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        self.assertRegex(
+            text,
+            r'warbler_requests_total\{endpoint="login",method="GET",'
+            r'status="200"\} \d+')
+        self.assertIn(
+            'warbler_request_duration_seconds_bucket'
+            '{endpoint="login",method="GET",le="+Inf"}', text)
+        self.assertIn('warbler_db_pool_connections{state="checked_out"}',
+                      text)
+        self.assertIn('warbler_bcrypt_seconds_bucket{op="check",le="0.5"}',
+                      text)
+
+    def test_metrics_token(self):
+        """ With METRICS_TOKEN set, is /metrics served only with it? """
+
+        app.config['METRICS_TOKEN'] = "scrape"
+        try:
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+
+            resp = self.client.get(
+                "/metrics", headers={"Authorization": "Bearer scrape"})
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            app.config['METRICS_TOKEN'] = None
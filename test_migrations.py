@@ -0,0 +1,116 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_migrations.py
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, inspect
+
+import migrations
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+db.create_all()
+
+
+def quiet(message):
+    pass
+
+
+class MigrationsTestCase(TestCase):
+    """ Upgrades build new databases and bring old ones up to date. """
+
+    def setUp(self):
+        migrations.upgrade(db.engine, echo=quiet)
+
+    def forget(self, revision):
+        with db.engine.begin() as connection:
+            connection.execute(
+                migrations.schema_migrations.delete().where(
+                    migrations.schema_migrations.c.revision == revision))
+
+    def test_new_database(self):
+        """ Is a new database built whole and marked fully migrated? """
+
+        directory = tempfile.mkdtemp()
+        engine = create_engine(
+            f"sqlite:///{os.path.join(directory, 'new.db')}")
+
+        try:
+            self.assertEqual(migrations.upgrade(engine, echo=quiet), [])
+            self.assertIn('timeline_entries',
+                          inspect(engine).get_table_names())
+            self.assertTrue(all(
+                applied for _, applied in migrations.status(engine)))
+            self.assertEqual(migrations.upgrade(engine, echo=quiet), [])
+        finally:
+            engine.dispose()
+            shutil.rmtree(directory)
+
+    def test_missing_index_is_built(self):
+        """ Does upgrading build a hot path index that is missing? """
+
+        db.engine.execute("DROP INDEX ix_likes_message_user")
+        self.forget('0003')
+
+        applied = migrations.upgrade(db.engine, echo=quiet)
+
+        self.assertEqual([m.revision for m in applied], ['0003'])
+        self.assertIn('ix_likes_message_user',
+                      {ix['name'] for ix in inspect(db.engine)
+                       .get_indexes('likes')})
+
+    def test_missing_column_is_added(self):
+        """ Does upgrading add a counter column that is missing? """
+
+        db.engine.execute("ALTER TABLE messages DROP COLUMN likes_count")
+        self.forget('0002')
+
+        migrations.upgrade(db.engine, echo=quiet)
+
+        self.assertIn('likes_count',
+                      {column['name'] for column in inspect(db.engine)
+                       .get_columns('messages')})
+
+    def test_missing_search_index_is_built(self):
+        """ Does upgrading build the message search index? """
+
+        db.engine.execute("DROP INDEX ix_messages_text_search")
+        self.forget('0006')
+
+        applied = migrations.upgrade(db.engine, echo=quiet)
+
+        self.assertEqual([m.revision for m in applied], ['0006'])
+        # The inspector skips expression indexes
+        self.assertIsNotNone(db.engine.execute(
+            "SELECT to_regclass('ix_messages_text_search')").scalar())
+
+    def test_hot_queries_use_indexes(self):
+        """ Does every hot query, search included, use its index? """
+
+        with db.engine.connect() as connection:
+            checks = migrations.check_plans(connection, strict=True)
+
+        self.assertIn("message search", [check.name for check in checks])
+        for check in checks:
+            self.assertTrue(check.ok, f"{check.name}:\n{check.plan}")
+
+    def test_cli(self):
+        """ Do the status and check-plans commands work? """
+
+        runner = app.test_cli_runner()
+
+        result = runner.invoke(args=['db', 'status'])
+        self.assertIn("[x] 0003", result.output)
+
+        result = runner.invoke(
+            args=['db', 'check-plans', '--strict'])
+        self.assertEqual(result.exit_code, 0, result.output)
@@ -0,0 +1,59 @@
+"""Password hasher tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+
+from unittest import TestCase
+
+from passwords import PasswordHasher, PasswordHasherBusy
+
+# Cheapest bcrypt cost, to keep the tests fast
+ROUNDS = 4
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test hashing inline and in the process pool."""
+
+    def test_inline_hash_and_check(self):
+        """ Does hashing without a pool work? """
+
+        hasher = PasswordHasher(workers=0, rounds=ROUNDS)
+        pw_hash = hasher.generate_password_hash("password")
+
+        self.assertTrue(pw_hash.startswith("$2b$04$"))
+        self.assertTrue(hasher.check_password_hash(pw_hash, "password"))
+        self.assertFalse(hasher.check_password_hash(pw_hash, "wrong"))
+        self.assertFalse(hasher.check_password_hash("not-a-hash", "x"))
+
+        with self.assertRaises(ValueError):
+            hasher.generate_password_hash("")
+
+    def test_pool_hash_and_check(self):
+        """ Does hashing in the process pool work and record timings? """
+
+        hasher = PasswordHasher(workers=1, rounds=ROUNDS)
+        timings = []
+        hasher.observers.append(lambda op, seconds: timings.append(op))
+
+        try:
+            pw_hash = hasher.generate_password_hash("password")
+            self.assertTrue(hasher.check_password_hash(pw_hash, "password"))
+        finally:
+            hasher.shutdown()
+
+        self.assertEqual(timings, ["hash", "check"])
+        self.assertEqual(hasher.stats["hash"]["count"], 1)
+        self.assertGreater(hasher.stats["check"]["seconds"], 0)
+
+    def test_pool_saturated(self):
+        """ Do calls fail fast once max_pending calls are in flight? """
+
+        hasher = PasswordHasher(workers=1, max_pending=1, rounds=ROUNDS)
+        hasher._slots.acquire()
+
+        with self.assertRaises(PasswordHasherBusy):
+            hasher.generate_password_hash("password")
+
+        hasher._slots.release()
+        hasher.shutdown()
@@ -0,0 +1,203 @@
+"""Query-count regression tests for timeline pages."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_query_budgets.py
+
+import os
+from contextlib import contextmanager
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from cache import DictBackend
+from models import db, User, Message, Follows, Like, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, current_user_cache, timeline_cache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NUM_AUTHORS = 5
+MESSAGES_PER_AUTHOR = 4
+
+
+@contextmanager
+def count_queries():
+    """ Collect every SQL statement run on the engine into a list. """
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(
+            db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+class QueryBudgetTestCase(TestCase):
+    """ Pages must render in a fixed number of queries. """
+
+    # Budgets don't depend on how many messages are on the page: going
+    # over one means something is lazy-loading per message again.
+    HOME_BUDGET = 3
+    PROFILE_BUDGET = 5
+    LIKES_BUDGET = 3
+    LIKE_BUDGET = 6
+
+    def setUp(self):
+        """ A viewer following several authors who liked every message. """
+
+        User.query.delete()
+        Message.query.delete()
+
+        self.client = app.test_client()
+
+        viewer = User(
+            username="viewer",
+            email="viewer@test.com",
+            password="HASHED_PASSWORD",
+        )
+        authors = [
+            User(
+                username=f"author{i}",
+                email=f"author{i}@test.com",
+                password="HASHED_PASSWORD",
+            )
+            for i in range(NUM_AUTHORS)
+        ]
+        db.session.add_all([viewer] + authors)
+        db.session.flush()
+
+        for author in authors:
+            db.session.add(Follows(
+                user_being_followed_id=author.id,
+                user_following_id=viewer.id,
+            ))
+            for i in range(MESSAGES_PER_AUTHOR):
+                msg = Message(text=f"warble {i}", user_id=author.id)
+                db.session.add(msg)
+                db.session.flush()
+                db.session.add(Like(user_id=viewer.id, message_id=msg.id))
+
+        TimelineEntry.backfill([viewer.id])
+        db.session.commit()
+
+        self.viewer_id = viewer.id
+        self.author_id = authors[0].id
+
+    def tearDown(self):
+        resp = super().tearDown()
+        db.session.rollback()
+        return resp
+
+    def get_counting_queries(self, url):
+        """ GET `url` as the viewer; return (response, statements). """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            db.session.expunge_all()
+            with count_queries() as statements:
+                resp = c.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        return resp, statements
+
+    def test_homepage_query_budget(self):
+        """ Does the homepage stay within its query budget? """
+
+        resp, statements = self.get_counting_queries("/")
+
+        self.assertEqual(
+            resp.get_data(as_text=True).count("fas fa-star"),
+            NUM_AUTHORS * MESSAGES_PER_AUTHOR,
+        )
+        self.assertLessEqual(len(statements), self.HOME_BUDGET, statements)
+
+    def test_users_show_query_budget(self):
+        """ Does a profile page stay within its query budget? """
+
+        resp, statements = self.get_counting_queries(
+            f"/users/{self.author_id}")
+
+        self.assertEqual(
+            resp.get_data(as_text=True).count("fas fa-star"),
+            MESSAGES_PER_AUTHOR,
+        )
+        self.assertLessEqual(len(statements), self.PROFILE_BUDGET, statements)
+
+    def test_users_likes_query_budget(self):
+        """ Does the likes page stay within its query budget? """
+
+        resp, statements = self.get_counting_queries(
+            f"/users/{self.viewer_id}/likes")
+
+        self.assertIn("@author4", resp.get_data(as_text=True))
+        self.assertLessEqual(len(statements), self.LIKES_BUDGET, statements)
+
+    def test_like_query_budget(self):
+        """ Is a like through the API one INSERT, with no checks first? """
+
+        message = Message(text="new warble", user_id=self.author_id)
+        db.session.add(message)
+        db.session.commit()
+        message_id = message.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            for likes_count in (1, 1):
+                db.session.expunge_all()
+                with count_queries() as statements:
+                    resp = c.post(
+                        f"/api/v1/messages/{message_id}/like",
+                        headers={'Content-Type': 'application/json'},
+                    )
+
+                self.assertEqual(resp.get_json()['likes_count'], likes_count)
+                self.assertLessEqual(
+                    len(statements), self.LIKE_BUDGET, statements)
+                likes = [s for s in statements if "likes" in s.split()]
+                self.assertEqual(len(likes), 1, likes)
+                self.assertIn("ON CONFLICT DO NOTHING", likes[0])
+
+    def test_cached_current_user_skips_query(self):
+        """ Is the logged-in user served from cache on later requests? """
+
+        current_user_cache.clear()
+
+        _, statements = self.get_counting_queries("/messages/new")
+        self.assertEqual(len(statements), 1, statements)
+
+        _, statements = self.get_counting_queries("/messages/new")
+        self.assertEqual(statements, [])
+
+    def test_cached_homepage_skips_queries(self):
+        """ Does a warm homepage come entirely from cache? """
+
+        current_user_cache.clear()
+        old_store, timeline_cache.store = timeline_cache.store, DictBackend()
+
+        try:
+            _, statements = self.get_counting_queries("/")
+            self.assertLessEqual(
+                len(statements), self.HOME_BUDGET, statements)
+
+            resp, statements = self.get_counting_queries("/")
+            self.assertEqual(statements, [])
+            self.assertEqual(
+                resp.get_data(as_text=True).count("fas fa-star"),
+                NUM_AUTHORS * MESSAGES_PER_AUTHOR,
+            )
+        finally:
+            timeline_cache.store = old_store
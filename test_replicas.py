@@ -0,0 +1,206 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_replicas.py
+#
+# A SQLite file stands in for the replica. It holds different rows from
+# the primary, so each page shows which database it read from.
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from cache import DictBackend
+from models import db, Message, User, Follows, TimelineEntry
+from replicas import PRIMARY_UNTIL_KEY, ReplicaSet
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, current_user_cache, timeline_cache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """ Read-only views read from the replica; writes stick to primary. """
+
+    def setUp(self):
+        db.session.remove()
+        User.query.delete()
+        Message.query.delete()
+
+        self.reader = User.signup("reader", "reader@test.com", "password",
+                                  None)
+        self.primary_user = User.signup("onprimary", "primary@test.com",
+                                        "password", None)
+        db.session.commit()
+        self.reader_id = self.reader.id
+        self.primary_user_id = self.primary_user.id
+        current_user_cache.clear()
+
+        # The requests below share this thread's session; start them
+        # with one that hasn't written, as each real request does
+        db.session.remove()
+
+        self.replica_dir = tempfile.mkdtemp()
+        self.replica = create_engine(
+            f"sqlite:///{os.path.join(self.replica_dir, 'replica.db')}")
+        db.metadata.create_all(self.replica)
+        with self.replica.begin() as connection:
+            connection.execute(User.__table__.insert(), [
+                {'id': self.reader_id, 'username': 'reader',
+                 'email': 'reader@test.com', 'password': 'x'},
+                {'id': 1, 'username': 'onreplica',
+                 'email': 'replica@test.com', 'password': 'x'},
+            ])
+
+        self.old_replicas = db.replicas
+        db.replicas = ReplicaSet([self.replica], cooldown=60)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.replicas = self.old_replicas
+        db.session.remove()
+        self.replica.dispose()
+        shutil.rmtree(self.replica_dir)
+
+    def login(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+    def test_read_only_view_uses_replica(self):
+        """ Does a read-only view read from the replica? """
+
+        resp = self.client.get('/users')
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('@onreplica', html)
+        self.assertNotIn('@onprimary', html)
+
+    def test_other_views_use_primary(self):
+        """ Do views that aren't marked read-only use the primary? """
+
+        self.login()
+        resp = self.client.get('/users/profile')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('reader@test.com', resp.get_data(as_text=True))
+
+    def test_reads_stick_to_primary_after_write(self):
+        """ After a write, does the user read from the primary for a while? """
+
+        self.login()
+        resp = self.client.post(f'/users/follow/{self.primary_user_id}')
+        self.assertEqual(resp.status_code, 302)
+        self.assertTrue(Follows.exists(self.reader_id, self.primary_user_id))
+
+        with self.client.session_transaction() as sess:
+            self.assertIn(PRIMARY_UNTIL_KEY, sess)
+
+        html = self.client.get('/users').get_data(as_text=True)
+        self.assertIn('@onprimary', html)
+        self.assertNotIn('@onreplica', html)
+
+        # Once the window has passed, reads go back to the replica
+        with self.client.session_transaction() as sess:
+            sess[PRIMARY_UNTIL_KEY] = 0
+
+        html = self.client.get('/users').get_data(as_text=True)
+        self.assertIn('@onreplica', html)
+
+    def test_one_replica_per_request(self):
+        """ Does every read in a request go to the same replica? """
+
+        chosen = []
+
+        class CountingReplicaSet(ReplicaSet):
+            def choose(self):
+                chosen.append(super().choose())
+                return chosen[-1]
+
+        db.replicas = CountingReplicaSet([self.replica], cooldown=60)
+
+        self.login()
+        resp = self.client.get(f'/users/{self.reader_id}')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(chosen, [self.replica])
+
+    def test_current_user_cached_from_primary(self):
+        """ Is the cached current user read from the primary, not the
+        replica a view reads from? """
+
+        with self.replica.begin() as connection:
+            connection.execute(
+                User.__table__.update()
+                .where(User.id == self.reader_id)
+                .values(followers_count=99))
+
+        self.login()
+        resp = self.client.get('/users')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            current_user_cache.get(self.reader_id)['followers_count'], 0)
+
+    def test_timeline_cached_from_primary(self):
+        """ Is a home page that's cached (or its missing messages) read
+        from the primary, not the lagging replica? """
+
+        # Posted on the primary; the replica hasn't caught up
+        message = Message(text="not replicated yet",
+                          user_id=self.primary_user_id)
+        db.session.add(message)
+        db.session.flush()
+        db.session.add(TimelineEntry(
+            user_id=self.reader_id, message_id=message.id,
+            author_id=self.primary_user_id, timestamp=message.timestamp))
+        db.session.commit()
+        message_id = message.id
+        db.session.remove()
+
+        old_store, timeline_cache.store = timeline_cache.store, DictBackend()
+        try:
+            self.login()
+            html = self.client.get('/').get_data(as_text=True)
+            self.assertIn("not replicated yet", html)
+
+            page, _ = timeline_cache.get_page(self.reader_id)
+            self.assertEqual([m.id for m in page], [message_id])
+
+            # A dropped message is reloaded from the primary too
+            timeline_cache.invalidate_messages([message_id])
+            html = self.client.get('/').get_data(as_text=True)
+            self.assertIn("not replicated yet", html)
+        finally:
+            timeline_cache.store = old_store
+
+    def test_failed_replica_is_skipped(self):
+        """ Is a failing replica left out, and the view run on the primary? """
+
+        broken = create_engine(
+            f"sqlite:///{os.path.join(self.replica_dir, 'no/such.db')}")
+        db.replicas = ReplicaSet([broken], cooldown=60)
+
+        # The view is retried on the primary, and the replica left out
+        resp = self.client.get('/users')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('@onprimary', resp.get_data(as_text=True))
+        self.assertEqual(db.replicas.healthy(), [])
+        self.assertIsNone(db.replicas.choose())
+
+    def test_failed_replica_comes_back_after_cooldown(self):
+        """ Is a failed replica used again after its cooldown? """
+
+        replicas = ReplicaSet([self.replica], cooldown=0)
+        replicas.mark_down(self.replica)
+
+        self.assertEqual(replicas.choose(), self.replica)
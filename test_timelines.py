@@ -0,0 +1,156 @@
+"""Timeline cache tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_timelines.py
+
+import os
+from unittest import TestCase
+
+from cache import DictBackend
+from invalidation import invalidate
+from models import db, Follows, Message, User, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import (
+    app, CURR_USER_KEY, current_user_cache, job_queue, timeline_cache,
+)
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+JSON = {'Content-Type': 'application/json'}
+
+
+class TimelineCacheTestCase(TestCase):
+    """ Cached home pages change with the writes that affect them. """
+
+    def setUp(self):
+        db.session.remove()
+        User.query.delete()
+        Message.query.delete()
+
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        author = User.signup("author", "author@test.com", "password", None)
+        db.session.flush()
+        db.session.add(Follows(user_being_followed_id=author.id,
+                               user_following_id=reader.id))
+        message = Message(text="first warble", user_id=author.id)
+        db.session.add(message)
+        db.session.flush()
+        TimelineEntry.fan_out(message)
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.author_id = author.id
+        self.message_id = message.id
+
+        # Tests don't set CACHE_REDIS_URL; stand in for the shared store
+        self.old_store = timeline_cache.store
+        timeline_cache.store = DictBackend()
+        current_user_cache.clear()
+
+        self.reader = app.test_client()
+        self.author = app.test_client()
+        with self.reader.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+        with self.author.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+
+    def tearDown(self):
+        timeline_cache.store = self.old_store
+
+    def home(self):
+        """ The reader's homepage, after checking it was cached. """
+
+        html = self.reader.get('/').get_data(as_text=True)
+        self.assertIsNotNone(timeline_cache.get_page(self.reader_id))
+        return html
+
+    def test_page_is_cached(self):
+        """ Is the first page cached with its authors and likes? """
+
+        self.assertIn("first warble", self.home())
+
+        page, liked_ids = timeline_cache.get_page(self.reader_id)
+        self.assertEqual([m.id for m in page], [self.message_id])
+        self.assertEqual(page.items[0].user.username, "author")
+        self.assertEqual(liked_ids, set())
+
+    def test_new_and_deleted_messages(self):
+        """ Do new and deleted messages show on a cached page? """
+
+        self.home()
+
+        self.author.post('/messages/new', data={'text': "second warble"})
+        self.assertNotIn("second warble", self.home())
+        job_queue.work(burst=True)
+        self.assertIn("second warble", self.home())
+
+        self.author.post(f'/messages/{self.message_id}/delete')
+        self.assertNotIn("first warble", self.home())
+
+    def test_unfollow_and_follow(self):
+        """ Do unfollows and follows change the cached page? """
+
+        self.home()
+
+        self.reader.post(f'/users/stop-following/{self.author_id}')
+        self.assertNotIn("first warble", self.home())
+
+        self.reader.post(f'/api/v1/users/{self.author_id}/follow',
+                         headers=JSON)
+        self.assertIn("first warble", self.home())
+
+    def test_like(self):
+        """ Does a like show on the cached page? """
+
+        self.assertNotIn("fas fa-star", self.home())
+
+        self.reader.post(f'/messages/{self.message_id}/like')
+        self.assertIn("fas fa-star", self.home())
+
+    def test_author_edit(self):
+        """ Does an author's edit show on the cached page? """
+
+        self.home()
+
+        self.author.post('/users/profile', data={
+            'username': "renamed",
+            'email': "author@test.com",
+            'password': "password",
+        })
+        self.assertIn("@renamed", self.home())
+
+    def test_missing_message_is_reloaded(self):
+        """ Is a message dropped from the cache loaded again? """
+
+        self.home()
+        timeline_cache.invalidate_messages([self.message_id])
+
+        page, _ = timeline_cache.get_page(self.reader_id)
+        self.assertEqual(page.items[0].text, "first warble")
+
+    def test_invalidate_outside_views(self):
+        """ Does invalidate() (as jobs use it) drop timelines and users? """
+
+        self.home()
+        self.assertIsNotNone(current_user_cache.get(self.reader_id))
+
+        with app.app_context():
+            invalidate(users=[self.reader_id], timelines=[self.reader_id])
+
+        self.assertIsNone(timeline_cache.get_page(self.reader_id))
+        self.assertIsNone(current_user_cache.get(self.reader_id))
+
+    def test_off_without_shared_store(self):
+        """ Without a shared store, are timelines left uncached? """
+
+        timeline_cache.store = None
+
+        html = self.reader.get('/').get_data(as_text=True)
+
+        self.assertIn("first warble", html)
+        self.assertIsNone(timeline_cache.get_page(self.reader_id))
@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 from sqlalchemy import exc
-from models import db, User, Message, Follows
+from models import db, bcrypt, User, Message, Follows
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -72,6 +72,8 @@ class UserModelTestCase(TestCase):
     def test_user_follow_methods(self):
         """ Do is_following and is_followed_by work? """
 
+        # Both checks query the follows table, so the users must be saved
+        db.session.add_all([self.u1, self.u2])
         self.u1.followers.append(self.u2)
         self.u1.following.append(self.u2)
         db.session.commit()
@@ -86,6 +88,23 @@ class UserModelTestCase(TestCase):
         self.assertEqual(self.u1.is_followed_by(self.u2), False)
         self.assertEqual(self.u1.is_followed_by(self.u2), False)
 
+    def test_user_following_ids(self):
+        """ Does following_ids answer for a batch of users in one go? """
+
+        u3 = User(
+            username="testuser3",
+            email="test3@test.com",
+            password="HASHED_PASSWORD",
+        )
+        db.session.add_all([self.u1, self.u2, u3])
+        self.u1.following.append(self.u2)
+        db.session.commit()
+
+        self.assertEqual(
+            self.u1.following_ids([self.u2.id, u3.id]), {self.u2.id})
+        self.assertEqual(self.u2.following_ids([self.u1.id, u3.id]), set())
+        self.assertEqual(self.u1.following_ids([]), set())
+
     def test_valid_signup(self):
         """ Does User.signup method work? """
 
@@ -173,6 +192,31 @@ class UserModelTestCase(TestCase):
             User.authenticate('Invalid_username', "HASHED_PASSWORD")
         )
 
+    def test_authenticate_rehashes_other_cost(self):
+        """ Does a login rehash a password stored at another bcrypt cost? """
+
+        user = User.signup(
+            "rehash_test",
+            "rehash@test.com",
+            "HASHED_PASSWORD",
+            None
+        )
+        user.password = bcrypt.generate_password_hash(
+            "HASHED_PASSWORD", rounds=4)
+        db.session.commit()
+
+        target_rounds = bcrypt.rounds
+        bcrypt.rounds = 5
+        try:
+            self.assertIs(
+                User.authenticate("rehash_test", "HASHED_PASSWORD"), user)
+            self.assertTrue(user.password.startswith("$2b$05$"))
+            self.assertFalse(bcrypt.needs_rehash(user.password))
+            self.assertIs(
+                User.authenticate("rehash_test", "HASHED_PASSWORD"), user)
+        finally:
+            bcrypt.rounds = target_rounds
+
     def test_user_messages_liked(self):
         """ Does messages_liked relationship work? """
 
@@ -186,3 +230,24 @@ class UserModelTestCase(TestCase):
 
         self.assertIn(message, self.u2.messages_liked)
         self.assertIn(self.u2, message.users_who_liked)
+
+    def test_reconcile_counters(self):
+        """ Does reconcile_counters recompute counts from source rows? """
+
+        message = Message(text="This is a test message.")
+        self.u1.messages.append(message)
+        self.u1.following.append(self.u2)
+        self.u2.messages_liked.append(message)
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+        User.reconcile_counters(self.u1.id, self.u2.id)
+        Message.reconcile_counters(message.id, message.id)
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertEqual(self.u1.messages_count, 1)
+        self.assertEqual(self.u1.following_count, 1)
+        self.assertEqual(self.u2.followers_count, 1)
+        self.assertEqual(self.u2.likes_count, 1)
+        self.assertEqual(message.likes_count, 1)
@@ -5,9 +5,13 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 import os
+import re
+from datetime import datetime
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, connect_db, Message, User, Follows, Like
+from models import db, connect_db, bcrypt, Message, User, Follows, Like
+from passwords import PasswordHasherBusy
 from bs4 import BeautifulSoup
 
 # BEFORE we import our app, let's set an environmental variable
@@ -19,7 +23,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, job_queue, user_search
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -31,6 +35,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Tests add users straight to the database, so don't let user search use
+# a stale in-process index
+user_search.refresh_interval = 0
+
 
 class UserViewTestCase(TestCase):
     """Test views for users."""
@@ -103,6 +111,72 @@ class UserViewTestCase(TestCase):
             self.assertIn("@testuser3", str(resp.data))
             self.assertIn("@testuser4", str(resp.data))
 
+    def test_login_password_pool_busy(self):
+        """ Does login fail fast with a 503 when bcrypt is saturated? """
+
+        with patch.object(
+            bcrypt,
+            "check_password_hash",
+            side_effect=PasswordHasherBusy,
+        ):
+            resp = self.client.post("/login", data={
+                "username": "testuser",
+                "password": "testuser",
+            })
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers["Retry-After"], "1")
+
+    def test_users_search(self):
+        """ Are search results ranked, with prefix matches first? """
+
+        with self.client as c:
+            resp = c.get("/users?q=testuser2")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            names = [p.text for p in soup.select('.card-contents p')]
+
+            self.assertEqual(names[0], "@testuser2")
+
+            resp = c.get("/users?q=estuser")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            names = [p.text for p in soup.select('.card-contents p')]
+
+            self.assertEqual(len(names), 5)
+
+            resp = c.get("/users?q=nobody-by-this-name")
+            self.assertIn("Sorry, no users found", str(resp.data))
+
+    def test_users_list_pages(self):
+        """ Is the user list paged instead of showing every user? """
+
+        db.session.add_all([
+            User(
+                username=f"paged{i:02}",
+                email=f"paged{i}@test.com",
+                password="HASHED_PASSWORD",
+            )
+            for i in range(25)
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+
+            self.assertEqual(len(soup.select('.user-card')), 24)
+            next_link = soup.find('a', string=re.compile("Next"))
+
+            resp = c.get(next_link['href'])
+            soup = BeautifulSoup(resp.data, 'html.parser')
+
+            self.assertEqual(len(soup.select('.user-card')), 6)
+            self.assertIsNone(soup.find('a', string=re.compile("Next")))
+
+            resp = c.get("/users?q=paged&page=2")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+
+            self.assertEqual(len(soup.select('.user-card')), 1)
+
     def test_users_show(self):
         """ Does user profile display? """
         # TODO: Add authentication test
@@ -113,6 +187,94 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("@testuser", str(resp.data))
 
+    def test_users_show_not_modified(self):
+        """ Is an unchanged profile answered with 304 until it changes? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/users/{self.testuser_id}")
+            etag, is_weak = resp.get_etag()
+
+            self.assertTrue(is_weak)
+
+            resp = c.get(f"/users/{self.testuser_id}",
+                         headers={'If-None-Match': f'W/"{etag}"'})
+
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+            self.assertTrue(resp.cache_control.private)
+
+            # Following the user bumps both users' updated_at
+            c.post(f"/users/follow/{self.testuser_id}")
+            resp = c.get(f"/users/{self.testuser_id}",
+                         headers={'If-None-Match': f'W/"{etag}"'})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Unfollow", resp.get_data(as_text=True))
+
+    def test_not_modified_reads_viewer_from_database(self):
+        """ Does a change to the viewer the cache hasn't seen yet (say,
+        made in another process) still change the ETag?
+        """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get(f"/users/{self.testuser_id}")
+            resp = c.get(f"/users/{self.testuser_id}")
+            etag, _ = resp.get_etag()
+
+            User.query.filter_by(id=self.u1_id).update(
+                {User.updated_at: datetime(2100, 1, 1)})
+            db.session.commit()
+
+            resp = c.get(f"/users/{self.testuser_id}",
+                         headers={'If-None-Match': f'W/"{etag}"'})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_users_show_pagination(self):
+        """ Are profile messages paged with older / newer cursors? """
+
+        same_time = datetime(2021, 1, 1)
+        db.session.add_all([
+            Message(
+                text=f"paged message {i:02}",
+                timestamp=same_time,
+                user_id=self.testuser_id,
+            )
+            for i in range(30)
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/users/{self.testuser_id}")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            older = soup.find('a', string=re.compile("Older"))
+
+            self.assertEqual(len(soup.select('#messages li')), 25)
+            self.assertIsNone(soup.find('a', string=re.compile("Newer")))
+
+            resp = c.get(older['href'])
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            texts = [p.text for p in soup.select('#messages li p')]
+            newer = soup.find('a', string=re.compile("Newer"))
+
+            self.assertEqual(len(texts), 5)
+            self.assertIn("paged message 00", texts)
+            self.assertIsNone(soup.find('a', string=re.compile("Older")))
+
+            resp = c.get(newer['href'])
+            soup = BeautifulSoup(resp.data, 'html.parser')
+
+            self.assertEqual(len(soup.select('#messages li')), 25)
+            self.assertIn("paged message 29", soup.text)
+
     def setup_likes(self):
         """ Function to setup likes for following tests. """
 
@@ -282,14 +444,100 @@ class UserViewTestCase(TestCase):
             self.assertNotIn("@testuser3", str(resp.data))
             self.assertNotIn("@testuser4", str(resp.data))
 
+    def test_follow_counters(self):
+        """ Do follow / unfollow keep both users' counters correct? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/follow/{self.u1_id}")
+
+            self.assertEqual(User.query.get(self.testuser_id).following_count, 1)
+            self.assertEqual(User.query.get(self.u1_id).followers_count, 1)
+
+            c.post(f"/users/stop-following/{self.u1_id}")
+
+            self.assertEqual(User.query.get(self.testuser_id).following_count, 0)
+            self.assertEqual(User.query.get(self.u1_id).followers_count, 0)
+
+    def test_delete_counters(self):
+        """ Does deleting a user take them out of others' counters? """
+
+        self.setup_followers()
+        self.setup_likes()
+        Like.query.delete()
+        db.session.add(Like(
+            user_id=self.u1_id,
+            message_id=Message.query.filter_by(
+                user_id=self.testuser_id).first().id,
+        ))
+        db.session.commit()
+
+        User.reconcile_counters(0, 10000)
+        db.session.commit()
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+        self.assertEqual(User.query.get(self.u1_id).followers_count, 1)
+        self.assertEqual(User.query.get(self.u1_id).following_count, 1)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/users/delete")
+
+        # The rows go in a background job
+        job_queue.work(burst=True)
+        db.session.expire_all()
+        u1 = User.query.get(self.u1_id)
+        self.assertEqual(u1.likes_count, 0)
+        self.assertEqual(u1.followers_count, 0)
+        self.assertEqual(u1.following_count, 0)
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 0)
+
     # def test_users_add_follow(self):
     #     """ Does adding a follow for currently-logged-in user work? """
 
     # def test_users_stop_following(self):
     #     """ Does stop following for currently-logged-in user work? """
 
-    # def test_users_edit_profile(self):
-    #     """ Can the currently-logged-in user update their profile? """
+    def test_users_follow_self(self):
+        """ Is following yourself refused, not an error? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post(f"/users/follow/{self.testuser_id}",
+                          follow_redirects=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Cannot follow yourself",
+                          resp.get_data(as_text=True))
+            self.assertEqual(
+                User.query.get(self.testuser_id).following_count, 0)
+
+    def test_users_edit_profile(self):
+        """ Can the currently-logged-in user update their profile? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            # Warm the current-user cache before the edit
+            resp = c.get("/")
+            self.assertIn("@testuser<", resp.get_data(as_text=True))
+
+            c.post("/users/profile", data={
+                "username": "renamed",
+                "email": "test@test.com",
+                "bio": "bio",
+                "location": "here",
+                "password": "testuser",
+            })
+
+            resp = c.get("/")
+            self.assertIn("@renamed<", resp.get_data(as_text=True))
 
     # def test_users_delete(self):
     #     """ Does deleting a user work? """
@@ -0,0 +1,191 @@
+"""Cache of home timelines for Warbler.
+
+Three kinds of entry share one store:
+
+    timeline:<user id>  ids of the messages on the first page of the user's
+                        home timeline, which of them they liked, and the
+                        cursor for the next page
+    message:<id>        a message's columns (its card)
+    author:<user id>    a user's columns, minus the password hash
+
+Messages and authors are kept once however many timelines show them, so
+an author's new avatar needs one entry dropped, not one per follower.
+A homepage whose entries are all cached runs no SQL at all.
+
+Writes drop the entries they make stale rather than updating them:
+
+    posting or deleting a message   its readers' timelines (and its card)
+    following / unfollowing         the follower's timeline
+    liking / unliking               the liker's timeline (its liked ids)
+    editing a user, or a counter    their author entry
+
+The store is the shared RedisBackend, so every process sees these
+deletes at once. Entries also expire after `ttl` seconds, which bounds
+how long a page read just before a write, and cached just after it, can
+stay out of date. What gets cached is read from the primary, never a
+read replica: a lagging replica would hand back the rows from before
+the write that dropped the entry, to be served for the whole `ttl`.
+
+With no store (None) nothing is cached: a per-process store would only
+see its own process's deletes, and keep serving the rest stale.
+"""
+
+import pickle
+
+from sqlalchemy import inspect
+
+from models import db, Message, User
+from pagination import Page
+from replicas import reading_from_primary
+
+MESSAGE_COLUMNS = [
+    attr.key for attr in inspect(Message).column_attrs
+    if attr.key not in Message.unversioned_columns
+]
+
+AUTHOR_COLUMNS = [
+    attr.key for attr in inspect(User).column_attrs
+    if attr.key not in User.unversioned_columns
+]
+
+
+class TimelineCache:
+    """ First pages of home timelines, with their messages and authors. """
+
+    def __init__(self, store=None, prefix='warbler:', ttl=600):
+        self.store = store
+        self.prefix = prefix
+        self.ttl = ttl
+
+    @property
+    def enabled(self):
+        return self.store is not None
+
+    def get_page(self, user_id):
+        """ (Page, liked_ids) for the first page of `user_id`'s timeline,
+        or None if it isn't cached.
+
+        Messages and authors missing from the cache are loaded (one query
+        for each kind) and cached. Items are new Message objects outside
+        the DB session, each with its `user` set: enough for templates,
+        but they don't lazy-load anything.
+        """
+
+        entry = self._get_many('timeline', [user_id])[user_id]
+        if entry is None:
+            return None
+
+        messages = self._get_many('message', entry['ids'])
+        self._load_missing('message', messages, Message, MESSAGE_COLUMNS)
+
+        authors = self._get_many(
+            'author',
+            {columns['user_id'] for columns in messages.values() if columns})
+        self._load_missing('author', authors, User, AUTHOR_COLUMNS)
+
+        items = []
+        for message_id in entry['ids']:
+            columns = messages[message_id]
+            # Deleted since the page was cached (its readers' entries are
+            # dropped too, but a racing read may have put one back), or
+            # by an author being deleted
+            author = authors[columns['user_id']] if columns else None
+            if author is None or author['deactivated']:
+                continue
+
+            message = Message(**columns)
+            message.user = User(**author)
+            items.append(message)
+
+        return Page(items, older=entry['older']), entry['liked_ids']
+
+    def set_page(self, user_id, page, liked_ids):
+        """ Cache a first timeline page (of Messages with their users
+        loaded) and the ids on it `user_id` liked.
+        """
+
+        self._set_many('timeline', {user_id: {
+            'ids': [message.id for message in page],
+            'liked_ids': set(liked_ids),
+            'older': page.older,
+        }})
+        self._set_many('message', {
+            message.id: _columns(message, MESSAGE_COLUMNS)
+            for message in page
+        })
+        self._set_many('author', {
+            message.user.id: _columns(message.user, AUTHOR_COLUMNS)
+            for message in page
+        })
+
+    def invalidate_timelines(self, user_ids):
+        self._delete_many('timeline', user_ids)
+
+    def invalidate_messages(self, message_ids):
+        self._delete_many('message', message_ids)
+
+    def invalidate_authors(self, user_ids):
+        self._delete_many('author', user_ids)
+
+    def clear(self):
+        """ Remove every entry (a RedisBackend empties its whole database).
+        """
+
+        if self.store is not None:
+            self.store.clear()
+
+    def _key(self, kind, item_id):
+        return f"{self.prefix}{kind}:{item_id}"
+
+    def _get_many(self, kind, ids):
+        """ {id: value, or None if not cached} for `ids`. """
+
+        ids = list(ids)
+        if self.store is None:
+            return dict.fromkeys(ids)
+
+        raws = self.store.get_many([self._key(kind, i) for i in ids])
+        return {
+            item_id: None if raw is None else pickle.loads(raw)
+            for item_id, raw in zip(ids, raws)
+        }
+
+    def _set_many(self, kind, values):
+        if self.store is None:
+            return
+
+        self.store.set_many(
+            {self._key(kind, item_id): pickle.dumps(value)
+             for item_id, value in values.items()},
+            ttl=self.ttl,
+        )
+
+    def _delete_many(self, kind, ids):
+        if self.store is None:
+            return
+
+        self.store.delete_many([self._key(kind, i) for i in ids])
+
+    def _load_missing(self, kind, found, model, columns):
+        """ Fill in (and cache) the Nones in `found` from `model`'s table.
+        Ids with no row are left None.
+        """
+
+        missing = [item_id for item_id, value in found.items()
+                   if value is None]
+        if not missing:
+            return
+
+        with reading_from_primary():
+            rows = (db.session
+                    .query(*[getattr(model, column) for column in columns])
+                    .filter(model.id.in_(missing))
+                    .all())
+        loaded = {row.id: row._asdict() for row in rows}
+
+        self._set_many(kind, loaded)
+        found.update(loaded)
+
+
+def _columns(obj, columns):
+    return {column: getattr(obj, column) for column in columns}